@@ -1,9 +1,18 @@
+from array import array
+from concurrent.futures import Executor, Future, wait
+import contextlib
 import logging
+import os
 from pathlib import Path
+import re
 import shutil
 import subprocess
 import tempfile
-from typing import Iterable, Union
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Union
+
+from radioscripts.cache import ConversionCache
+from radioscripts.probe import PROBE_SIZE, probe_duration, wav_data_chunk
+from radioscripts.wav import WavWriter, header_size, resize_data
 
 
 logger = logging.getLogger(__name__)
@@ -13,6 +22,16 @@ RADIOMUSIC_SAMPLE_RATE: int = 44100
 RADIOMUSIC_BIT_DEPTH: int = 16
 RADIOMUSIC_CHANNELS: int = 1
 
+PCM_CHUNK_SIZE: int = 1024 * 1024
+
+PEAK_PATTERN = re.compile(r'^(?:Maximum|Minimum) amplitude:\s*(\S+)$', re.MULTILINE)
+
+# sox raw signed integer samples in native byte order, see `array` typecodes
+PCM_TYPECODES: dict[int, str] = {8: 'b', 16: 'h', 32: 'i'}
+
+# level in dB below which sound is taken as silence, dither noise included
+SILENCE_THRESHOLD: float = -80.0
+
 
 class SoxNotFoundError(Exception):
     def __str__(self) -> str:
@@ -28,13 +47,21 @@ class SoxError(Exception):
         return f'{self.message} (exit code {self.returncode})'
 
 
-def run_sox(*args: Union[str, Path]) -> str:
-    """Executes sox application with provided arguments."""
+def sox_command(*args: Union[str, Path]) -> list[Union[str, Path]]:
+    """Returns sox application command line with provided arguments."""
     sox_path = shutil.which('sox')
     if sox_path is None:
         raise SoxNotFoundError()
+    return [sox_path, *args]
 
-    cmd = [sox_path, *args]
+
+def run_sox(*args: Union[str, Path], stderr: bool = False) -> str:
+    """Executes sox application with provided arguments.
+
+    Returns the application output, or its error output if `stderr` is
+    set, that is where sox effects report statistics.
+    """
+    cmd = sox_command(*args)
     logger.debug('Running %s', ' '.join(map(str, cmd)))
     try:
         completed_process = subprocess.run(
@@ -46,15 +73,90 @@ def run_sox(*args: Union[str, Path]) -> str:
         logger.debug(
             'Sox stderr << EOB\n%s\n%s', completed_process.stderr.strip(), 'EOB'
         )
-        return completed_process.stdout
+        return completed_process.stderr if stderr else completed_process.stdout
     except subprocess.CalledProcessError as exc:
         raise SoxError(exc.returncode, exc.stderr) from exc
 
 
+@contextlib.contextmanager
+def open_sox(
+    *args: Union[str, Path],
+    stdin: Optional[int] = None,
+    stdout: Optional[int] = None,
+    report: Optional[Callable[[str], object]] = None,
+) -> Iterator[subprocess.Popen]:
+    """Starts sox application with provided arguments in background.
+
+    Use `subprocess.PIPE` for `stdin` or `stdout` to stream audio
+    through the process. Waits for the process to exit on leaving the
+    context and raises `SoxError` if it failed. Otherwise `report` is
+    called with the process error output, where sox effects report
+    statistics.
+    """
+    cmd = sox_command(*args)
+    logger.debug('Starting %s', ' '.join(map(str, cmd)))
+    # stderr goes to a file so that a chatty process never blocks on a full pipe
+    with tempfile.TemporaryFile() as stderr:
+        with subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr) as proc:
+            try:
+                yield proc
+            except BaseException:
+                proc.kill()
+                raise
+            finally:
+                if proc.stdin:
+                    with contextlib.suppress(BrokenPipeError):
+                        proc.stdin.close()
+                returncode = proc.wait()
+        stderr.seek(0)
+        message = stderr.read().decode(errors='replace').strip()
+        logger.debug('Sox stderr << EOB\n%s\n%s', message, 'EOB')
+        if returncode != 0:
+            raise SoxError(returncode, message)
+        if report is not None:
+            report(message)
+
+
+def raw_format(*, channels: int, sample_rate: int, bit_depth: int) -> list[str]:
+    """Returns sox format options of headerless signed integer audio."""
+    # fmt: off
+    return [
+        '-t', 'raw',
+        '-e', 'signed-integer',
+        '-b', f'{bit_depth}',
+        '-c', f'{channels}',
+        '-r', f'{sample_rate}',
+    ]
+    # fmt: on
+
+
 def measure_durations(*paths: Path) -> list[float]:
-    """Returns durations of sound files in seconds."""
-    sox_output = run_sox('--info', '-D', *paths)
-    return [float(line) for line in sox_output.strip().splitlines()]
+    """Returns durations of sound files in seconds.
+
+    MP3 and WAV files are probed by their headers, sox measures the
+    rest of files at once.
+    """
+    durations = [probe_duration(path) for path in paths]
+    unknown = [path for path, duration in zip(paths, durations) if duration is None]
+    if unknown:
+        sox_output = run_sox('--info', '-D', *unknown)
+        measured = iter(float(line) for line in sox_output.strip().splitlines())
+        durations = [next(measured) if d is None else d for d in durations]
+    return durations
+
+
+def parse_peak(statistics: str) -> float:
+    """Returns peak amplitude relative to full scale from sox stat report."""
+    peaks = [abs(float(peak)) for peak in PEAK_PATTERN.findall(statistics)]
+    return max(peaks, default=0)
+
+
+def measure_peak(path: Path) -> float:
+    """Returns peak amplitude of sound file relative to full scale.
+
+    The sound is only read, nothing is written.
+    """
+    return parse_peak(run_sox(path, '-n', 'stat', stderr=True))
 
 
 def convert(
@@ -64,74 +166,448 @@ def convert(
     channels: int,
     sample_rate: int,
     bit_depth: int,
-):
+    cache: Optional[ConversionCache] = None,
+) -> float:
     """Converts file sample rate, bit depth and channels number to provided values.
     And also removes silence from the beggining and end of the audio.
+
+    The audio is not normalized, its peak amplitude relative to full
+    scale is returned instead. Conversion is skipped if the cache has
+    the result already.
     """
+    if cache is not None:
+        digest = cache.digest(
+            input_path,
+            conversion_parameters(
+                channels=channels, sample_rate=sample_rate, bit_depth=bit_depth
+            ),
+        )
+        if cache.checkout(digest, output_path):
+            logger.debug('%s conversion found in cache', input_path.name)
+            if (peak := cache.peak(digest)) is None:
+                peak = measure_peak(output_path)
+            return peak
+        with cache.converting(digest, output_path) as tmp_path:
+            peak = convert(
+                input_path,
+                tmp_path,
+                channels=channels,
+                sample_rate=sample_rate,
+                bit_depth=bit_depth,
+            )
+        cache.remember_peak(digest, peak)
+        return peak
+
     # fmt: off
-    run_sox(
+    statistics = run_sox(
         input_path,
         '-b', f'{bit_depth}',
         output_path,
-        'channels', f'{channels}',
-        'gain', '-n',
-        'rate', '-s', '-a', f'{sample_rate}',
-        'reverse',
-        'silence', '1', '5', '0',
-        'reverse',
-        'silence', '1', '5', '0',
+        *conversion_effects(channels=channels, sample_rate=sample_rate),
+        'stat',  # passes audio through
+        stderr=True,
     )
     # fmt: on
+    trim_trailing_silence(output_path, channels=channels, bit_depth=bit_depth)
+    return parse_peak(statistics)
 
 
-def join(input_paths: list[Path], output_path: Path, *, crossfade_duration: float):
-    """Splices sounds together."""
-    if not input_paths:
-        return
+@contextlib.contextmanager
+def convert_stream(
+    output_path: Path,
+    *,
+    file_type: str,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    report_peak: Optional[Callable[[float], object]] = None,
+) -> Iterator[BinaryIO]:
+    """Provides a stream to write a sound file of provided type to,
+    converting it like `convert` does while it is written.
 
-    excess = crossfade_duration / 2
-    splices = measure_durations(*input_paths)[:-1]
-    for index in range(1, len(splices)):
-        splices[index] = splices[index - 1] + splices[index] - excess * index
+    `report_peak` is called with the sound peak amplitude relative to
+    full scale once it is converted.
+    """
+    statistics: list[str] = []
     # fmt: off
-    run_sox(
-        *input_paths,
+    with open_sox(
+        '-t', file_type, '-',
+        '-b', f'{bit_depth}',
         output_path,
-        'splice', '-q', *[f'{position},{excess}' for position in splices],
-        'compand', '0,0.02', '1:-6,0,-3', '0', '-90', '0.01',  # little bit of limiting
-        'gain', '-n',
-        'dither', '-s',
-    )
+        *conversion_effects(channels=channels, sample_rate=sample_rate),
+        'stat',  # passes audio through
+        stdin=subprocess.PIPE,
+        report=statistics.append,
+    ) as proc:
+        yield proc.stdin
     # fmt: on
+    trim_trailing_silence(output_path, channels=channels, bit_depth=bit_depth)
+    if report_peak is not None:
+        report_peak(parse_peak(statistics[0]))
 
 
-def make_radio_program(
+def convert_all(
     input_paths: Iterable[Path],
-    output_path: Path,
+    output_dir: Path,
     *,
-    crossfade_duration: int = 2,
-    channels: int = RADIOMUSIC_CHANNELS,
-    sample_rate: int = RADIOMUSIC_SAMPLE_RATE,
-    bit_depth: int = RADIOMUSIC_BIT_DEPTH,
-):
-    """Concatenates sounds together into a wav file,
-    creating a kind of radio station.
+    executor: Executor,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    cache: Optional[ConversionCache] = None,
+) -> tuple[list[Path], list[float]]:
+    """Converts files concurrently to wav files in provided directory,
+    see `convert`.
+
+    Returns converted files paths and their peak amplitudes in the order
+    of input files. Every file is submitted for conversion as soon as
+    the input provides it.
     """
-    with tempfile.TemporaryDirectory() as tmpdir:
-        staging_paths: list[Path] = []
+    output_paths: list[Path] = []
+    futures: list[Future] = []
+    try:
         for index, input_path in enumerate(input_paths, start=1):
-            staging_path = (
-                Path(tmpdir).joinpath(f'{index}_{input_path.name}').with_suffix('.wav')
+            output_path = output_dir.joinpath(f'{index}_{input_path.name}')
+            output_paths.append(output_path.with_suffix('.wav'))
+            futures.append(
+                executor.submit(
+                    convert,
+                    input_path,
+                    output_paths[-1],
+                    channels=channels,
+                    sample_rate=sample_rate,
+                    bit_depth=bit_depth,
+                    cache=cache,
+                )
             )
-            convert(
-                input_path,
-                staging_path,
-                channels=channels,
-                sample_rate=sample_rate,
-                bit_depth=bit_depth,
+    finally:
+        wait(futures)  # none of them should be left writing to the directory
+    return output_paths, [future.result() for future in futures]
+
+
+def conversion_effects(*, channels: int, sample_rate: int) -> list[str]:
+    """Returns sox effects chain used to convert a sample.
+
+    Only leading silence is removed by sox, see `trim_trailing_silence`.
+    """
+    # fmt: off
+    return [
+        'channels', f'{channels}',
+        'rate', '-s', '-a', f'{sample_rate}',
+        'silence', '1', '5', f'{SILENCE_THRESHOLD}d',
+    ]
+    # fmt: on
+
+
+def trim_trailing_silence(path: Path, *, channels: int, bit_depth: int):
+    """Cuts silence off the end of wav file audio data.
+
+    Only the silent end of the file is read, unlike reversing the whole
+    audio to trim it with sox.
+    """
+    frame_size = channels * bit_depth // 8
+    with path.open('r+b') as file:
+        chunk = wav_data_chunk(file.read(PROBE_SIZE))
+        if chunk is None:
+            return
+        _, offset, size = chunk
+        size = min(size, file.seek(0, os.SEEK_END) - offset)
+        end = offset + size - size % frame_size
+        while end > offset:
+            start = max(end - PCM_CHUNK_SIZE // frame_size * frame_size, offset)
+            file.seek(start)
+            data = file.read(end - start)
+            if length := sound_length(data, channels=channels, bit_depth=bit_depth):
+                end = start + length
+                break
+            end = start
+        if end == offset + size:
+            return
+        resize_data(file, offset, size, end - offset)
+    logger.debug('%d bytes of silence trimmed from %s', offset + size - end, path.name)
+
+
+def sound_length(data: bytes, *, channels: int, bit_depth: int) -> int:
+    """Returns bytes of raw PCM frames up to the end of the last one
+    which isn't silent, see `SILENCE_THRESHOLD`.
+    """
+    samples = array(PCM_TYPECODES[bit_depth], data)
+    threshold = 10 ** (SILENCE_THRESHOLD / 20) * 2 ** (bit_depth - 1)
+    for index in range(len(samples) - 1, -1, -1):
+        if abs(samples[index]) > threshold:
+            return (index // channels + 1) * channels * samples.itemsize
+    return 0
+
+
+def conversion_parameters(
+    *, channels: int, sample_rate: int, bit_depth: int
+) -> list[str]:
+    """Returns everything affecting conversion result, see `ConversionCache`."""
+    return [
+        f'{bit_depth}',
+        *conversion_effects(channels=channels, sample_rate=sample_rate),
+    ]
+
+
+def decoding_parameters(
+    *, channels: int, sample_rate: int, bit_depth: int
+) -> list[str]:
+    """Returns everything affecting decoding result, see `ConversionCache`.
+
+    Cached samples are peak normalized, like sox `gain -n` does.
+    """
+    return [
+        *conversion_parameters(
+            channels=channels, sample_rate=sample_rate, bit_depth=bit_depth
+        ),
+        'gain',
+        '-n',
+    ]
+
+
+def seek_pcm(file: BinaryIO) -> Optional[BinaryIO]:
+    """Moves WAV file position to the beginning of its audio data.
+
+    Returns a stream of the audio data only, so that chunks following
+    it are not read as sound, or None if the file is not a wav file.
+    """
+    if (chunk := wav_data_chunk(file.read(PROBE_SIZE))) is None:
+        return None
+    _, offset, size = chunk
+    file.seek(offset)
+    return LimitedReader(file, size)
+
+
+class LimitedReader:
+    """Binary stream wrapper reading no more than provided number of bytes."""
+
+    def __init__(self, stream: BinaryIO, size: int):
+        self.stream = stream
+        self.remaining = size
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads data from the stream."""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class SilenceTrimmer:
+    """Raw PCM stream wrapper dropping silence at the end, see
+    `sound_length`.
+
+    Silent frames are held back until they turn out to be followed
+    by sound.
+    """
+
+    def __init__(self, stream: BinaryIO, *, channels: int, bit_depth: int):
+        self.stream = stream
+        self.channels = channels
+        self.bit_depth = bit_depth
+        self.buffer = bytearray()
+        self.silence = bytearray()  # silent frames held back after the buffer
+        self.incomplete = b''  # part of a frame left from the previous read
+        self.ended = False
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads data from the stream."""
+        frame_size = self.channels * self.bit_depth // 8
+        while not self.ended and (size < 0 or len(self.buffer) < size):
+            data = self.stream.read(PCM_CHUNK_SIZE if size < 0 else size)
+            if not data:
+                self.ended = True
+                continue
+            data = self.incomplete + data
+            frames_size = len(data) - len(data) % frame_size
+            data, self.incomplete = data[:frames_size], data[frames_size:]
+            if length := sound_length(
+                data, channels=self.channels, bit_depth=self.bit_depth
+            ):
+                self.buffer += self.silence
+                self.buffer += data[:length]
+                self.silence = bytearray(data[length:])
+            else:
+                self.silence += data
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class TeeReader:
+    """Binary stream wrapper passing read data to a callback."""
+
+    def __init__(self, stream: BinaryIO, callback: Callable[[bytes], object]):
+        self.stream = stream
+        self.callback = callback
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads data from the stream."""
+        data = self.stream.read(size)
+        self.callback(data)
+        return data
+
+
+@contextlib.contextmanager
+def decode(
+    input_path: Path,
+    *,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    cache: Optional[ConversionCache] = None,
+    converted: bool = False,
+    report_peak: Optional[Callable[[float], object]] = None,
+) -> Iterator[BinaryIO]:
+    """Converts the file like `convert` does, but streams the result
+    as raw signed integer PCM instead of writing a file.
+
+    The peak amplitude of the sample is not known until it is decoded,
+    so the sample is streamed at its own level and `report_peak` is
+    called with the peak once the stream is read to the end. Cached
+    conversion results are normalized and streamed without running
+    sox, see `decode_cached`. Already `converted` wav file is streamed
+    as it is without running sox, its volume is up to the caller.
+    """
+    pcm_format = {
+        'channels': channels,
+        'sample_rate': sample_rate,
+        'bit_depth': bit_depth,
+    }
+
+    def report(statistics: str):
+        if report_peak is not None:
+            report_peak(parse_peak(statistics))
+
+    with contextlib.ExitStack() as stack:
+        if converted:
+            stream = seek_pcm(stack.enter_context(input_path.open('rb')))
+            if stream is None:
+                raise ValueError(f'{input_path} is not a wav file')
+        elif cache is not None:
+            stream = stack.enter_context(decode_cached(input_path, cache, **pcm_format))
+        else:
+            proc = stack.enter_context(
+                open_sox(
+                    input_path,
+                    *raw_format(**pcm_format),
+                    '-',
+                    *conversion_effects(channels=channels, sample_rate=sample_rate),
+                    'stat',  # passes audio through
+                    stdout=subprocess.PIPE,
+                    report=report,
+                )
             )
-            staging_paths.append(staging_path)
-        join(staging_paths, output_path, crossfade_duration=crossfade_duration)
+            stream = SilenceTrimmer(proc.stdout, channels=channels, bit_depth=bit_depth)
+        yield stream
+
+
+@contextlib.contextmanager
+def decode_cached(  # pylint: disable=too-many-locals
+    input_path: Path,
+    cache: ConversionCache,
+    *,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+) -> Iterator[BinaryIO]:
+    """Streams cached result of `decode`, or decodes the file storing
+    the result in the cache while streaming it.
+
+    Cached results are normalized by their peak amplitude, which is
+    tracked while the sample is decoded for the first time.
+    """
+    pcm_format = {
+        'channels': channels,
+        'sample_rate': sample_rate,
+        'bit_depth': bit_depth,
+    }
+    digest = cache.digest(input_path, decoding_parameters(**pcm_format))
+    with contextlib.ExitStack() as stack:
+        stream: Optional[BinaryIO] = None
+        if (cached_file := cache.open(digest)) is not None:
+            if (stream := seek_pcm(cached_file)) is None:
+                # the cache entry is replaced like a missing one
+                logger.warning('%s cached conversion is broken', input_path.name)
+                cached_file.close()
+            else:
+                logger.debug('%s conversion found in cache', input_path.name)
+                stack.enter_context(cached_file)
+
+        if stream is None:
+            tmp_path = stack.enter_context(cache.converting(digest))
+            peaks: list[float] = []
+
+            def normalize(exc_type, *_):
+                # the decoder has exited and reported the peak by then
+                if exc_type is None and (volume := normalizing_volume(peaks[0])) != 1:
+                    normalized_path = tmp_path.with_stem(f'{tmp_path.stem}-normalized')
+                    run_sox('-v', f'{volume}', tmp_path, normalized_path)
+                    os.replace(normalized_path, tmp_path)
+
+            stack.push(normalize)
+            decoded = stack.enter_context(
+                decode(input_path, **pcm_format, report_peak=peaks.append)
+            )
+            output = stack.enter_context(WavWriter(tmp_path, **pcm_format))
+            stream = reader = TeeReader(decoded, output.write)
+
+            def complete(exc_type, *_):
+                # the cached conversion must be complete whatever the consumer read
+                if exc_type is None:
+                    while reader.read(PCM_CHUNK_SIZE):
+                        pass
+
+            stack.push(complete)
+        yield stream
+
+
+def decode_all(
+    input_paths: Iterable[Path],
+    *,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    cache: Optional[ConversionCache] = None,
+    converted: bool = False,
+) -> Iterator[BinaryIO]:
+    """Decodes files one by one, see `decode`.
+
+    The next file is not decoded until the previous stream is consumed.
+    """
+    for input_path in input_paths:
+        with decode(
+            input_path,
+            channels=channels,
+            sample_rate=sample_rate,
+            bit_depth=bit_depth,
+            cache=cache,
+            converted=converted,
+        ) as stream:
+            yield stream
+
+
+def normalizing_volume(peak: float) -> float:
+    """Returns volume factor bringing sound peak to full scale."""
+    return 1 / peak if peak > 0 else 1
+
+
+def wav_file_size(
+    duration: float,
+    *,
+    channels: int = RADIOMUSIC_CHANNELS,
+    sample_rate: int = RADIOMUSIC_SAMPLE_RATE,
+    bit_depth: int = RADIOMUSIC_BIT_DEPTH,
+    alignment: Optional[int] = None,
+) -> int:
+    """Returns the size in bytes of a wav file of provided duration
+    in seconds written by `WavWriter`.
+    """
+    data_size = round(duration * sample_rate) * channels * bit_depth // 8
+    return header_size(alignment) + data_size + data_size % 2
 
 
 def calculate_required_space(
@@ -139,9 +615,48 @@ def calculate_required_space(
     files: int,
     minutes: int,
     *,
+    channels: int = RADIOMUSIC_CHANNELS,
     sample_rate: int = RADIOMUSIC_SAMPLE_RATE,
     bit_depth: int = RADIOMUSIC_BIT_DEPTH,
+    alignment: Optional[int] = None,
+    cluster_size: int = 1,
 ) -> int:
-    """Returns the size in bytes of N banks of M wav files K minutes each."""
-    bits = banks * files * minutes * 60 * sample_rate * bit_depth
-    return int(bits / 8 + 0.5)
+    """Returns the size in bytes of N banks of M wav files K minutes each.
+
+    Every file and bank directory takes whole clusters of the file system.
+    """
+    file_size = wav_file_size(
+        minutes * 60,
+        channels=channels,
+        sample_rate=sample_rate,
+        bit_depth=bit_depth,
+        alignment=alignment,
+    )
+    clusters = -(-file_size // cluster_size)  # rounded up
+    return banks * (files * clusters + 1) * cluster_size
+
+
+def calculate_staging_space(
+    stations: int,
+    minutes: int,
+    *,
+    converted: bool,
+    sample_byte_rate: int,
+    channels: int = RADIOMUSIC_CHANNELS,
+    sample_rate: int = RADIOMUSIC_SAMPLE_RATE,
+    bit_depth: int = RADIOMUSIC_BIT_DEPTH,
+) -> int:
+    """Returns the size in bytes of temporary files of N stations
+    K minutes each prepared at once.
+
+    Every station keeps its samples until it is rendered, converted
+    already if `converted` is set, or compressed at about
+    `sample_byte_rate` bytes per second otherwise. The station being
+    rendered may take twice its size more for converted samples and
+    parts of the program.
+    """
+    station_size = wav_file_size(
+        minutes * 60, channels=channels, sample_rate=sample_rate, bit_depth=bit_depth
+    )
+    samples_size = station_size if converted else minutes * 60 * sample_byte_rate
+    return stations * samples_size + 2 * station_size
@@ -0,0 +1,72 @@
+import argparse
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+import tempfile
+import time
+from typing import Optional
+import wave
+
+from radioscripts.program import engines, make_radio_program
+
+
+parser = argparse.ArgumentParser(
+    description='Compare radio program rendering engines on local sound files'
+)
+parser.add_argument(
+    '-e',
+    '--engine',
+    action='append',
+    choices=engines.keys(),
+    help='Engine to benchmark, may be repeated (default: all engines)',
+)
+parser.add_argument(
+    '-r',
+    '--repeat',
+    type=int,
+    default=3,
+    help='Number of renders per engine (default: %(default)s)',
+)
+parser.add_argument(
+    '-j',
+    '--jobs',
+    type=int,
+    default=1,
+    help='Number of samples converting at once (default: %(default)s)',
+)
+parser.add_argument('paths', type=Path, nargs='+', help='Sound files to splice')
+
+
+def benchmark(
+    engine: str, paths: list[Path], repeat: int, executor: Optional[Executor] = None
+) -> tuple[float, float]:
+    """Returns the best rendering time and the rendered program duration
+    in seconds.
+    """
+    timings = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_path = Path(tmpdir) / f'{engine}.wav'
+        for _ in range(repeat):
+            started = time.perf_counter()
+            make_radio_program(paths, output_path, engine=engine, executor=executor)
+            timings.append(time.perf_counter() - started)
+        with wave.open(str(output_path), 'rb') as output:
+            duration = output.getnframes() / output.getframerate()
+    return min(timings), duration
+
+
+def entrypoint():
+    """Renders the same samples with every engine and prints timings."""
+    args = parser.parse_args()
+    with ThreadPoolExecutor(args.jobs) as executor:
+        for engine in args.engine or engines.keys():
+            elapsed, duration = benchmark(
+                engine, args.paths, args.repeat, executor if args.jobs > 1 else None
+            )
+            print(
+                f'{engine:>10}: {elapsed:8.2f} s '
+                f'({duration / elapsed:6.1f}x realtime, {duration:.0f} s of audio)'
+            )
+
+
+if __name__ == '__main__':
+    entrypoint()
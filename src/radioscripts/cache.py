@@ -0,0 +1,375 @@
+import contextlib
+import errno
+import hashlib
+from email.message import Message
+import logging
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
+
+from radioscripts.download import download
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_PATH: Path = Path.home() / '.cache' / 'radioscripts'
+
+DIGEST_CHUNK_SIZE: int = 1024 * 1024
+
+# bytes copied by a single system call, the kernel caps it at about 2 GiB
+COPY_CHUNK_SIZE: int = 1024 * 1024 * 1024
+
+# kernel copy is not possible for the files, nothing is copied then
+UNSUPPORTED_COPY_ERRORS = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSOCK,
+)
+
+
+class DigestWriter:
+    """Binary file wrapper calculating SHA-256 digest of written data."""
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        """Writes data to the file."""
+        self.digest.update(data)
+        return self.file.write(data)
+
+
+def place_file(src: Path, dst: Path):
+    """Hard links the file to provided path, copies it if linking fails."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)
+
+
+def copy_file(src: Path, dst: Path):
+    """Copies file content without passing it through the process,
+    see `copy_data`.
+    """
+    with src.open('rb') as source, dst.open('wb') as target:
+        copy_data(source, target)
+
+
+def copy_data(source: BinaryIO, target: BinaryIO):
+    """Copies the rest of a file to another one in kernel.
+
+    `os.copy_file_range` lets the file system share blocks or copy them
+    server side, `os.sendfile` is tried if it is not supported. Data is
+    passed through the process as the last resort.
+    """
+    in_fd, out_fd = source.fileno(), target.fileno()
+    copiers: list[Callable[[], int]] = []
+    if hasattr(os, 'copy_file_range'):
+        copiers.append(lambda: os.copy_file_range(in_fd, out_fd, COPY_CHUNK_SIZE))
+    if hasattr(os, 'sendfile'):
+        copiers.append(lambda: os.sendfile(out_fd, in_fd, None, COPY_CHUNK_SIZE))
+    for copy in copiers:
+        try:
+            while copy():
+                pass
+            return
+        except OSError as exc:
+            if exc.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+            # e.g. old kernels don't copy between file systems
+            logger.debug('Could not copy %s in kernel\n%s', source.name, exc)
+    shutil.copyfileobj(source, target, DIGEST_CHUNK_SIZE)
+
+
+class Database:
+    """SQLite database shared between threads.
+
+    Subclasses define tables in `schema`.
+    """
+
+    schema = ''
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA foreign_keys = ON')
+        self._db.executescript(self.schema)
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Provides exclusive access to the database."""
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+
+class ObjectStore(Database):
+    """Content addressed files storage limited by the total size.
+
+    Least recently used files are evicted when the size limit is
+    exceeded. Files are handed out as hard links, so the evicted ones
+    stay available to whoever got them.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS objects (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            used REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, root: Path, *, budget: int):
+        super().__init__(root / 'index.sqlite3')
+        self.root = root
+        self.budget = budget
+        (root / 'tmp').mkdir(exist_ok=True)
+
+    def object_path(self, digest: str) -> Path:
+        """Returns path of the file stored under provided digest."""
+        return self.root / 'objects' / digest[:2] / digest
+
+    @contextlib.contextmanager
+    def temporary_path(self, suffix: str = '') -> Iterator[Path]:
+        """Provides a path on the storage file system to prepare a file."""
+        with tempfile.TemporaryDirectory(dir=self.root / 'tmp') as tmpdir:
+            yield Path(tmpdir) / f'object{suffix}'
+
+    def checkout(self, digest: str, path: Path) -> bool:
+        """Places stored file to provided path marking it as recently used.
+
+        Returns False if there is no such file.
+        """
+        with self.transaction() as db:
+            src = self.object_path(digest)
+            if not src.exists():
+                return False
+            place_file(src, path)
+            db.execute(
+                'UPDATE objects SET used = ? WHERE digest = ?', (time.time(), digest)
+            )
+        return True
+
+    def open(self, digest: str) -> Optional[BinaryIO]:
+        """Opens stored file for reading marking it as recently used.
+
+        Returns None if there is no such file.
+        """
+        with self.transaction() as db:
+            try:
+                file = self.object_path(digest).open('rb')
+            except FileNotFoundError:
+                return None
+            db.execute(
+                'UPDATE objects SET used = ? WHERE digest = ?', (time.time(), digest)
+            )
+        return file
+
+    def add(self, src: Path, digest: str, path: Optional[Path] = None):
+        """Moves the file to the storage and places it to provided path."""
+        dst = self.object_path(digest)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with self.transaction() as db:
+            os.replace(src, dst)
+            if path is not None:
+                place_file(dst, path)
+            db.execute(
+                'INSERT INTO objects VALUES (?, ?, ?) '
+                'ON CONFLICT (digest) DO UPDATE SET used = excluded.used',
+                (digest, dst.stat().st_size, time.time()),
+            )
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used files until they all fit the budget."""
+        with self.transaction() as db:
+            (total,) = db.execute('SELECT TOTAL(size) FROM objects').fetchone()
+            evicted = []
+            for digest, size in db.execute(
+                'SELECT digest, size FROM objects ORDER BY used'
+            ).fetchall():
+                if total <= self.budget:
+                    break
+                evicted.append(digest)
+                total -= size
+                self.object_path(digest).unlink(missing_ok=True)
+            db.executemany(
+                'DELETE FROM objects WHERE digest = ?', [(d,) for d in evicted]
+            )
+        if evicted:
+            logger.debug('%d files evicted from %s', len(evicted), self.root)
+
+
+class SampleCache(ObjectStore):
+    """Persistent cache of downloaded samples.
+
+    Samples are stored by content hash and looked up by URL. Entries
+    older than `max_age` seconds are revalidated with conditional
+    requests using ETag and Last-Modified headers.
+    """
+
+    schema = ObjectStore.schema + '''
+        CREATE TABLE IF NOT EXISTS urls (
+            url TEXT PRIMARY KEY,
+            digest TEXT NOT NULL REFERENCES objects (digest) ON DELETE CASCADE,
+            etag TEXT,
+            last_modified TEXT,
+            validated REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, root: Path, *, budget: int, max_age: float = 24 * 60 * 60):
+        super().__init__(root, budget=budget)
+        self.max_age = max_age
+
+    def __contains__(self, url: str) -> bool:
+        with self.transaction() as db:
+            row = db.execute('SELECT digest FROM urls WHERE url = ?', (url,)).fetchone()
+        return row is not None
+
+    def retrieve(
+        self, url: str, path: Path, *, abort: Optional[threading.Event] = None
+    ):
+        """Places the sample to provided path, downloading it only
+        if there is no fresh copy in the cache, see `download`.
+        """
+        with self.transaction() as db:
+            row = db.execute(
+                'SELECT digest, etag, last_modified, validated FROM urls WHERE url = ?',
+                (url,),
+            ).fetchone()
+
+        validators: dict[str, str] = {}
+        if row is not None:
+            digest, etag, last_modified, validated = row
+            if etag:
+                validators['If-None-Match'] = etag
+            if last_modified:
+                validators['If-Modified-Since'] = last_modified
+            fresh = time.time() - validated < self.max_age or not validators
+            if fresh and self.checkout(digest, path):
+                logger.debug('%s found in cache', url)
+                return
+
+        with self.temporary_path() as tmp_path:
+            fetched = self.fetch(url, tmp_path, headers=validators, abort=abort)
+            if fetched is None:
+                if self.checkout(digest, path):
+                    logger.debug('%s revalidated in cache', url)
+                    with self.transaction() as db:
+                        db.execute(
+                            'UPDATE urls SET validated = ? WHERE url = ?',
+                            (time.time(), url),
+                        )
+                    return
+                # the sample has been evicted in the meantime
+                fetched = self.fetch(url, tmp_path, abort=abort)
+            self.store(url, tmp_path, *fetched, path)
+
+    @staticmethod
+    def fetch(
+        url: str,
+        path: Path,
+        *,
+        headers: Optional[dict[str, str]] = None,
+        abort: Optional[threading.Event] = None,
+    ) -> Optional[tuple[str, Message]]:
+        """Downloads the sample to provided path.
+
+        Returns content digest and response headers, or None if the
+        sample is not modified according to conditional request headers.
+        """
+        with path.open('wb') as file:
+            writer = DigestWriter(file)
+            response_headers = download(url, writer, headers=headers, abort=abort)
+        if response_headers is None:
+            return None
+        return writer.digest.hexdigest(), response_headers
+
+    def store(self, url: str, src: Path, digest: str, headers: Message, path: Path):
+        """Adds downloaded sample to the cache."""
+        self.add(src, digest, path)
+        with self.transaction() as db:
+            # the sample is evicted right away when it exceeds the budget
+            db.execute(
+                'INSERT OR REPLACE INTO urls SELECT ?, ?, ?, ?, ? '
+                'WHERE EXISTS (SELECT 1 FROM objects WHERE digest = ?)',
+                (
+                    url,
+                    digest,
+                    headers.get('ETag'),
+                    headers.get('Last-Modified'),
+                    time.time(),
+                    digest,
+                ),
+            )
+        logger.debug('%s cached as %s', url, digest)
+
+
+class ConversionCache(ObjectStore):
+    """Persistent cache of converted samples.
+
+    Converted wav files are stored by digest of the source file content
+    and the conversion parameters. Their peak amplitudes are kept too.
+    """
+
+    schema = ObjectStore.schema + '''
+        CREATE TABLE IF NOT EXISTS peaks (
+            digest TEXT PRIMARY KEY REFERENCES objects (digest) ON DELETE CASCADE,
+            peak REAL NOT NULL
+        );
+    '''
+
+    @staticmethod
+    def digest(source: Path, parameters: Iterable[str]) -> str:
+        """Returns the key of source file converted with provided parameters."""
+        digest = hashlib.sha256()
+        with source.open('rb') as file:
+            while chunk := file.read(DIGEST_CHUNK_SIZE):
+                digest.update(chunk)
+        for parameter in parameters:
+            digest.update(b'\0' + parameter.encode())
+        return digest.hexdigest()
+
+    def peak(self, digest: str) -> Optional[float]:
+        """Returns known peak amplitude of the stored file."""
+        with self.transaction() as db:
+            row = db.execute(
+                'SELECT peak FROM peaks WHERE digest = ?', (digest,)
+            ).fetchone()
+        return row and row[0]
+
+    def remember_peak(self, digest: str, peak: float):
+        """Saves peak amplitude of the file unless it is evicted already."""
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO peaks SELECT digest, ? FROM objects '
+                'WHERE digest = ?',
+                (peak, digest),
+            )
+
+    @contextlib.contextmanager
+    def converting(self, digest: str, path: Optional[Path] = None) -> Iterator[Path]:
+        """Provides a path to write converted file to.
+
+        The file is stored and placed to provided path on successful
+        exit from the context.
+        """
+        with self.temporary_path('.wav') as tmp_path:
+            yield tmp_path
+            self.add(tmp_path, digest, path)
@@ -0,0 +1,311 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import ctypes
+import errno
+from itertools import count
+import logging
+import os
+from pathlib import Path
+import struct
+import sys
+import threading
+import time
+from typing import BinaryIO, Callable, Hashable, Iterable, Iterator, Optional
+
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from radioscripts.cache import copy_file
+from radioscripts.probe import PROBE_SIZE, wav_data_chunk
+
+logger = logging.getLogger(__name__)
+
+
+SECTOR_SIZE: int = 512
+
+# Linux ioctl reporting physical extents of a file, see linux/fiemap.h
+FS_IOC_FIEMAP: int = 0xC020660B
+FIEMAP_FLAG_SYNC: int = 0x1
+FIEMAP_EXTENT_LAST: int = 0x1
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQ2QI3I')
+
+# Linux fallocate mode allocating space beyond the end of file, see linux/falloc.h
+FALLOC_FL_KEEP_SIZE: int = 0x1
+
+
+def reserve_file(dir_: Path, name: str) -> Path:
+    """Creates an empty file in a directory without overwriting an
+    existing file. Uses a new name in case of conflict.
+
+    Returns the created file path.
+    """
+    dir_.mkdir(exist_ok=True)
+    dst = dir_ / name
+    for num in count(1):
+        try:
+            dst.touch(exist_ok=False)
+            break
+        except FileExistsError:
+            # append something like a version to the filename
+            dst = dst.with_stem(Path(name).stem + '-' + str(num))
+    return dst
+
+
+def move_file(src: Path, dst: Path):
+    """Renames the file to provided path replacing it, copies the file
+    and removes the original if they are on different file systems.
+    """
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+    copy_file(src, dst)
+    with dst.open('rb') as file:
+        os.fsync(file.fileno())
+    src.unlink()
+
+
+def cluster_size(path: Path) -> int:
+    """Returns allocation unit size in bytes of the file system."""
+    if not hasattr(os, 'statvfs'):
+        return SECTOR_SIZE
+    return os.statvfs(path).f_frsize
+
+
+def load_fallocate() -> Optional[Callable[[int, int, int, int], int]]:
+    """Returns Linux fallocate function of the C library, or None if it
+    is not available.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    function = getattr(libc, 'fallocate64', None) or getattr(libc, 'fallocate', None)
+    if function is not None:
+        function.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+        function.restype = ctypes.c_int
+    return function
+
+
+fallocate = load_fallocate()
+
+
+def preallocate(file: BinaryIO, size: int):
+    """Allocates space for the whole file at once, so that file system
+    can keep it contiguous.
+
+    The file size is kept, so that the space is not filled with zeros
+    before the data is written, like `os.posix_fallocate` does on FAT.
+    Nothing is allocated where Linux fallocate is not available.
+    """
+    if fallocate is None:
+        return
+    if fallocate(file.fileno(), FALLOC_FL_KEEP_SIZE, 0, size) == 0:
+        return
+    code = ctypes.get_errno()
+    if code not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+        raise OSError(code, os.strerror(code), file.name)
+    logger.debug('Could not preallocate %s\n%s', file.name, os.strerror(code))
+
+
+class CardWriter:
+    """Renders files to the SD card one by one in a dedicated thread.
+
+    Files are written in the order of their keys, a file submitted
+    early waits for the ones before it. Every file is rendered straight
+    into space preallocated for it and synced before the next one is
+    written, so that writes don't interleave on the card and files stay
+    contiguous.
+
+    No more than `ahead` files after the one being written are prepared
+    at once if it is provided, see `wait_for_room`.
+    """
+
+    def __init__(self, order: Iterable[Hashable], *, ahead: Optional[int] = None):
+        self.ahead = ahead
+        self._order = deque(order)
+        self._positions = {key: index for index, key in enumerate(self._order)}
+        self._next = 0  # position of the next file to be written
+        # files waiting for their turn, None for files which won't come
+        self._submitted: dict[
+            Hashable, Optional[tuple[Callable[[Path], object], Path, int, Future]]
+        ] = {}
+        self._futures: list[Future] = []
+        self._closed = False
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='CardWriter')
+        # sizes in bytes and durations in seconds of written files
+        self.written: list[tuple[int, float]] = []
+
+    def wait_for_room(self, key: Hashable):
+        """Waits until the file is no more than `ahead` files after the
+        next one to be written, so that files waiting for their turn
+        don't pile up.
+        """
+        with self._room:
+            self._room.wait_for(
+                lambda: self._closed
+                or self.ahead is None
+                or self._positions[key] < self._next + self.ahead
+            )
+
+    def submit(
+        self, key: Hashable, render: Callable[[Path], object], dst: Path, size: int
+    ) -> Future:
+        """Schedules rendering the file to provided path, or to a new
+        name if the path exists.
+
+        `render` writes the file to the path it is called with, which
+        has space preallocated for provided size in bytes. Returns
+        a future resolved with the written file path, or cancelled if
+        the writer is shut down.
+        """
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                future.cancel()
+                return future
+            self._submitted[key] = (render, dst, size, future)
+            self._futures.append(future)
+            self._schedule()
+        return future
+
+    def discard(self, key: Hashable):
+        """Lets the files after the one which won't be submitted go on."""
+        with self._lock:
+            self._submitted[key] = None
+            self._schedule()
+
+    def _schedule(self):
+        if self._closed:
+            return
+        while self._order and self._order[0] in self._submitted:
+            key = self._order.popleft()
+            self._next += 1
+            if (submitted := self._submitted.pop(key)) is not None:
+                self._executor.submit(self.deliver, *submitted)
+        self._room.notify_all()  # the files after them may go on
+
+    def deliver(
+        self, render: Callable[[Path], object], dst: Path, size: int, future: Future
+    ):
+        """Writes the file resolving the future."""
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(self.write(render, dst, size))
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                future.set_exception(exc)
+
+    def write(self, render: Callable[[Path], object], dst: Path, size: int) -> Path:
+        """Renders the file to provided path or to a new name, and returns
+        the written path.
+
+        The file is rendered under a temporary name next to it, so that
+        a partly written file never takes the name.
+        """
+        started = time.perf_counter()
+        path = reserve_file(dst.parent, dst.name)
+        part = path.with_name(f'.{path.name}.part')
+        try:
+            with part.open('wb') as file:
+                preallocate(file, size)
+            render(part)
+            with part.open('rb') as file:
+                os.fsync(file.fileno())
+                size = os.fstat(file.fileno()).st_size
+            move_file(part, path)
+        except BaseException:
+            part.unlink(missing_ok=True)
+            path.unlink(missing_ok=True)
+            raise
+        elapsed = time.perf_counter() - started
+        self.written.append((size, elapsed))
+        logger.debug(
+            '%s written in %.1f s (%.1f MB/s)',
+            path,
+            elapsed,
+            size / 1024**2 / elapsed,
+        )
+        return path
+
+    def throughput(self) -> tuple[float, float]:
+        """Returns average and the lowest write speed in bytes per second."""
+        sizes, durations = zip(*self.written)
+        slowest = min(size / duration for size, duration in self.written)
+        return sum(sizes) / sum(durations), slowest
+
+    def shutdown(self):
+        """Stops writing and cancels files waiting for their turn.
+
+        Files submitted afterwards are cancelled right away.
+        """
+        with self._room:
+            self._closed = True
+            self._room.notify_all()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            for future in self._futures:
+                future.cancel()  # written ones are done already
+            self._submitted.clear()
+
+
+def file_extents(path: Path) -> Optional[list[tuple[int, int]]]:
+    """Returns physical offsets and lengths in bytes of the file parts
+    on its device, or None if the file system doesn't tell.
+    """
+    if fcntl is None:
+        return None
+    extents: list[tuple[int, int]] = []
+    start = 0
+    with path.open('rb') as file:
+        while True:
+            # the rest of the file, up to a batch of extents
+            header = FIEMAP_HEADER.pack(start, 2**64 - 1, FIEMAP_FLAG_SYNC, 0, 64, 0)
+            request = bytearray(header + bytes(FIEMAP_EXTENT.size * 64))
+            try:
+                fcntl.ioctl(file.fileno(), FS_IOC_FIEMAP, request)
+            except OSError as exc:
+                logger.debug('Could not map %s\n%s', path, exc)
+                return None
+            mapped = FIEMAP_HEADER.unpack_from(request)[3]
+            for index in range(mapped):
+                logical, physical, length, _, _, flags, *_ = FIEMAP_EXTENT.unpack_from(
+                    request, FIEMAP_HEADER.size + index * FIEMAP_EXTENT.size
+                )
+                extents.append((physical, length))
+            if not mapped or flags & FIEMAP_EXTENT_LAST:
+                return extents
+            start = logical + length
+
+
+def count_fragments(extents: list[tuple[int, int]]) -> int:
+    """Returns number of contiguous runs of file extents."""
+    return sum(
+        1
+        for index, (physical, _) in enumerate(extents)
+        if index == 0 or sum(extents[index - 1]) != physical
+    )
+
+
+def verify(target: Path) -> Iterator[tuple[Path, Optional[int], Optional[int]]]:
+    """Yields station files on the card with numbers of their fragments
+    and offsets of their audio data, None if it is unknown.
+    """
+    for path in sorted(target.glob('*/*.wav')):
+        extents = file_extents(path)
+        with path.open('rb') as file:
+            chunk = wav_data_chunk(file.read(PROBE_SIZE))
+        yield (
+            path,
+            None if extents is None else count_fragments(extents),
+            None if chunk is None else chunk[1],
+        )
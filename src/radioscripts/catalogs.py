@@ -4,8 +4,8 @@ import logging
 import re
 from typing import Generic, Optional, TypeVar
 import urllib.parse
-import urllib.request
 
+from radioscripts.download import client
 from radioscripts.worker import Catalog
 
 
@@ -32,7 +32,7 @@ class HTMLResourceParser(HTMLParser, Generic[ScrapedItem]):
         self.url = url
         self._data = []
         with contextlib.closing(self):
-            with urllib.request.urlopen(url) as response:
+            with client.request(url) as response:
                 self.feed(response.read().decode())
         logger.debug('Found %d items on %s page', len(self._data), url)
         return self._data
@@ -2,14 +2,22 @@ import argparse
 from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
 import itertools
 import logging
+import os
 from pathlib import Path
 import shutil
 import sys
+import tempfile
 import time
 from typing import Iterable
 
-from radioscripts.audio import calculate_required_space
+from radioscripts.audio import calculate_required_space, calculate_staging_space
+from radioscripts.cache import DEFAULT_CACHE_PATH, ConversionCache, SampleCache
+from radioscripts.card import SECTOR_SIZE, cluster_size, verify
 from radioscripts.catalogs import IrdialCatalog, UbuSoundCatalog
+from radioscripts.download import client
+from radioscripts.index import CatalogIndex
+from radioscripts.planner import DEFAULT_BYTE_RATE
+from radioscripts.program import engines
 from radioscripts.worker import Catalog, Worker
 
 
@@ -48,6 +56,138 @@ parser.add_argument(
     default=30,
     help='Audio file duration (default: %(default)s)',
 )
+parser.add_argument(
+    '-e',
+    '--engine',
+    choices=engines.keys(),
+    default='staging',
+    help='Audio rendering engine (default: %(default)s)',
+)
+parser.add_argument(
+    '--planning',
+    choices=('packing', 'random'),
+    default='packing',
+    help=(
+        'Pick samples that fill stations best or just random ones '
+        '(default: %(default)s)'
+    ),
+)
+parser.add_argument(
+    '--excerpts',
+    type=float,
+    nargs='?',
+    const=5,
+    metavar='MINUTES',
+    help=(
+        'Use random parts of long MP3 sounds instead of skipping them '
+        '(default part length: %(const)s)'
+    ),
+)
+parser.add_argument(
+    '--stream',
+    action='store_true',
+    help=(
+        'Convert samples while downloading them without saving sound files '
+        '(caches are not used then)'
+    ),
+)
+parser.add_argument(
+    '--precrawl',
+    type=int,
+    nargs='?',
+    const=16,
+    metavar='CONNECTIONS',
+    help='Fetch all catalog pages concurrently before composing (default: %(const)s)',
+)
+parser.add_argument(
+    '--downloads',
+    type=int,
+    default=16,
+    help='Number of stations downloading samples at once (default: %(default)s)',
+)
+parser.add_argument(
+    '--prefetch',
+    type=int,
+    default=2,
+    help='Number of samples of a station downloaded in advance (default: %(default)s)',
+)
+parser.add_argument(
+    '--connections',
+    type=int,
+    default=6,
+    help='Number of simultaneous connections to a server (default: %(default)s)',
+)
+parser.add_argument(
+    '--queue',
+    type=int,
+    default=4,
+    help=(
+        'Number of downloaded stations waiting to be rendered to SD card '
+        '(default: %(default)s)'
+    ),
+)
+parser.add_argument(
+    '--conversions',
+    type=int,
+    default=os.cpu_count() or 1,
+    help=(
+        'Number of samples converting, or program parts rendering with '
+        'segments engine, at once (default: %(default)s)'
+    ),
+)
+parser.add_argument(
+    '--cache',
+    type=Path,
+    nargs='?',
+    const=DEFAULT_CACHE_PATH,
+    help=(
+        'Keep catalog index, downloaded and converted samples in a directory '
+        '(default: %(const)s)'
+    ),
+)
+parser.add_argument(
+    '--cache-size',
+    type=int,
+    default=2048,
+    help='Downloaded samples cache size in megabytes (default: %(default)s)',
+)
+parser.add_argument(
+    '--conversions-cache-size',
+    type=int,
+    default=8192,
+    help='Converted samples cache size in megabytes (default: %(default)s)',
+)
+parser.add_argument(
+    '--catalog-ttl',
+    type=int,
+    default=168,
+    help='Hours before indexed catalog pages are scraped again (default: %(default)s)',
+)
+parser.add_argument(
+    '--align',
+    type=int,
+    nargs='?',
+    const=0,
+    metavar='BYTES',
+    help=(
+        'Pad station file headers, so that audio data starts at a multiple '
+        'of bytes (default: the SD card cluster size)'
+    ),
+)
+parser.add_argument(
+    '--verify',
+    action='store_true',
+    help='Report fragmentation of station files on the SD card and exit',
+)
+parser.add_argument(
+    '--workdir',
+    type=Path,
+    help=(
+        'Keep temporary files in a directory, e.g. on the cache file system '
+        'to link cached samples instead of copying them (default: system '
+        'temporary directory)'
+    ),
+)
 parser.add_argument('path', type=Path, help='Path to SD card')
 
 
@@ -55,6 +195,28 @@ def log_uncaught_exception(type_, value, traceback):
     logging.critical('%s\nProgram terminated', value)
 
 
+def confirm_free_space(
+    target_path: Path, target_size: int, staging_path: Path, staging_size: int
+):
+    """Asks whether to continue if there is not enough free space for
+    stations on the SD card or for temporary files, which take space
+    on the SD card too if they are on the same file system.
+    """
+    required = {target_path: target_size}
+    if staging_path.stat().st_dev == target_path.stat().st_dev:
+        required[target_path] += staging_size
+    else:
+        required[staging_path] = staging_size
+    for path, size in required.items():
+        if shutil.disk_usage(path).free < size:
+            prompt = (
+                f'There is not enough free disk space on {path.anchor}. '
+                'Do you want to continue? (y/N) '
+            )
+            if input(prompt) != 'y':
+                sys.exit(2)
+
+
 def wait_progress(
     futures: Iterable[Future],
     *,
@@ -113,7 +275,27 @@ def pretty_size(bytes_: int) -> tuple[float, str]:
     return value, label
 
 
-def entrypoint():
+def print_verification(target_path: Path):
+    """Prints fragments number and audio data offset of every station
+    file on the SD card.
+    """
+    files = fragmented = misaligned = 0
+    for path, fragments, offset in verify(target_path):
+        files += 1
+        fragmented += bool(fragments and fragments > 1)
+        misaligned += bool(offset is None or offset % SECTOR_SIZE)
+        print(
+            f'{path.relative_to(target_path)}: '
+            f'{"unknown" if fragments is None else fragments} fragments, '
+            f'audio data at {"unknown" if offset is None else offset} bytes'
+        )
+    print(
+        f'{fragmented} of {files} files are fragmented, '
+        f'{misaligned} are not aligned to {SECTOR_SIZE} byte sectors'
+    )
+
+
+def entrypoint():  # pylint: disable=too-many-locals,too-many-branches
     """Compiles Radio Music module compatible stations
     from online catalog of sounds.
 
@@ -131,27 +313,92 @@ def entrypoint():
         sys.excepthook = log_uncaught_exception
 
     target_path = args.path.resolve(strict=True)  # make sure the path exists
+    if args.verify:
+        print_verification(target_path)
+        return
+
+    # samples, conversions and rendering parts go there
+    workdir = args.workdir.resolve(strict=True) if args.workdir else None
 
-    total_size = calculate_required_space(args.banks, args.files, args.minutes)
+    cluster = cluster_size(target_path)
+    alignment = args.align or cluster if args.align is not None else None
+    total_size = calculate_required_space(
+        args.banks,
+        args.files,
+        args.minutes,
+        alignment=alignment,
+        cluster_size=cluster,
+    )
     print('Space required on SD card is {0:.3f} {1}'.format(*pretty_size(total_size)))
+    # downloading stations and the ones waiting to be rendered
+    staging_size = calculate_staging_space(
+        args.downloads + args.queue,
+        args.minutes,
+        converted=args.stream,
+        sample_byte_rate=DEFAULT_BYTE_RATE,
+    )
+    print(
+        'Space required for temporary files is {0:.3f} {1}'.format(
+            *pretty_size(staging_size)
+        )
+    )
+    confirm_free_space(
+        target_path,
+        total_size,
+        workdir or Path(tempfile.gettempdir()),
+        staging_size,
+    )
 
-    free_space = shutil.disk_usage(target_path).free
-    if free_space < total_size:
-        prompt = (
-            f'There is not enough free disk space on {target_path.anchor}. '
-            'Do you want to continue? (y/N) '
+    catalog = catalogs[args.catalog]()
+    if args.cache:
+        catalog = CatalogIndex(
+            catalog, args.cache / 'catalogs.sqlite3', max_age=args.catalog_ttl * 3600
         )
-        if input(prompt) != 'y':
-            sys.exit(2)
 
+    converter = ThreadPoolExecutor(args.conversions, thread_name_prefix='Converter')
+    # every downloading station fetches the awaited sample and the ones ahead
+    prefetcher = ThreadPoolExecutor(
+        args.downloads * (args.prefetch + 1), thread_name_prefix='Prefetcher'
+    )
     worker = Worker(
         target=target_path,
-        catalog=catalogs[args.catalog](),
+        catalog=catalog,
         banks=args.banks,
         files=args.files,
         minutes=args.minutes,
+        engine=args.engine,
+        planning=args.planning,
+        render_queue=args.queue,
+        excerpts=args.excerpts * 60 if args.excerpts else None,
+        streaming=args.stream,
+        prefetch=args.prefetch,
+        prefetcher=prefetcher,
+        converter=converter,
+        alignment=alignment,
+        workdir=workdir,
+        cache=(
+            SampleCache(args.cache / 'samples', budget=args.cache_size * 1024**2)
+            if args.cache
+            else None
+        ),
+        conversions=(
+            ConversionCache(
+                args.cache / 'conversions',
+                budget=args.conversions_cache_size * 1024**2,
+            )
+            if args.cache
+            else None
+        ),
     )
-    executor = ThreadPoolExecutor(thread_name_prefix='Composer')
+    client.connections_per_host = args.connections
+    if args.precrawl:
+        pages, elapsed = worker.precrawl(args.precrawl)
+        print(
+            f'Crawled {pages} catalog pages in {elapsed:.1f} s '
+            f'({pages / elapsed:.1f} pages/s)'
+        )
+
+    executor = ThreadPoolExecutor(args.downloads, thread_name_prefix='Downloader')
     try:
         futures = worker.start(executor)
         if args.debug:
@@ -161,5 +408,16 @@ def entrypoint():
         else:
             wait_progress(futures)
     except Exception as exc:
+        # downloads waiting for room in the writer go on then
+        worker.writer.shutdown()
         executor.shutdown(wait=True, cancel_futures=True)
+        prefetcher.shutdown(wait=True, cancel_futures=True)
+        converter.shutdown(wait=True, cancel_futures=True)
         raise exc
+
+    if worker.writer.written:
+        average, slowest = worker.writer.throughput()
+        print(
+            f'Written {len(worker.writer.written)} files '
+            f'at {average / 1024**2:.1f} MB/s (slowest {slowest / 1024**2:.1f} MB/s)'
+        )
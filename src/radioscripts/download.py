@@ -0,0 +1,361 @@
+import contextlib
+from email.message import Message
+import http.client
+import logging
+import math
+import random
+import re
+import threading
+import time
+from typing import BinaryIO, Iterator, Optional
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from radioscripts import VERSION
+from radioscripts.probe import PROBE_SIZE, id3v2_size, mp3_duration, mp3_frames
+
+
+logger = logging.getLogger(__name__)
+
+
+DOWNLOAD_BUFFER_SIZE: int = 1024 * 1024
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+DOWNLOAD_ATTEMPTS: int = 5
+
+DOWNLOAD_BACKOFF: float = 1  # seconds
+
+USER_AGENT: str = f'radioscripts/{VERSION}'
+
+
+class DownloadError(OSError):
+    """Resource could not be downloaded."""
+
+
+class DownloadAborted(DownloadError):
+    """Download has been aborted by the caller."""
+
+
+class HTTPClient:
+    """HTTP client keeping connections alive to reuse them.
+
+    Number of simultaneous requests to a host is limited. Proxies are
+    taken from the environment like urllib does unless provided, see
+    `urllib.request.getproxies`, proxy authentication is not supported.
+    """
+
+    def __init__(
+        self,
+        *,
+        connections_per_host: int = 6,
+        timeout: float = 60,
+        proxies: Optional[dict[str, str]] = None,
+    ):
+        self.timeout = timeout
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+
+        self._lock = threading.Lock()
+        self._idle: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+        self._limits: dict[tuple[str, str], threading.BoundedSemaphore] = {}
+        self._connections_per_host = connections_per_host
+
+    @property
+    def connections_per_host(self) -> int:
+        """Number of simultaneous requests to a host."""
+        return self._connections_per_host
+
+    @connections_per_host.setter
+    def connections_per_host(self, value: int):
+        # requests sent from now on are limited by new semaphores
+        with self._lock:
+            self._connections_per_host = value
+            self._limits.clear()
+
+    def proxy(self, host: tuple[str, str]) -> Optional[str]:
+        """Returns address of the proxy to send requests to the host
+        through, or None if they are sent directly.
+        """
+        scheme, netloc = host
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(netloc):
+            return None
+        return urllib.parse.urlsplit(proxy).netloc or proxy
+
+    def host_limit(self, host: tuple[str, str]) -> threading.BoundedSemaphore:
+        """Returns semaphore limiting requests to the host."""
+        with self._lock:
+            if host not in self._limits:
+                self._limits[host] = threading.BoundedSemaphore(
+                    self._connections_per_host
+                )
+            return self._limits[host]
+
+    def connection(
+        self, host: tuple[str, str]
+    ) -> tuple[http.client.HTTPConnection, bool]:
+        """Returns idle connection to the host or a new one, and whether
+        the connection is reused.
+        """
+        with self._lock:
+            if idle := self._idle.get(host):
+                return idle.pop(), True
+        scheme, netloc = host
+        connection_class = (
+            http.client.HTTPSConnection
+            if scheme == 'https'
+            else http.client.HTTPConnection
+        )
+        if (proxy := self.proxy(host)) is None:
+            return connection_class(netloc, timeout=self.timeout), False
+        connection = connection_class(proxy, timeout=self.timeout)
+        if scheme == 'https':
+            connection.set_tunnel(netloc)
+        return connection, False
+
+    def recycle(
+        self,
+        host: tuple[str, str],
+        connection: http.client.HTTPConnection,
+        response: http.client.HTTPResponse,
+    ):
+        """Keeps connection for the next request to the host if the
+        response is read entirely, closes it otherwise.
+        """
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.setdefault(host, []).append(connection)
+        else:
+            connection.close()
+
+    def send(
+        self, host: tuple[str, str], target: str, headers: dict[str, str]
+    ) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        """Sends GET request to the host.
+
+        Idle connection may be closed by the server already, a new one
+        is tried then.
+        """
+        while True:
+            connection, reused = self.connection(host)
+            try:
+                connection.request('GET', target, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+
+    @contextlib.contextmanager
+    def request(
+        self, url: str, *, headers: Optional[dict[str, str]] = None, redirects: int = 5
+    ) -> Iterator[http.client.HTTPResponse]:
+        """Sends GET request and provides the response, following redirects.
+
+        Raises `urllib.error.HTTPError` on error statuses like urllib does.
+        """
+        headers = {'User-Agent': USER_AGENT, **(headers or {})}
+        for _ in range(redirects + 1):
+            scheme, netloc, path, query, _ = urllib.parse.urlsplit(url)
+            host = (scheme, netloc)
+            target = urllib.parse.urlunsplit(('', '', path or '/', query, ''))
+            if scheme == 'http' and self.proxy(host) is not None:
+                # HTTP proxy needs the whole URL, HTTPS is tunneled through it
+                target = f'{scheme}://{netloc}{target}'
+            with self.host_limit(host):
+                connection, response = self.send(host, target, headers)
+                try:
+                    if response.status in REDIRECT_STATUSES:
+                        response.read()
+                        location = response.headers['Location']
+                        logger.debug('%s redirected to %s', url, location)
+                        url = urllib.parse.urljoin(url, location)
+                        continue
+                    if response.status >= 400:
+                        raise urllib.error.HTTPError(
+                            url,
+                            response.status,
+                            response.reason,
+                            response.headers,
+                            None,
+                        )
+                    yield response
+                    return
+                finally:
+                    self.recycle(host, connection, response)
+        raise urllib.error.HTTPError(
+            url, response.status, 'Too many redirects', response.headers, None
+        )
+
+
+client = HTTPClient()
+
+
+def fetch_range(url: str, start: int, length: int) -> tuple[bytes, Optional[int]]:
+    """Returns requested part of the resource and the resource size
+    in bytes if the server told it.
+
+    The beginning of the resource is read from servers ignoring Range
+    header too. Other parts are not, as everything before them would
+    be downloaded, `DownloadError` is raised then.
+    """
+    with client.request(
+        url, headers={'Range': f'bytes={start}-{start + length - 1}'}
+    ) as response:
+        if response.status == 206:
+            match = CONTENT_RANGE_PATTERN.fullmatch(
+                response.headers.get('Content-Range', '')
+            )
+            size = int(match[3]) if match and match[3] != '*' else None
+            return response.read(length), size
+        if start:
+            raise DownloadError(f'{url} ranges are not supported')
+        size = response.headers.get('Content-Length')
+        return response.read(length), int(size) if size else None
+
+
+def probe_remote(url: str) -> tuple[Optional[int], Optional[float]]:
+    """Returns size in bytes and estimated duration in seconds of MP3
+    file without downloading it.
+
+    Fetches only the beginning of the file to parse frame headers.
+    """
+    try:
+        data, size = fetch_range(url, 0, PROBE_SIZE)
+        if size is None:
+            return None, None
+        if skip := id3v2_size(data):
+            data = data[skip:] if skip < len(data) else b''
+            if len(data) < PROBE_SIZE // 2:
+                data, _ = fetch_range(url, skip, PROBE_SIZE)
+        duration = mp3_duration(data, size - skip)
+    except OSError as exc:
+        logger.debug('Could not probe %s\n%s', url, exc)
+        return None, None
+    logger.debug('%s is estimated to be %s seconds long', url, duration)
+    return size, duration
+
+
+def fetch_mp3_excerpt(
+    url: str, size: int, duration: float, max_duration: float
+) -> Optional[tuple[memoryview, float]]:
+    """Returns whole frames from random part of MP3 file shorter than
+    provided duration in seconds, and their duration.
+
+    Size in bytes and duration of the file are used to estimate the
+    part position.
+    """
+    # bytes at the average bitrate plus a second to find the first frame
+    length = min(size, math.ceil(size / duration * (max_duration + 1)))
+    start = random.randrange(size - length + 1)
+    try:
+        data, _ = fetch_range(url, start, length)
+    except OSError as exc:
+        logger.debug('Could not fetch excerpt of %s\n%s', url, exc)
+        return None
+    if (frames := mp3_frames(data, max_duration)) is None:
+        return None
+    begin, end, excerpt_duration = frames
+    logger.debug(
+        '%.1f seconds excerpt of %s fetched from %d byte',
+        excerpt_duration,
+        url,
+        start + begin,
+    )
+    return memoryview(data)[begin:end], excerpt_duration
+
+
+def resume_headers(headers: Message, start: int) -> dict[str, str]:
+    """Returns request headers to get the rest of the resource starting
+    from provided byte, unless the resource has changed.
+    """
+    resume = {'Range': f'bytes={start}-'}
+    if validator := headers.get('ETag') or headers.get('Last-Modified'):
+        resume['If-Range'] = validator
+    return resume
+
+
+def is_transient(exc: Exception) -> bool:
+    """Tells whether the request may succeed if it is repeated."""
+    # broken pipe comes from a file which is a pipe to a failed process
+    if isinstance(exc, (DownloadError, BrokenPipeError)):
+        return False
+    if isinstance(exc, urllib.error.HTTPError):
+        return exc.code >= 500 or exc.code == 429
+    return isinstance(exc, (OSError, http.client.HTTPException))
+
+
+def download(
+    url: str,
+    file: BinaryIO,
+    *,
+    headers: Optional[dict[str, str]] = None,
+    abort: Optional[threading.Event] = None,
+) -> Optional[Message]:
+    """Writes resource content to the file.
+
+    Interrupted transfer is resumed from the last written byte after
+    a random delay growing with each attempt. `DownloadError` is raised
+    when attempts are exhausted, and `DownloadAborted` as soon as the
+    `abort` event is set.
+
+    Returns response headers, or None if the server responded that the
+    resource is not modified according to conditional request headers.
+    """
+    written = 0
+    first_headers: Optional[Message] = None
+    attempts = 0
+    while True:
+        try:
+            with client.request(
+                url,
+                headers=(
+                    headers
+                    if first_headers is None
+                    else resume_headers(first_headers, written)
+                ),
+            ) as response:
+                if response.status == 304:
+                    return None
+                if first_headers is None:
+                    first_headers = response.headers
+                elif response.status != 206:
+                    skip_written(url, response, first_headers, written)
+                while chunk := response.read(DOWNLOAD_BUFFER_SIZE):
+                    if abort is not None and abort.is_set():
+                        raise DownloadAborted(f'Download of {url} aborted')
+                    file.write(chunk)
+                    written += len(chunk)
+            size = int(first_headers.get('Content-Length', written))
+            if written < size:
+                raise http.client.IncompleteRead(b'', size - written)
+            return first_headers
+        except DownloadAborted:
+            raise
+        except (OSError, http.client.HTTPException) as exc:
+            attempts += 1
+            if not is_transient(exc) or attempts == DOWNLOAD_ATTEMPTS:
+                raise DownloadError(f'Could not download {url}') from exc
+            delay = random.uniform(0, DOWNLOAD_BACKOFF * 2 ** (attempts - 1))
+            logger.debug(
+                'Resuming %s from %d bytes in %.1f s\n%s', url, written, delay, exc
+            )
+            time.sleep(delay)
+
+
+def skip_written(
+    url: str, response: http.client.HTTPResponse, headers: Message, written: int
+):
+    """Reads already written part of the full response body.
+
+    Raises `DownloadError` if the resource has changed since the first
+    response with provided headers.
+    """
+    for validator in ('ETag', 'Last-Modified'):
+        if response.headers.get(validator) != headers.get(validator):
+            raise DownloadError(f'{url} has changed while downloading')
+    while written > 0 and (chunk := response.read(min(written, DOWNLOAD_BUFFER_SIZE))):
+        written -= len(chunk)
@@ -0,0 +1,112 @@
+import logging
+from pathlib import Path
+import time
+from typing import TYPE_CHECKING, Callable, Optional
+
+from radioscripts.cache import Database
+
+if TYPE_CHECKING:
+    from radioscripts.worker import Catalog
+
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogIndex(Database):
+    """Catalog wrapper keeping sections and sounds in a local database.
+
+    Pages are scraped again when their copy is older than `max_age`
+    seconds. Stale copy is used if the page could not be fetched.
+    Index also keeps known sizes and durations of sounds.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS pages (
+            url TEXT PRIMARY KEY,
+            fetched REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS links (
+            page TEXT NOT NULL REFERENCES pages (url) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            PRIMARY KEY (page, position)
+        );
+        CREATE TABLE IF NOT EXISTS sounds (
+            url TEXT PRIMARY KEY,
+            size INTEGER,
+            duration REAL
+        );
+    '''
+
+    def __init__(self, catalog: 'Catalog', path: Path, *, max_age: float):
+        super().__init__(path)
+        self.catalog = catalog
+        self.max_age = max_age
+
+    def sections(self) -> list[str]:
+        """Returns list of section pages URLs which contain sounds."""
+        # catalog description is as unique as its start page
+        return self.links(str(self.catalog), self.catalog.sections)
+
+    def sounds(self, url: str) -> list[str]:
+        """Returns list of sound URLs from provided page."""
+        return self.links(url, lambda: self.catalog.sounds(url))
+
+    def links(self, page: str, scrape: Callable[[], list[str]]) -> list[str]:
+        """Returns links found on the page, scraping it if the indexed
+        copy is missing or outdated.
+        """
+        with self.transaction() as db:
+            row = db.execute(
+                'SELECT fetched FROM pages WHERE url = ?', (page,)
+            ).fetchone()
+            urls = [
+                url
+                for (url,) in db.execute(
+                    'SELECT url FROM links WHERE page = ? ORDER BY position', (page,)
+                )
+            ]
+        if row is not None and time.time() - row[0] < self.max_age:
+            return urls
+
+        try:
+            urls = scrape()
+        except OSError as exc:
+            if row is None:
+                raise
+            logger.debug('Using outdated copy of %s page\n%s', page, exc)
+            return urls
+
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?)', (page, time.time())
+            )
+            db.executemany(
+                'INSERT INTO links VALUES (?, ?, ?)',
+                [(page, position, url) for position, url in enumerate(urls)],
+            )
+        logger.debug('%d links of %s page indexed', len(urls), page)
+        return urls
+
+    def sound(self, url: str) -> tuple[Optional[int], Optional[float]]:
+        """Returns known size in bytes and duration in seconds of the sound."""
+        with self.transaction() as db:
+            row = db.execute(
+                'SELECT size, duration FROM sounds WHERE url = ?', (url,)
+            ).fetchone()
+        return row or (None, None)
+
+    def remember(
+        self, url: str, *, size: Optional[int] = None, duration: Optional[float] = None
+    ):
+        """Saves known size in bytes and duration in seconds of the sound."""
+        with self.transaction() as db:
+            db.execute(
+                'INSERT INTO sounds VALUES (?, ?, ?) ON CONFLICT (url) DO UPDATE SET '
+                'size = COALESCE(excluded.size, size), '
+                'duration = COALESCE(excluded.duration, duration)',
+                (url, size, duration),
+            )
+
+    def __str__(self):
+        return str(self.catalog)
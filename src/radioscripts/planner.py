@@ -0,0 +1,85 @@
+import math
+import random
+from typing import NamedTuple, Optional, Sequence
+
+
+# bytes per second of 128 kbit/s MP3
+DEFAULT_BYTE_RATE = 16000
+
+
+class Candidate(NamedTuple):
+    """Sample which may be included in a radio station."""
+
+    url: str
+    section: int
+    size: int  # bytes to download
+    duration: float
+
+
+def byte_rate(descriptions: Sequence[tuple[Optional[int], Optional[float]]]) -> float:
+    """Returns average bytes per second of samples described by size
+    and duration, to estimate sizes which aren't known.
+    """
+    known = [
+        (size, duration)
+        for size, duration in descriptions
+        if size and duration  # cached samples cost nothing to download
+    ]
+    if not known:
+        return DEFAULT_BYTE_RATE
+    return sum(size for size, _ in known) / sum(duration for _, duration in known)
+
+
+def pack(candidates: Sequence[Candidate], capacity: float) -> list[Candidate]:
+    """Returns candidates which fill the capacity in seconds as much
+    as possible, downloading the least bytes among equal fillings.
+
+    Solves 0/1 knapsack problem over whole seconds. Durations are
+    rounded up, so chosen candidates never exceed the capacity.
+    """
+    slots = int(capacity)
+    weights = [math.ceil(candidate.duration) for candidate in candidates]
+    # least bytes needed to fill exactly N seconds
+    costs = [0.0] + [math.inf] * slots
+    taken = [bytearray(slots + 1) for _ in candidates]
+    for index, (candidate, weight) in enumerate(zip(candidates, weights)):
+        for filled in range(slots, weight - 1, -1):
+            cost = costs[filled - weight] + candidate.size
+            if cost < costs[filled]:
+                costs[filled] = cost
+                taken[index][filled] = 1
+
+    filled = max(slot for slot, cost in enumerate(costs) if cost < math.inf)
+    chosen = []
+    for index in reversed(range(len(candidates))):
+        if taken[index][filled]:
+            chosen.append(candidates[index])
+            filled -= weights[index]
+    return chosen[::-1]
+
+
+def plan(
+    candidates: Sequence[Candidate], capacity: float, *, sections: int
+) -> list[Candidate]:
+    """Returns candidates to fill the capacity in seconds taking
+    at least one candidate from each section if possible.
+
+    Candidates are expected to be randomly ordered.
+    """
+    chosen = []
+    remaining = capacity
+    # seeds take no more than a fair share to leave room for packing
+    share = capacity / max(sections, 1)
+    for section in range(sections):
+        fitting = (
+            candidate
+            for candidate in candidates
+            if candidate.section == section and candidate.duration < share
+        )
+        if (seed := next(fitting, None)) is not None:
+            chosen.append(seed)
+            remaining -= seed.duration
+
+    rest = [candidate for candidate in candidates if candidate not in chosen]
+    chosen.extend(pack(rest, remaining))
+    return random.sample(chosen, len(chosen))
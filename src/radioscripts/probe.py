@@ -0,0 +1,229 @@
+import logging
+import math
+from pathlib import Path
+import struct
+from typing import NamedTuple, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+PROBE_SIZE: int = 64 * 1024
+
+ID3V2_HEADER_SIZE: int = 10
+
+# kbit/s by (MPEG version 1, layer) and (MPEG version 2 or 2.5, layer)
+MP3_BITRATES: dict[tuple[bool, int], tuple[int, ...]] = {
+    (True, 1): (32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+# Hz by MPEG version: 1, 2 and 2.5
+MP3_SAMPLE_RATES: dict[float, tuple[int, int, int]] = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+
+
+class FrameHeader(NamedTuple):
+    """MPEG audio frame header fields."""
+
+    version: float
+    layer: int
+    bitrate: int  # bit/s
+    sample_rate: int
+    padding: bool
+    mono: bool
+
+    @property
+    def samples(self) -> int:
+        """Number of samples per channel in the frame."""
+        if self.layer == 1:
+            return 384
+        if self.layer == 3 and self.version != 1:
+            return 576
+        return 1152
+
+    @property
+    def length(self) -> int:
+        """Frame size in bytes including header."""
+        slot = 4 if self.layer == 1 else 1
+        slots = self.samples // 8 * self.bitrate // self.sample_rate // slot
+        return (slots + self.padding) * slot
+
+    @property
+    def side_info_size(self) -> int:
+        """Layer III side information size in bytes."""
+        if self.version == 1:
+            return 17 if self.mono else 32
+        return 9 if self.mono else 17
+
+
+def parse_frame_header(data: bytes, offset: int = 0) -> Optional[FrameHeader]:
+    """Returns MPEG audio frame header found at provided offset if it is valid."""
+    if len(data) < offset + 4:
+        return None
+    (word,) = struct.unpack_from('>I', data, offset)
+    if word >> 21 != 0x7FF:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get(word >> 19 & 0b11)
+    layer = 4 - (word >> 17 & 0b11)
+    bitrate_index = word >> 12 & 0b1111
+    sample_rate_index = word >> 10 & 0b11
+    # free format bitrate is not supported
+    if version is None or layer == 4 or bitrate_index in (0, 15):
+        return None
+    if sample_rate_index == 3:
+        return None
+    return FrameHeader(
+        version=version,
+        layer=layer,
+        bitrate=MP3_BITRATES[version == 1, layer][bitrate_index - 1] * 1000,
+        sample_rate=MP3_SAMPLE_RATES[version][sample_rate_index],
+        padding=bool(word >> 9 & 1),
+        mono=word >> 6 & 0b11 == 3,
+    )
+
+
+def find_frame(data: bytes, start: int = 0) -> Optional[tuple[int, FrameHeader]]:
+    """Returns offset and header of the first MPEG audio frame in the data.
+
+    A frame is trusted only if the next frame follows it, unless the
+    data ends before.
+    """
+    offset = data.find(b'\xff', start)
+    while offset != -1:
+        header = parse_frame_header(data, offset)
+        if header is not None:
+            following = parse_frame_header(data, offset + header.length)
+            if len(data) < offset + header.length + 4 or (
+                following is not None
+                and following[:2] == header[:2]
+                and following.sample_rate == header.sample_rate
+            ):
+                return offset, header
+        offset = data.find(b'\xff', offset + 1)
+    return None
+
+
+def id3v2_size(data: bytes) -> int:
+    """Returns size of ID3v2 tag in the beginning of the data or zero."""
+    if len(data) < ID3V2_HEADER_SIZE or not data.startswith(b'ID3'):
+        return 0
+    flags = data[5]
+    # tag size is a 28 bit integer stored in 7 lower bits of 4 bytes
+    size = 0
+    for byte in data[6:10]:
+        size = size << 7 | byte & 0x7F
+    footer = ID3V2_HEADER_SIZE if flags & 0x10 else 0
+    return ID3V2_HEADER_SIZE + size + footer
+
+
+def vbr_frames(data: bytes, offset: int, header: FrameHeader) -> Optional[int]:
+    """Returns number of frames from Xing, Info or VBRI tag of the frame."""
+    xing = offset + 4 + header.side_info_size
+    if data[xing : xing + 4] in (b'Xing', b'Info') and len(data) >= xing + 12:
+        (flags,) = struct.unpack_from('>I', data, xing + 4)
+        if flags & 1:
+            return struct.unpack_from('>I', data, xing + 8)[0]
+    vbri = offset + 4 + 32
+    if data[vbri : vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+        return struct.unpack_from('>I', data, vbri + 14)[0]
+    return None
+
+
+def mp3_duration(data: bytes, size: int) -> Optional[float]:
+    """Returns duration in seconds of MPEG audio stream by its beginning
+    and total size in bytes.
+
+    Data should start right after ID3v2 tag. Duration of streams
+    without Xing, Info or VBRI tag is estimated from the first frame
+    bitrate.
+    """
+    found = find_frame(data)
+    if found is None:
+        return None
+    offset, header = found
+    frames = vbr_frames(data, offset, header)
+    if frames is not None:
+        return frames * header.samples / header.sample_rate
+    return (size - offset) * 8 / header.bitrate
+
+
+def mp3_frames(
+    data: bytes, max_duration: float = math.inf
+) -> Optional[tuple[int, int, float]]:
+    """Returns start and end offsets and duration in seconds of whole
+    MPEG audio frames in the data cut out of a stream.
+
+    Frames are taken until their duration would reach `max_duration`.
+    """
+    found = find_frame(data)
+    if found is None:
+        return None
+    start, header = found
+    end, duration = start, 0.0
+    while header is not None and end + header.length <= len(data):
+        frame_duration = header.samples / header.sample_rate
+        if duration + frame_duration >= max_duration:
+            break
+        end += header.length
+        duration += frame_duration
+        header = parse_frame_header(data, end)
+    return (start, end, duration) if duration else None
+
+
+def wav_data_chunk(data: bytes) -> Optional[tuple[int, int, int]]:
+    """Returns byte rate, offset and size of audio data of RIFF WAVE
+    file by its beginning.
+    """
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+    byte_rate = None
+    offset = 12
+    while len(data) >= offset + 8:
+        chunk_id, chunk_size = struct.unpack_from('<4sI', data, offset)
+        offset += 8
+        if chunk_id == b'fmt ' and len(data) >= offset + 12:
+            (byte_rate,) = struct.unpack_from('<I', data, offset + 8)
+        elif chunk_id == b'data':
+            return (byte_rate, offset, chunk_size) if byte_rate else None
+        offset += chunk_size + chunk_size % 2
+    return None
+
+
+def wav_duration(data: bytes, size: int) -> Optional[float]:
+    """Returns duration in seconds of RIFF WAVE file by its beginning
+    and total size in bytes.
+    """
+    if (chunk := wav_data_chunk(data)) is None:
+        return None
+    byte_rate, offset, chunk_size = chunk
+    # streamed files may have unknown data size in the header
+    available = size - offset
+    if chunk_size in (0, 0xFFFFFFFF) or chunk_size > available:
+        chunk_size = available
+    return chunk_size / byte_rate
+
+
+def probe_duration(path: Path) -> Optional[float]:
+    """Returns duration in seconds of MP3 or WAV file reading only
+    its headers, or None if the format is not recognized.
+    """
+    size = path.stat().st_size
+    with path.open('rb') as file:
+        data = file.read(PROBE_SIZE)
+        if duration := wav_duration(data, size):
+            return duration
+        if skip := id3v2_size(data):
+            file.seek(skip)
+            data = file.read(PROBE_SIZE)
+        duration = mp3_duration(data, size - skip)
+    if duration is None:
+        logger.debug('Could not probe %s', path.name)
+    return duration
@@ -0,0 +1,750 @@
+from array import array
+from concurrent.futures import Executor, ThreadPoolExecutor, wait
+import contextlib
+import itertools
+import logging
+import math
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
+from typing import BinaryIO, Callable, Iterable, Iterator, Mapping, Optional
+import wave
+
+from radioscripts import render
+from radioscripts.audio import (
+    PCM_CHUNK_SIZE,
+    PCM_TYPECODES,
+    RADIOMUSIC_BIT_DEPTH,
+    RADIOMUSIC_CHANNELS,
+    RADIOMUSIC_SAMPLE_RATE,
+    convert_all,
+    decode_all,
+    measure_durations,
+    normalizing_volume,
+    raw_format,
+    open_sox,
+    run_sox,
+    seek_pcm,
+)
+from radioscripts.cache import ConversionCache
+from radioscripts.probe import PROBE_SIZE, wav_data_chunk
+from radioscripts.wav import WavWriter, resize_data
+
+
+logger = logging.getLogger(__name__)
+
+
+# overlap in seconds of neighbouring samples of a radio program
+CROSSFADE_DURATION: float = 2
+
+# duration in seconds of radio program parts rendered concurrently by the
+# segments engine
+SEGMENT_DURATION: float = 300
+
+# fade out of a radio program cut to its duration, so that it doesn't click
+CUT_FADE_DURATION: float = 0.01
+
+
+class NoSamplesError(Exception):
+    def __str__(self) -> str:
+        return 'no samples to make radio program of'
+
+
+def join(
+    input_paths: list[Path],
+    output: BinaryIO,
+    *,
+    crossfade_duration: float,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    peaks: Optional[list[float]] = None,
+):
+    """Splices converted sounds together normalizing each of them,
+    and writes the program to the output as raw PCM.
+
+    Sounds are taken as peaking at full scale unless their peak
+    amplitudes are provided. The program is rendered in a single pass,
+    as its level is calculated from them, see `program_volumes`.
+    """
+    if not input_paths:
+        return
+
+    if peaks is None:
+        peaks = [1.0] * len(input_paths)
+    volumes = program_volumes(input_paths, peaks, crossfade_duration=crossfade_duration)
+    with open_sox(
+        *[
+            argument
+            for input_path, volume in zip(input_paths, volumes)
+            for argument in ('-v', f'{volume}', input_path)
+        ],
+        *raw_format(channels=channels, sample_rate=sample_rate, bit_depth=bit_depth),
+        '-',
+        *splice_effects(input_paths, crossfade_duration=crossfade_duration),
+        *mastering_effects(),
+        stdout=subprocess.PIPE,
+    ) as proc:
+        shutil.copyfileobj(proc.stdout, output, PCM_CHUNK_SIZE)
+
+
+def read_edge(
+    path: Path, *, duration: float, at_end: bool, volume: float = 1.0
+) -> tuple[array, int]:
+    """Returns samples of the beginning or the end of wav file relative
+    to full scale at provided volume, and the number of channels.
+    """
+    with wave.open(str(path), 'rb') as sound:
+        # pylint: disable=no-member
+        frames = min(int(duration * sound.getframerate()), sound.getnframes())
+        if at_end:
+            sound.setpos(sound.getnframes() - frames)
+        bit_depth = sound.getsampwidth() * 8
+        samples = array(PCM_TYPECODES[bit_depth], sound.readframes(frames))
+        channels = sound.getnchannels()
+    scale = volume / 2 ** (bit_depth - 1)
+    return array('d', (sample * scale for sample in samples)), channels
+
+
+def crossfade_peak(tail: array, head: array, *, channels: int) -> float:
+    """Returns peak amplitude of two pieces of audio mixed with equal
+    power fades like `crossfade` does, but without clipping.
+
+    The pieces overlap by the length of the shorter one.
+    """
+    length = min(len(tail), len(head)) // channels * channels
+    frames = length // channels
+    peak = 0.0
+    for index, (out_, in_) in enumerate(zip(tail[len(tail) - length :], head)):
+        angle = math.pi / 2 * ((index // channels) + 0.5) / frames
+        peak = max(peak, abs(out_ * math.cos(angle) + in_ * math.sin(angle)))
+    return peak
+
+
+def program_volumes(
+    input_paths: list[Path], peaks: list[float], *, crossfade_duration: float
+) -> list[float]:
+    """Returns volume factors of sounds with provided peak amplitudes,
+    so that the program spliced of them peaks at full scale.
+
+    Sounds are normalized by their peaks, and all of them are brought
+    down together if crossfades mix louder than full scale. Mixes are
+    calculated from the crossfaded parts, not rendering the program.
+    """
+    volumes = [normalizing_volume(peak) for peak in peaks]
+    level = 1.0
+    for index in range(1, len(input_paths)):
+        tail, channels = read_edge(
+            input_paths[index - 1],
+            duration=crossfade_duration,
+            at_end=True,
+            volume=volumes[index - 1],
+        )
+        head, _ = read_edge(
+            input_paths[index],
+            duration=crossfade_duration,
+            at_end=False,
+            volume=volumes[index],
+        )
+        # equal power fades mix to no more than this, the mix is rarely louder
+        bound = math.hypot(max(tail, key=abs, default=0), max(head, key=abs, default=0))
+        if bound > level:
+            level = max(level, crossfade_peak(tail, head, channels=channels))
+    logger.debug('Crossfades peak at %.2f dB', 20 * math.log10(level))
+    return [volume / level for volume in volumes]
+
+
+def known_peaks(
+    input_paths: list[Path], peaks: Optional[Mapping[Path, float]]
+) -> list[float]:
+    """Returns peak amplitudes of sounds by their paths. Sounds of
+    unknown peaks are taken as peaking at full scale, so that they keep
+    their level.
+    """
+    return [(peaks or {}).get(input_path, 1.0) for input_path in input_paths]
+
+
+def splice_effects(input_paths: list[Path], *, crossfade_duration: float) -> list[str]:
+    """Returns sox effect splicing sounds one after another."""
+    excess = crossfade_duration / 2
+    splices = measure_durations(*input_paths)[:-1]
+    for index in range(1, len(splices)):
+        splices[index] = splices[index - 1] + splices[index] - excess * index
+    if not splices:
+        return []
+    return ['splice', '-q', *[f'{position},{excess}' for position in splices]]
+
+
+def limiter_effects() -> list[str]:
+    """Returns sox effects chain which limits loud parts."""
+    # fmt: off
+    return [
+        'compand', '0,0.02', '1:-6,0,-3', '0', '-90', '0.01',  # little bit of limiting
+    ]
+    # fmt: on
+
+
+def mastering_effects() -> list[str]:
+    """Returns sox effects chain applied to the whole radio program.
+
+    Samples of the program are expected to peak at full scale, so the
+    limited program is brought back to full scale by a known gain. sox
+    `gain -n` would keep the whole program in a temporary file instead.
+    """
+    # fmt: off
+    return [
+        *limiter_effects(),
+        'gain', f'{-render.limiter_level(0)}',
+        'dither', '-s',
+    ]
+    # fmt: on
+
+
+@contextlib.contextmanager
+def open_mastering(
+    output: BinaryIO,
+    *,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    input_bit_depth: Optional[int] = None,
+) -> Iterator[BinaryIO]:
+    """Provides a stream to write raw PCM program to, which a sox
+    process masters into the output as raw PCM while it is written.
+
+    The program may have more bits per sample than the output.
+    """
+    output_format = {
+        'channels': channels,
+        'sample_rate': sample_rate,
+        'bit_depth': bit_depth,
+    }
+    input_format = {**output_format, 'bit_depth': input_bit_depth or bit_depth}
+
+    def drain(proc: subprocess.Popen):
+        try:
+            shutil.copyfileobj(proc.stdout, output, PCM_CHUNK_SIZE)
+        except BaseException:
+            proc.kill()  # so that the program isn't written to a full pipe
+            raise
+
+    # fmt: off
+    with open_sox(
+        *raw_format(**input_format), '-',
+        *raw_format(**output_format), '-',
+        *mastering_effects(),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    ) as proc:
+        with ThreadPoolExecutor(1, thread_name_prefix='Mastering') as drainer:
+            drained = drainer.submit(drain, proc)
+            try:
+                yield proc.stdin
+            finally:
+                with contextlib.suppress(BrokenPipeError):
+                    proc.stdin.close()
+                drained.result()  # the reason of the broken pipe if the output failed
+    # fmt: on
+
+
+def crossfade(tail: bytes, head: bytes, *, channels: int, bit_depth: int) -> bytes:
+    """Mixes two equally long pieces of raw PCM with equal power fades,
+    fading `tail` out and `head` in.
+    """
+    typecode = PCM_TYPECODES[bit_depth]
+    fading_out, fading_in = array(typecode, tail), array(typecode, head)
+    frames = len(fading_out) // channels
+    limit = 2 ** (bit_depth - 1)
+    mixed = array(typecode, bytes(len(tail)))
+    for index, (out_, in_) in enumerate(zip(fading_out, fading_in)):
+        angle = math.pi / 2 * ((index // channels) + 0.5) / frames
+        value = round(out_ * math.cos(angle) + in_ * math.sin(angle))
+        mixed[index] = min(max(value, -limit), limit - 1)
+    return mixed.tobytes()
+
+
+def splice_streams(
+    streams: Iterable[BinaryIO],
+    output: BinaryIO,
+    *,
+    crossfade_duration: float,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+):
+    """Writes raw PCM streams one after another to the output
+    overlapping them by crossfade duration.
+
+    Only the overlapping parts are kept in memory.
+    """
+    frame_size = channels * bit_depth // 8
+    overlap = int(crossfade_duration * sample_rate) * frame_size
+    chunk_size = max(PCM_CHUNK_SIZE // frame_size, 1) * frame_size
+
+    pending = b''  # the end of the previous stream to be mixed with the next one
+    for stream in streams:
+        buffer = stream.read(overlap)
+        if pending and buffer:
+            length = min(len(pending), len(buffer))
+            output.write(pending[: len(pending) - length])
+            buffer = (
+                crossfade(
+                    pending[len(pending) - length :],
+                    buffer[:length],
+                    channels=channels,
+                    bit_depth=bit_depth,
+                )
+                + buffer[length:]
+            )
+        elif pending:
+            buffer = pending
+        while chunk := stream.read(chunk_size):
+            buffer += chunk
+            if len(buffer) > overlap:
+                output.write(buffer[: len(buffer) - overlap])
+                buffer = buffer[len(buffer) - overlap :]
+        pending = buffer
+    output.write(pending)
+
+
+def pipe_radio_program(  # pylint: disable=unused-argument
+    input_paths: Iterable[Path],
+    output: BinaryIO,
+    *,
+    crossfade_duration: float,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    cache: Optional[ConversionCache],
+    converted: bool,
+    peaks: Optional[Mapping[Path, float]],
+    executor: Optional[Executor],
+    workdir: Optional[Path],
+):
+    """Concatenates sounds together into raw PCM output without
+    intermediate files.
+
+    Every sample is decoded by its own sox process, spliced in memory
+    and streamed through a single mastering sox process over pipes.
+    Converted samples are spliced by a single sox process instead, see
+    `join`, as there is nothing to decode.
+    """
+    pcm_format = {
+        'channels': channels,
+        'sample_rate': sample_rate,
+        'bit_depth': bit_depth,
+    }
+    if converted:
+        input_paths = list(input_paths)
+        join(
+            input_paths,
+            output,
+            crossfade_duration=crossfade_duration,
+            **pcm_format,
+            peaks=known_peaks(input_paths, peaks),
+        )
+        return
+
+    with open_mastering(output, **pcm_format) as stream:
+        splice_streams(
+            decode_all(input_paths, **pcm_format, cache=cache),
+            stream,
+            crossfade_duration=crossfade_duration,
+            **pcm_format,
+        )
+
+
+def numpy_radio_program(  # pylint: disable=unused-argument
+    input_paths: Iterable[Path],
+    output: BinaryIO,
+    *,
+    crossfade_duration: float,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    cache: Optional[ConversionCache],
+    converted: bool,
+    peaks: Optional[Mapping[Path, float]],
+    executor: Optional[Executor],
+    workdir: Optional[Path],
+):
+    """Concatenates sounds together into raw PCM output rendering it
+    with numpy.
+
+    Samples are still converted by sox, but splicing and mastering
+    happen in process. Converted samples are read without sox and
+    normalized by numpy.
+    """
+    pcm_format = {
+        'channels': channels,
+        'sample_rate': sample_rate,
+        'bit_depth': bit_depth,
+    }
+    volumes = None
+    if converted:
+        input_paths = list(input_paths)
+        volumes = [normalizing_volume(peak) for peak in known_peaks(input_paths, peaks)]
+
+    render.render(
+        decode_all(input_paths, **pcm_format, cache=cache, converted=converted),
+        output,
+        crossfade_duration=crossfade_duration,
+        **pcm_format,
+        volumes=volumes,
+    )
+
+
+def stage_radio_program(
+    input_paths: Iterable[Path],
+    output: BinaryIO,
+    *,
+    crossfade_duration: float,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    cache: Optional[ConversionCache],
+    converted: bool,
+    peaks: Optional[Mapping[Path, float]],
+    executor: Optional[Executor],
+    workdir: Optional[Path],
+):
+    """Concatenates sounds together into raw PCM output
+    converting every sample into temporary file first.
+
+    Samples are converted by the executor, or one by one if it is not
+    provided.
+    """
+    with contextlib.ExitStack() as stack:
+        if converted:
+            input_paths = list(input_paths)
+            sample_peaks = known_peaks(input_paths, peaks)
+        else:
+            tmpdir = stack.enter_context(tempfile.TemporaryDirectory(dir=workdir))
+            if executor is None:
+                executor = stack.enter_context(
+                    ThreadPoolExecutor(1, thread_name_prefix='Staging')
+                )
+            input_paths, sample_peaks = convert_all(
+                input_paths,
+                Path(tmpdir),
+                executor=executor,
+                channels=channels,
+                sample_rate=sample_rate,
+                bit_depth=bit_depth,
+                cache=cache,
+            )
+        join(
+            input_paths,
+            output,
+            crossfade_duration=crossfade_duration,
+            channels=channels,
+            sample_rate=sample_rate,
+            bit_depth=bit_depth,
+            peaks=sample_peaks,
+        )
+
+
+def split_evenly(input_paths: list[Path], duration: float) -> list[list[Path]]:
+    """Splits sounds into consecutive groups of about provided duration
+    in seconds.
+    """
+    durations = measure_durations(*input_paths)
+    parts = max(math.ceil(sum(durations) / duration), 1)
+    groups: list[list[Path]] = [[]]
+    elapsed = 0.0
+    for input_path, sound_duration in zip(input_paths, durations):
+        if groups[-1] and elapsed >= sum(durations) * len(groups) / parts:
+            groups.append([])
+        groups[-1].append(input_path)
+        elapsed += sound_duration
+    return groups
+
+
+def splice_segment(
+    input_paths: list[Path],
+    volumes: list[float],
+    output_path: Path,
+    *,
+    crossfade_duration: float,
+):
+    """Splices converted sounds together at provided volumes into
+    a wav file of 32 bit samples, so that nothing is lost before the
+    program is mastered.
+    """
+    # fmt: off
+    run_sox(
+        *[
+            argument
+            for input_path, volume in zip(input_paths, volumes)
+            for argument in ('-v', f'{volume}', input_path)
+        ],
+        '-b', '32',
+        output_path,
+        *splice_effects(input_paths, crossfade_duration=crossfade_duration),
+    )
+    # fmt: on
+
+
+def render_segments(
+    groups: list[list[Path]],
+    volumes: list[float],
+    output_dir: Path,
+    *,
+    executor: Executor,
+    crossfade_duration: float,
+) -> list[Path]:
+    """Splices every group of sounds at their volumes to a wav file
+    concurrently.
+
+    Returns spliced files paths in the order of groups.
+    """
+    segment_paths = [
+        output_dir / f'segment_{index}.wav' for index in range(len(groups))
+    ]
+    bounds = itertools.accumulate(len(group) for group in groups)
+    futures = [
+        executor.submit(
+            splice_segment,
+            group,
+            volumes[end - len(group) : end],
+            segment_path,
+            crossfade_duration=crossfade_duration,
+        )
+        for group, end, segment_path in zip(groups, bounds, segment_paths)
+    ]
+    wait(futures)  # none of them should be left writing to the directory
+    for future in futures:
+        future.result()
+    return segment_paths
+
+
+def stitch_segments(
+    segment_paths: list[Path],
+    output: BinaryIO,
+    *,
+    crossfade_duration: float,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+):
+    """Crossfades spliced segments at the seams and streams them through
+    a single mastering sox process into raw PCM output.
+    """
+    segment_format = {'channels': channels, 'sample_rate': sample_rate, 'bit_depth': 32}
+    with open_mastering(
+        output,
+        channels=channels,
+        sample_rate=sample_rate,
+        bit_depth=bit_depth,
+        input_bit_depth=32,
+    ) as stream:
+        with contextlib.ExitStack() as stack:
+            splice_streams(
+                open_segments(segment_paths, stack),
+                stream,
+                crossfade_duration=crossfade_duration,
+                **segment_format,
+            )
+
+
+def open_segments(
+    segment_paths: list[Path], stack: contextlib.ExitStack
+) -> Iterator[BinaryIO]:
+    """Opens spliced segments one by one as raw PCM streams, which are
+    closed with the stack.
+
+    Raises `ValueError` if a segment is not a wav file.
+    """
+    for path in segment_paths:
+        if (stream := seek_pcm(stack.enter_context(path.open('rb')))) is None:
+            raise ValueError(f'{path} is not a wav file')
+        yield stream
+
+
+def segment_radio_program(
+    input_paths: Iterable[Path],
+    output: BinaryIO,
+    *,
+    crossfade_duration: float,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    cache: Optional[ConversionCache],
+    converted: bool,
+    peaks: Optional[Mapping[Path, float]],
+    executor: Optional[Executor],
+    workdir: Optional[Path],
+):
+    """Concatenates sounds together into raw PCM output splicing parts
+    of the program in parallel sox processes.
+
+    The program is split between samples into parts of about
+    `SEGMENT_DURATION`. Parts are spliced by the executor, or by a pool
+    of their own if it is not provided, so that the number of sox
+    processes doesn't grow with the number of programs. Seams are
+    crossfaded with the same equal power fades as sox splices the rest,
+    then the whole program is limited and dithered at once like `join`
+    does it.
+    """
+    with contextlib.ExitStack() as stack:
+        tmpdir = Path(stack.enter_context(tempfile.TemporaryDirectory(dir=workdir)))
+        if executor is None:
+            executor = stack.enter_context(
+                ThreadPoolExecutor(os.cpu_count(), thread_name_prefix='Segment')
+            )
+        if converted:
+            input_paths = list(input_paths)
+            sample_peaks = known_peaks(input_paths, peaks)
+        else:
+            input_paths, sample_peaks = convert_all(
+                input_paths,
+                tmpdir,
+                executor=executor,
+                channels=channels,
+                sample_rate=sample_rate,
+                bit_depth=bit_depth,
+                cache=cache,
+            )
+        if not input_paths:
+            return
+        groups = split_evenly(input_paths, SEGMENT_DURATION)
+        stitch_segments(
+            render_segments(
+                groups,
+                program_volumes(
+                    input_paths, sample_peaks, crossfade_duration=crossfade_duration
+                ),
+                tmpdir,
+                executor=executor,
+                crossfade_duration=crossfade_duration,
+            ),
+            output,
+            crossfade_duration=crossfade_duration,
+            channels=channels,
+            sample_rate=sample_rate,
+            bit_depth=bit_depth,
+        )
+
+
+RadioProgramEngine = Callable[..., None]
+
+engines: dict[str, RadioProgramEngine] = {
+    'staging': stage_radio_program,
+    'pipe': pipe_radio_program,
+    'numpy': numpy_radio_program,
+    'segments': segment_radio_program,
+}
+
+
+def make_radio_program(  # pylint: disable=too-many-locals
+    input_paths: Iterable[Path],
+    output_path: Path,
+    *,
+    engine: str = 'staging',
+    crossfade_duration: float = CROSSFADE_DURATION,
+    channels: int = RADIOMUSIC_CHANNELS,
+    sample_rate: int = RADIOMUSIC_SAMPLE_RATE,
+    bit_depth: int = RADIOMUSIC_BIT_DEPTH,
+    cache: Optional[ConversionCache] = None,
+    converted: bool = False,
+    peaks: Optional[Mapping[Path, float]] = None,
+    executor: Optional[Executor] = None,
+    duration: Optional[float] = None,
+    alignment: Optional[int] = None,
+    workdir: Optional[Path] = None,
+):
+    """Concatenates sounds together into a wav file,
+    creating a kind of radio station.
+
+    Raises `NoSamplesError` if there are no samples at all.
+
+    Samples conversion results are reused if cache is provided.
+    Samples are expected to be wav files converted already by
+    `convert_stream` if `converted` is set, and they are normalized by
+    peak amplitudes it reports by their paths. Engines converting samples
+    to staging files, or rendering parts of the program, do it
+    concurrently with the executor if it is provided, and keep the files
+    in the work directory if it is provided. Streaming engines
+    decode samples one by one as they splice them.
+
+    The program is padded with silence or cut to exact duration in
+    seconds if it is provided, see `fit_length`. Engines write it
+    as raw PCM into the wav file, which is overwritten in place if it
+    exists and has its audio data aligned, see `WavWriter`.
+    """
+    pcm_format = {
+        'channels': channels,
+        'sample_rate': sample_rate,
+        'bit_depth': bit_depth,
+    }
+    input_paths = require_samples(input_paths)
+    with WavWriter(output_path, **pcm_format, alignment=alignment) as output:
+        engines[engine](
+            input_paths,
+            output,
+            crossfade_duration=crossfade_duration,
+            **pcm_format,
+            cache=cache,
+            converted=converted,
+            peaks=peaks,
+            executor=executor,
+            workdir=workdir,
+        )
+    if duration is not None:
+        fit_length(
+            output_path,
+            frames=round(duration * sample_rate),
+            channels=channels,
+            bit_depth=bit_depth,
+            fade_frames=round(CUT_FADE_DURATION * sample_rate),
+        )
+
+
+def require_samples(input_paths: Iterable[Path]) -> Iterator[Path]:
+    """Returns the samples as an iterator, raises `NoSamplesError` right
+    away if there are none.
+    """
+    input_paths = iter(input_paths)
+    if (first_path := next(input_paths, None)) is None:
+        raise NoSamplesError()
+    return itertools.chain((first_path,), input_paths)
+
+
+def fit_length(
+    path: Path, *, frames: int, channels: int, bit_depth: int, fade_frames: int
+):
+    """Pads wav file audio data with silence or cuts it to provided
+    number of frames in place.
+
+    Cut audio fades out over the last `fade_frames` frames. Raises
+    `ValueError` if the file is not a wav file.
+    """
+    frame_size = channels * bit_depth // 8
+    with path.open('r+b') as file:
+        chunk = wav_data_chunk(file.read(PROBE_SIZE))
+        if chunk is None:
+            raise ValueError(f'{path} is not a wav file')
+        _, offset, size = chunk
+        size = min(size, file.seek(0, os.SEEK_END) - offset)
+        end = offset + frames * frame_size
+        if end < offset + size:
+            fade_size = min(fade_frames * frame_size, end - offset)
+            file.seek(end - fade_size)
+            faded = fade_out(
+                file.read(fade_size), channels=channels, bit_depth=bit_depth
+            )
+            file.seek(end - fade_size)
+            file.write(faded)
+        resize_data(file, offset, size, end - offset)  # extended with zeros if short
+    logger.debug('%s fitted to %d frames', path.name, frames)
+
+
+def fade_out(data: bytes, *, channels: int, bit_depth: int) -> bytes:
+    """Returns raw PCM fading out linearly to silence."""
+    samples = array(PCM_TYPECODES[bit_depth], data)
+    frames = len(samples) // channels
+    for index, sample in enumerate(samples):
+        samples[index] = int(sample * (frames - index // channels) / frames)
+    return samples.tobytes()
@@ -0,0 +1,302 @@
+from collections import deque
+import itertools
+import logging
+from typing import BinaryIO, Generator, Iterable, Iterator, Optional
+
+
+try:
+    import numpy as np
+except ImportError:  # numpy is an optional dependency
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+RENDER_CHUNK_FRAMES: int = 1024 * 1024
+
+LIMITER_LOOKAHEAD: float = 0.01
+LIMITER_THRESHOLD: float = -6.0
+LIMITER_RATIO: float = 2.0
+
+
+class NumpyNotFoundError(Exception):
+    def __str__(self) -> str:
+        return 'numpy package not found'
+
+
+def pcm_dtype(bit_depth: int) -> 'np.dtype':
+    """Returns numpy type of raw signed integer samples of provided size."""
+    if bit_depth not in (16, 32):
+        raise ValueError(f'{bit_depth} bit depth is not supported')
+    return np.dtype(f'=i{bit_depth // 8}')
+
+
+def read_segments(
+    streams: Iterable[BinaryIO],
+    *,
+    channels: int,
+    bit_depth: int,
+    volumes: Optional[Iterable[float]] = None,
+) -> Iterator[Iterator['np.ndarray']]:
+    """Reads raw PCM streams as arrays of frames, changing their
+    volume by provided factors, see `read_frames`.
+    """
+    for stream, volume in zip(streams, volumes or itertools.repeat(1.0)):
+        yield read_frames(stream, channels=channels, bit_depth=bit_depth, volume=volume)
+
+
+def read_frames(
+    stream: BinaryIO,
+    *,
+    channels: int,
+    bit_depth: int,
+    volume: float = 1.0,
+    frames: int = RENDER_CHUNK_FRAMES,
+) -> Iterator['np.ndarray']:
+    """Reads raw PCM stream into arrays of about provided number
+    of frames, changing their volume by provided factor.
+    """
+    dtype = pcm_dtype(bit_depth)
+    frame_size = dtype.itemsize * channels
+    limit = 2 ** (bit_depth - 1)
+    incomplete = b''  # part of a frame left from the previous read
+    while data := stream.read(frames * frame_size):
+        data = incomplete + data
+        size = len(data) - len(data) % frame_size
+        incomplete = data[size:]
+        if not size:
+            continue
+        chunk = np.frombuffer(data, dtype=dtype, count=size // dtype.itemsize)
+        if volume != 1:
+            chunk = np.clip(np.rint(chunk * volume), -limit, limit - 1)
+            chunk = chunk.astype(dtype)
+        yield chunk.reshape(-1, channels)
+
+
+def split_frames(
+    chunks: Iterable['np.ndarray'], frames: int
+) -> tuple[Optional['np.ndarray'], Iterator['np.ndarray']]:
+    """Returns up to provided number of first frames and the rest
+    of the chunks. The first frames are None if there are no frames.
+    """
+    chunks = iter(chunks)
+    head: list[np.ndarray] = []
+    taken = 0
+    for chunk in chunks:
+        if not chunk.size:
+            continue
+        head.append(chunk[: frames - taken])
+        taken += len(head[-1])
+        if taken == frames:
+            return np.concatenate(head), itertools.chain(
+                [chunk[len(head[-1]) :]], chunks
+            )
+    return (np.concatenate(head) if head else None), chunks
+
+
+def hold_back(
+    chunks: Iterable['np.ndarray'], frames: int
+) -> Generator['np.ndarray', None, 'np.ndarray']:
+    """Yields all but provided number of last frames, and returns them."""
+    buffer: deque[np.ndarray] = deque()
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        while len(buffer) > 1 and buffered - len(buffer[0]) >= frames:
+            buffered -= len(buffer[0])
+            yield buffer.popleft()
+    held = np.concatenate(buffer)
+    if len(held) > frames:
+        yield held[: len(held) - frames]
+    return held[max(len(held) - frames, 0) :]
+
+
+def splice(
+    segments: Iterable[Iterable['np.ndarray']], *, overlap: int, bit_depth: int
+) -> Iterator['np.ndarray']:
+    """Yields pieces of the program with segments overlapped by
+    equal power crossfades.
+
+    Segments are read as they are spliced, only the ends to crossfade
+    are held back.
+    """
+    limit = 2 ** (bit_depth - 1)
+    previous = None  # end of the program to crossfade with the next segment
+    for segment in segments:
+        head, rest = split_frames(segment, overlap)
+        if head is None:
+            continue
+        if previous is not None:
+            length = min(len(previous), len(head))
+            angle = np.pi / 2 * (np.arange(length) + 0.5) / max(length, 1)
+            mixed = (
+                previous[len(previous) - length :] * np.cos(angle)[:, np.newaxis]
+                + head[:length] * np.sin(angle)[:, np.newaxis]
+            )
+            mixed = np.clip(np.rint(mixed), -limit, limit - 1).astype(head.dtype)
+            yield previous[: len(previous) - length]
+            yield mixed
+            head = head[length:]
+        previous = yield from hold_back(itertools.chain([head], rest), overlap)
+    if previous is not None:
+        yield previous
+
+
+def rechunk(pieces: Iterable['np.ndarray'], frames: int) -> Iterator['np.ndarray']:
+    """Yields program as consecutive arrays of exactly provided number
+    of frames, except the last one.
+    """
+    buffer: list[np.ndarray] = []
+    buffered = 0
+    for piece in pieces:
+        while len(piece):
+            taken = piece[: frames - buffered]
+            buffer.append(taken)
+            buffered += len(taken)
+            piece = piece[len(taken) :]
+            if buffered == frames:
+                yield np.concatenate(buffer)
+                buffer, buffered = [], 0
+    if buffer:
+        yield np.concatenate(buffer)
+
+
+def limiter_level(level: float) -> float:
+    """Returns peak level in dB of limited sound by its peak level in dB,
+    see `block_gains`.
+
+    Levels above full scale are expected to be reduced no more than
+    the full scale level is.
+    """
+    if level <= LIMITER_THRESHOLD:
+        return level
+    if level <= 0:
+        return LIMITER_THRESHOLD + (level - LIMITER_THRESHOLD) / LIMITER_RATIO
+    return LIMITER_THRESHOLD - LIMITER_THRESHOLD / LIMITER_RATIO + level
+
+
+def block_gains(chunk: 'np.ndarray', *, block: int, bit_depth: int) -> 'np.ndarray':
+    """Returns limiter gain of every block of frames.
+
+    Gain follows the same transfer function as sox `compand` used by
+    the sox engine.
+    """
+    scale = 2.0 ** (bit_depth - 1)
+    magnitudes = np.abs(chunk.astype(np.float32)).max(axis=1)
+    magnitudes = np.pad(magnitudes, (0, -len(chunk) % block))
+    peaks = magnitudes.reshape(-1, block).max(axis=1) / scale
+    levels = 20 * np.log10(np.maximum(peaks, 1e-9))
+    excess = np.maximum(levels - LIMITER_THRESHOLD, 0)
+    return 10 ** (-excess * (1 - 1 / LIMITER_RATIO) / 20)
+
+
+def limiter_envelope(
+    gains: 'np.ndarray', *, before: Optional[float], after: Optional[float]
+) -> 'np.ndarray':
+    """Returns limiter gain at the beginning and the end of every block
+    of frames by their gains and gains of the blocks around them.
+
+    Gain starts to drop one block before the peak and doesn't rise
+    until the block with the peak ends, so every block is reduced
+    at least by its own gain.
+    """
+    around = np.concatenate(
+        (
+            [gains[0] if before is None else before],
+            gains,
+            [gains[-1] if after is None else after],
+        )
+    )
+    return np.minimum(around[:-1], around[1:])
+
+
+def limited_chunks(
+    pieces: Iterable['np.ndarray'], *, block: int, bit_depth: int
+) -> Iterator['np.ndarray']:
+    """Yields program passed through look-ahead limiter as float arrays.
+
+    Every chunk is yielded once the gain of the next block is known.
+    """
+    chunk_frames = max(RENDER_CHUNK_FRAMES // block, 1) * block
+    previous = None  # chunk waiting for the next one, its gains and gain before it
+    for chunk in rechunk(pieces, chunk_frames):
+        gains = block_gains(chunk, block=block, bit_depth=bit_depth)
+        if previous is not None:
+            yield apply_envelope(*previous, after=gains[0], block=block)
+            before = previous[1][-1]
+        else:
+            before = None
+        previous = chunk, gains, before
+    if previous is not None:
+        yield apply_envelope(*previous, after=None, block=block)
+
+
+def apply_envelope(
+    chunk: 'np.ndarray',
+    gains: 'np.ndarray',
+    before: Optional[float],
+    *,
+    after: Optional[float],
+    block: int,
+) -> 'np.ndarray':
+    """Returns chunk reduced by the limiter envelope as float array."""
+    envelope = limiter_envelope(gains, before=before, after=after)
+    positions = np.arange(len(envelope)) * block
+    frame_gains = np.interp(np.arange(len(chunk)), positions, envelope)
+    return chunk.astype(np.float32) * frame_gains.astype(np.float32)[:, np.newaxis]
+
+
+def render(
+    streams: Iterable[BinaryIO],
+    output: BinaryIO,
+    *,
+    crossfade_duration: float,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    volumes: Optional[Iterable[float]] = None,
+):
+    """Renders raw PCM streams into raw PCM output with numpy.
+
+    Streams are brought to provided volumes, spliced with equal power
+    crossfades, passed through look-ahead limiter, brought back to
+    full scale by a known gain and dithered with triangular noise,
+    which is similar to the sox mastering chain. Streams are read
+    in chunks as the program is written.
+    """
+    if np is None:
+        raise NumpyNotFoundError()
+
+    pieces = splice(
+        read_segments(streams, channels=channels, bit_depth=bit_depth, volumes=volumes),
+        overlap=int(crossfade_duration * sample_rate),
+        bit_depth=bit_depth,
+    )
+    block = max(int(LIMITER_LOOKAHEAD * sample_rate), 1)
+    # samples are expected to peak at full scale, leave room for
+    # a quantization step of dither noise
+    limit = 2 ** (bit_depth - 1)
+    gain = (limit - 2) / limit * 10 ** (-limiter_level(0) / 20)
+
+    write_frames(
+        output,
+        (
+            chunk * gain
+            for chunk in limited_chunks(pieces, block=block, bit_depth=bit_depth)
+        ),
+        bit_depth=bit_depth,
+    )
+
+
+def write_frames(output: BinaryIO, chunks: Iterable['np.ndarray'], *, bit_depth: int):
+    """Writes float frames as raw PCM adding triangular dither noise."""
+    dtype = pcm_dtype(bit_depth).newbyteorder('<')
+    limit = 2 ** (bit_depth - 1)
+    rng = np.random.default_rng()
+    for chunk in chunks:
+        noise = rng.random(chunk.shape, np.float32) - rng.random(
+            chunk.shape, np.float32
+        )
+        samples = np.clip(np.rint(chunk + noise), -limit, limit - 1)
+        output.write(samples.astype(dtype).tobytes())
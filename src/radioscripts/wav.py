@@ -0,0 +1,151 @@
+import os
+from pathlib import Path
+import struct
+from typing import BinaryIO, Optional
+
+
+WAV_CHUNK_SIZE: int = 1024 * 1024
+
+WAVE_FORMAT_PCM: int = 1
+
+# RIFF chunk header, format chunk and audio data chunk header
+WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+WAV_HEADER_SIZE: int = WAV_HEADER.size
+
+
+class WavWriter:
+    """Writes raw PCM frames straight to a RIFF WAVE file.
+
+    A placeholder header goes first and is patched with actual sizes
+    when the writer is closed, so the audio length needn't be known in
+    advance. Data reaches the file in chunks of `chunk_size` bytes, so
+    memory use doesn't depend on the audio length. An existing file is
+    overwritten in place, keeping the space allocated for it.
+
+    Audio data starts at a multiple of `alignment` bytes if it is
+    provided, see `align_header`.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        channels: int,
+        sample_rate: int,
+        bit_depth: int,
+        alignment: Optional[int] = None,
+        chunk_size: int = WAV_CHUNK_SIZE,
+    ):
+        self.path = path
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.bit_depth = bit_depth
+        self.alignment = alignment
+        self.size = 0  # bytes of audio data written
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        self.file: BinaryIO = os.fdopen(fd, 'r+b', buffering=chunk_size)
+        self.file.write(self.header())
+
+    def header(self) -> bytes:
+        """Returns RIFF WAVE header describing the written data."""
+        return wav_header(
+            self.size,
+            channels=self.channels,
+            sample_rate=self.sample_rate,
+            bit_depth=self.bit_depth,
+            alignment=self.alignment,
+        )
+
+    def write(self, data: bytes) -> int:
+        """Appends raw PCM frames to the file."""
+        written = self.file.write(data)
+        self.size += written
+        return written
+
+    def close(self):
+        """Patches the header and closes the file."""
+        if self.file.closed:
+            return
+        try:
+            if self.size % 2:
+                self.file.write(b'\0')  # chunks are word aligned
+            self.file.truncate()  # an overwritten file may be longer
+            self.file.seek(0)
+            self.file.write(self.header())
+        finally:
+            self.file.close()
+
+    def __enter__(self) -> 'WavWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def wav_header(
+    size: int,
+    *,
+    channels: int,
+    sample_rate: int,
+    bit_depth: int,
+    alignment: Optional[int] = None,
+) -> bytes:
+    """Returns RIFF WAVE header of PCM audio data of provided size
+    in bytes, padded by `align_header` if alignment is provided.
+    """
+    frame_size = channels * bit_depth // 8
+    # fmt: off
+    header = WAV_HEADER.pack(
+        b'RIFF', WAV_HEADER.size - 8 + size + size % 2, b'WAVE',
+        b'fmt ', 16, WAVE_FORMAT_PCM, channels, sample_rate,
+        sample_rate * frame_size, frame_size, bit_depth,
+        b'data', size,
+    )
+    # fmt: on
+    if not alignment:
+        return header
+    return align_header(header, size + size % 2, alignment)
+
+
+def header_size(alignment: Optional[int] = None) -> int:
+    """Returns size in bytes of the header written by `WavWriter`,
+    which doesn't depend on the audio format.
+    """
+    return len(
+        wav_header(0, channels=1, sample_rate=1, bit_depth=8, alignment=alignment)
+    )
+
+
+def align_header(header: bytes, size: int, alignment: int) -> bytes:
+    """Returns wav file header with a padding chunk, so that audio data
+    following the header starts at a multiple of alignment bytes.
+
+    The header is the beginning of wav file up to its audio data and
+    size is the number of bytes after it.
+    """
+    chunks, data_header = header[12:-8], header[-8:]
+    padding = -(len(header) + 8) % alignment
+    junk = b'JUNK' + struct.pack('<I', padding) + bytes(padding)
+    riff_size = 4 + len(chunks) + len(junk) + len(data_header) + size
+    riff_header = b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+    return riff_header + chunks + junk + data_header
+
+
+def resize_data(file: BinaryIO, offset: int, size: int, new_size: int):
+    """Cuts or extends with zeros audio data of wav file which starts
+    at provided offset and is `size` bytes long, so that it becomes
+    `new_size` bytes long. Chunks following the audio data are moved
+    after it and sizes in the header are updated.
+    """
+    file.seek(offset + size + size % 2)
+    following = file.read()  # usually metadata, small
+    file.truncate(offset + new_size)
+    file.seek(0, os.SEEK_END)
+    if following:
+        file.write(bytes(new_size % 2))  # chunks are word aligned
+        file.write(following)
+    end = file.tell()
+    file.seek(4)
+    file.write(struct.pack('<I', end - 8))  # RIFF chunk size
+    file.seek(offset - 4)
+    file.write(struct.pack('<I', new_size))
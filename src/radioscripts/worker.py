@@ -1,16 +1,46 @@
 from collections import deque
-from concurrent.futures import Future, Executor
+from concurrent.futures import (
+    CancelledError,
+    Future,
+    Executor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from contextlib import suppress
-from itertools import count, zip_longest
+import functools
+from itertools import count, product, zip_longest
 import logging
+import math
 from pathlib import Path
 import random
 import shutil
 import tempfile
-from typing import Iterable, Iterator, Protocol
-import urllib.request
+import threading
+import time
+from typing import BinaryIO, ContextManager, Iterable, Iterator, Optional, Protocol
 
-from radioscripts.audio import SoxError, make_radio_program, measure_durations
+from radioscripts.audio import (
+    RADIOMUSIC_BIT_DEPTH,
+    RADIOMUSIC_CHANNELS,
+    RADIOMUSIC_SAMPLE_RATE,
+    SoxError,
+    convert_stream,
+    measure_durations,
+    wav_file_size,
+)
+from radioscripts.cache import ConversionCache, SampleCache
+from radioscripts.card import CardWriter
+from radioscripts.download import (
+    DownloadAborted,
+    DownloadError,
+    download,
+    fetch_mp3_excerpt,
+    probe_remote,
+)
+from radioscripts.index import CatalogIndex
+from radioscripts.planner import Candidate, byte_rate, plan
+from radioscripts.program import CROSSFADE_DURATION, make_radio_program
 
 
 logger = logging.getLogger(__name__)
@@ -29,7 +59,7 @@ class Catalog(Protocol):
 class Worker:
     """Compiles Radio Music module compatible stations from online catalog of sounds."""
 
-    def __init__(
+    def __init__(  # pylint: disable=too-many-locals
         self,
         *,
         target: Path,
@@ -38,8 +68,30 @@ class Worker:
         files: int,
         minutes: int,
         diversity: int = 5,
+        engine: str = 'staging',
+        cache: Optional[SampleCache] = None,
+        conversions: Optional[ConversionCache] = None,
+        planning: str = 'packing',
+        candidates: int = 50,
+        render_queue: int = 4,
+        excerpts: Optional[float] = None,
+        streaming: bool = False,
+        prefetch: int = 2,
+        prefetcher: Optional[Executor] = None,
+        converter: Optional[Executor] = None,
+        alignment: Optional[int] = None,
+        workdir: Optional[Path] = None,
     ):
         self._sections: deque[str] = deque()
+        self._sections_lock = threading.Lock()
+        self._catalog_sections: list[str] = []
+        # sound lists of sections, being fetched or fetched during the run
+        self._sounds: dict[str, Future] = {}
+        self._sounds_lock = threading.Lock()
+        # sizes and durations of samples known during the run
+        self._samples: dict[str, tuple[Optional[int], Optional[float]]] = {}
+        # peak amplitudes of samples converted while downloading
+        self._peaks: dict[Path, float] = {}
 
         self.target = target
         self.catalog = catalog
@@ -47,9 +99,42 @@ class Worker:
         self.files = files
         self.minutes = minutes
         self.diversity = diversity
+        self.engine = engine
+        self.cache = cache
+        self.conversions = conversions
+        self.planning = planning
+        # samples described before planning, probing 64 KB of each one
+        # whose duration isn't known yet (twice past large ID3 tags)
+        self.candidates = candidates
+        # longest part of a long sample to use instead of the whole
+        self.excerpts = excerpts
+        # samples are converted while downloading, the cache is not used then
+        self.streaming = streaming
+        # samples of a station downloaded ahead of the one in use
+        self.prefetch = prefetch
+        # downloads samples of all stations, sized for one station if not provided
+        self.prefetcher = prefetcher or ThreadPoolExecutor(
+            prefetch + 1, thread_name_prefix='Prefetcher'
+        )
+        # converts samples of a station concurrently if provided
+        self.converter = converter
+        # audio data of stations starts at a multiple of bytes if provided
+        self.alignment = alignment
+        # keeps downloaded samples and rendering files, the system
+        # temporary directory is used if not provided
+        self.workdir = workdir
+        # renders stations to the target storage in order, keeping no more
+        # than render queue of downloaded stations waiting for their turn
+        self.writer = CardWriter(
+            product(range(banks), range(files)), ahead=render_queue
+        )
 
     def start(self, executor: Executor) -> Iterator[Future]:
-        """Schedules cooperative radio stations compilation processes."""
+        """Schedules cooperative radio stations compilation processes.
+
+        Samples are downloaded by the executor and stations are rendered
+        by the writer.
+        """
         logger.debug(
             (
                 'Starting to fill %(target)s with %(banks)d banks of %(files)d files '
@@ -63,43 +148,185 @@ class Worker:
 
         for bank in range(self.banks):
             for file in range(self.files):
-                yield executor.submit(self.compose_station, bank, file, self.minutes)
+                yield self.schedule_station(executor, bank, file)
         logger.debug('%d jobs pending', self.banks * self.files)
 
-    def compose_station(self, bank: int, file: int, minutes: int):
-        """Compiles radio station from samples and saves it to the target storage."""
+    def schedule_station(self, downloader: Executor, bank: int, file: int) -> Future:
+        """Schedules radio station compilation in two stages: downloading
+        samples and rendering them to the target storage by the writer.
+
+        Returns a future which is done when the station is saved.
+        """
+        station: Future = Future()
+
+        def fail(exc: BaseException):
+            self.writer.discard((bank, file))
+            if not station.cancelled():
+                station.set_exception(exc)
+
+        def render(downloaded: Future):
+            if downloaded.cancelled():  # the downloader is shut down
+                fail(CancelledError())
+            elif exc := downloaded.exception():
+                fail(exc)
+            else:
+                samples, dir_ = downloaded.result()
+                written = self.render_station(bank, file, samples)
+                written.add_done_callback(functools.partial(clean, dir_=dir_))
+                written.add_done_callback(resolve)
+
+        def clean(_: Future, dir_: Path):
+            shutil.rmtree(dir_, ignore_errors=True)
+            self.forget_peaks(dir_)
+
+        def resolve(written: Future):
+            if written.cancelled():  # the writer is shut down
+                station.set_exception(CancelledError())
+            elif exc := written.exception():
+                station.set_exception(exc)
+            else:
+                station.set_result(written.result())
+
+        def fetch() -> tuple[list[Path], Path]:
+            if not station.set_running_or_notify_cancel():
+                raise CancelledError()
+            return self.download_station(bank, file, self.minutes)
+
+        downloader.submit(fetch).add_done_callback(render)
+        return station
+
+    def download_station(
+        self, bank: int, file: int, minutes: int
+    ) -> tuple[list[Path], Path]:
+        """Downloads samples for radio station to a new temporary directory.
+
+        Waits until the writer has room for the station, so that
+        downloaded stations waiting for their turn don't pile up on disk.
+        """
         logger.debug(
-            'Starting to compose radio station: bank %d file %d %d minutes long',
+            'Starting to download radio station: bank %d file %d %d minutes long',
             bank,
             file,
             minutes,
         )
+        dir_ = Path(tempfile.mkdtemp(dir=self.workdir))
+        try:
+            samples = list(self.collect_station_samples(minutes, dir_))
+        except BaseException:
+            shutil.rmtree(dir_, ignore_errors=True)
+            raise
+        self.writer.wait_for_room((bank, file))
+        return samples, dir_
 
-        samples_urls = self.choose_samples_urls(self.collect_catalogs_sounds())
-        with tempfile.TemporaryDirectory() as tmpdir:
-            samples = self.collect_samples(
-                duration=minutes * 60, urls=samples_urls, dir_=Path(tmpdir)
-            )
+    def collect_station_samples(self, minutes: int, dir_: Path) -> Iterator[Path]:
+        """Chooses samples for radio station and downloads them
+        to provided directory.
+        """
+        catalogs_sounds = self.collect_catalogs_sounds()
+        if self.planning == 'packing':
+            samples_urls = self.plan_samples_urls(list(catalogs_sounds), minutes * 60)
+        else:
+            samples_urls = self.choose_samples_urls(catalogs_sounds)
+        return self.collect_samples(duration=minutes * 60, urls=samples_urls, dir_=dir_)
 
-            program_path = Path(tmpdir) / f'{file:02}.wav'
-            make_radio_program(samples, program_path)
-            logger.debug('Compiled radio station %s', program_path.name)
+    def render_station(self, bank: int, file: int, samples: list[Path]) -> Future:
+        """Schedules rendering radio station from samples to the target
+        storage.
 
-            stored_path = self.copy_file_safely(
-                program_path, self.target / f'{bank:02}'
-            )
-            logger.debug('Audio saved to %s', stored_path)
+        Returns a future resolved with the saved file path.
+        """
+        return self.writer.submit(
+            (bank, file),
+            functools.partial(self.render_program, samples),
+            self.target / f'{bank:02}' / f'{file:02}.wav',
+            wav_file_size(self.minutes * 60, alignment=self.alignment),
+        )
+
+    def render_program(self, samples: list[Path], path: Path):
+        """Compiles radio station from samples to provided path."""
+        make_radio_program(
+            samples,
+            path,
+            engine=self.engine,
+            cache=self.conversions,
+            converted=self.streaming,
+            peaks=self._peaks,
+            executor=self.converter,
+            duration=self.minutes * 60,
+            alignment=self.alignment,
+            workdir=self.workdir,
+        )
+        logger.debug('Compiled radio station %s', path.name)
+
+    def catalog_sections(self) -> list[str]:
+        """Returns catalog section urls loading them once per run."""
+        if not self._catalog_sections:
+            self._catalog_sections = self.catalog.sections()
+        return self._catalog_sections
 
     def enqueue_sections(self):
         """Loads catalog section urls to queue."""
-        sections = self.catalog.sections()
+        sections = self.catalog_sections()
         self._sections.extend(random.sample(sections, len(sections)))
 
+    def precrawl(self, max_workers: int) -> tuple[int, float]:
+        """Fetches sound lists of all catalog sections concurrently,
+        so that stations don't wait for catalog pages.
+
+        Returns number of fetched pages and elapsed time in seconds.
+        """
+        started = time.perf_counter()
+        sections = self.catalog_sections()
+        fetched = 0
+        with ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='Crawler'
+        ) as executor:
+            futures = [executor.submit(self.section_sounds, url) for url in sections]
+            for future in as_completed(futures):
+                if exc := future.exception():
+                    # the page will be fetched again when a station needs it
+                    logger.debug('Section page is not crawled\n%s', exc)
+                else:
+                    fetched += 1
+        elapsed = time.perf_counter() - started
+        logger.debug('%d of %d section pages crawled', fetched, len(sections))
+        return fetched, elapsed
+
+    def next_section(self) -> str:
+        """Returns the next section url from the queue. Sections are
+        enqueued again in a new order once all of them are used.
+        """
+        with self._sections_lock:
+            if not self._sections:
+                self.enqueue_sections()
+                logger.debug('%d catalog sections enqueued', len(self._sections))
+            return self._sections.popleft()
+
+    def section_sounds(self, url: str) -> list[str]:
+        """Returns sound urls from the section page.
+
+        Every page is fetched once per run, concurrent requests for the
+        same page wait for the single fetch.
+        """
+        with self._sounds_lock:
+            future = self._sounds.get(url)
+            fetching = future is None
+            if fetching:
+                future = self._sounds[url] = Future()
+        if fetching:
+            try:
+                future.set_result(self.catalog.sounds(url))
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                with self._sounds_lock:
+                    del self._sounds[url]  # let the next caller retry
+                future.set_exception(exc)
+        return future.result()
+
     def collect_catalogs_sounds(self) -> Iterator[list[str]]:
         """Provides randomly ordered lists of sound urls from N catalog sections."""
-        with suppress(IndexError):  # no sections left - no more sounds yielded
+        with suppress(IndexError):  # no sections - no sounds yielded
             for _ in range(self.diversity):
-                sounds = self.catalog.sounds(self._sections.popleft())
+                sounds = self.section_sounds(self.next_section())
                 yield random.sample(sounds, len(sounds))
 
     def choose_samples_urls(
@@ -109,46 +336,239 @@ class Worker:
         for maybe_urls in zip_longest(*catalogs_sounds):
             yield from filter(None, random.sample(maybe_urls, len(maybe_urls)))
 
+    def plan_samples_urls(
+        self, catalogs_sounds: list[list[str]], duration: float
+    ) -> Iterator[str]:
+        """Provides samples which fill provided duration best,
+        considering some random samples from each of the catalog
+        sections.
+
+        Falls back to random samples if their durations can't be known.
+        Unknown sizes are estimated from the durations.
+        """
+        urls = list(self.choose_samples_urls(catalogs_sounds))
+        considered = urls[: self.candidates]
+        sections = {
+            url: section
+            for section, section_urls in enumerate(catalogs_sounds)
+            for url in section_urls
+        }
+        descriptions = list(self.prefetcher.map(self.describe_sample, considered))
+        rate = byte_rate(descriptions)
+        candidates = [
+            Candidate(
+                url,
+                sections[url],
+                round(duration * rate) if size is None else size,
+                duration,
+            )
+            for url, (size, duration) in zip(considered, descriptions)
+            if duration is not None
+        ]
+        chosen = plan(candidates, duration, sections=len(catalogs_sounds))
+        logger.debug(
+            '%d of %d samples planned to fill %.1f of %.1f seconds',
+            len(chosen),
+            len(candidates),
+            sum(candidate.duration for candidate in chosen),
+            duration,
+        )
+        chosen_urls = {candidate.url for candidate in chosen}
+        yield from (candidate.url for candidate in chosen)
+        # in case durations turn out to be estimated wrong
+        yield from (url for url in urls if url not in chosen_urls)
+
     def collect_samples(
-        self, duration: float, urls: Iterable[str], dir_: Path, *, skips_count: int = 5
+        self,
+        duration: float,
+        urls: Iterable[str],
+        dir_: Path,
+        *,
+        skips_count: int = 5,
+        crossfade_duration: float = CROSSFADE_DURATION,
     ) -> Iterator[Path]:
-        """Downloads and yields samples while they all fit provided duration."""
+        """Downloads and yields samples until they fill provided duration
+        crossfaded, the last sample is cut to the duration when the
+        program is rendered.
+
+        Samples known to be longer than the rest of the duration are
+        skipped, unless there were `skips_count` samples which couldn't
+        be used already. A few next samples are downloaded in advance by
+        the prefetcher while the yielded ones are being used. Downloads
+        ahead are aborted once the samples are collected.
+        """
         remaining = duration
-        for url in urls:
-            filename = Path(url).name
-            filepath = dir_ / filename
+        urls = iter(urls)
+        pending: deque[Future] = deque()
+        aborted = threading.Event()
+        try:
+            for index in count():
+                # the awaited sample and the ones ahead of it
+                while len(pending) <= self.prefetch and (url := next(urls, None)):
+                    filepath = dir_ / f'{index + len(pending):03}_{Path(url).name}'
+                    pending.append(
+                        self.prefetcher.submit(
+                            self.fetch_sample,
+                            url,
+                            filepath,
+                            remaining if skips_count > 0 else math.inf,
+                            abort=aborted,
+                        )
+                    )
+                if not pending:
+                    break
+                if (fetched := pending.popleft().result()) is None:
+                    skips_count -= 1  # too long or not available
+                    continue
+                filepath, file_duration = fetched
+                remaining -= file_duration
+                yield filepath
+                if remaining <= 0:
+                    break
+                remaining += crossfade_duration  # the next sample overlaps this one
+        finally:
+            aborted.set()
+            for future in pending:
+                future.cancel()
+            wait(pending)  # none of them should be left writing to the directory
 
-            urllib.request.urlretrieve(url, filepath)
-            logger.debug('%s downloaded', url)
+    def fetch_sample(
+        self,
+        url: str,
+        path: Path,
+        remaining: float,
+        *,
+        abort: Optional[threading.Event] = None,
+    ) -> Optional[tuple[Path, float]]:
+        """Downloads the sample to provided path and returns the path
+        and the sample duration in seconds.
 
-            try:
-                file_duration = next(iter(measure_durations(filepath)))
-            except SoxError as exc:
-                logger.debug('%s discarded due to the error\n%s', filename, exc)
-                continue
-
-            if remaining - file_duration <= 0:
-                # try to find another file that fits remaining length
-                skips_count -= 1
-                if skips_count <= 0:
-                    break
-                logger.debug('%s skipped as too long', filename)
-                continue
+        Returns None without downloading the sample if it is known to be
+        longer than remaining duration, or if the sample is not
+        available or the download is aborted, see `download`.
+        """
+        if self.streaming:
+            path = path.with_suffix('.wav')
 
-            remaining -= file_duration
-            yield filepath
+        excerpt_duration = self.excerpt_sample(url, remaining, path)
+        if excerpt_duration is not None:
+            return path, excerpt_duration
 
-    def copy_file_safely(self, src: Path, dir_: Path) -> Path:
-        """Copies file to a directory without overwriting an existing
-        file. Stores the provided file under a new name in case of
-        conflict.
+        # don't download files which are obviously too long
+        estimated_duration = self.estimate_duration(url)
+        if estimated_duration is not None and remaining <= estimated_duration:
+            logger.debug('%s skipped as too long', url)
+            return None
+
+        try:
+            self.retrieve(url, path, abort=abort)
+        except DownloadAborted:
+            logger.debug('%s download aborted', url)
+            path.unlink(missing_ok=True)
+            return None
+        except (DownloadError, SoxError) as exc:
+            # a lost sample is replaced by others, the station goes on
+            logger.warning('%s abandoned\n%s', url, exc)
+            path.unlink(missing_ok=True)
+            return None
+        logger.debug('%s downloaded', url)
+
+        try:
+            duration = next(iter(measure_durations(path)))
+        except SoxError as exc:
+            logger.debug('%s discarded due to the error\n%s', path.name, exc)
+            return None
+        self.remember_sample(url, duration=duration)
+        return path, duration
+
+    def describe_sample(self, url: str) -> tuple[Optional[int], Optional[float]]:
+        """Returns bytes to download and duration of the sample
+        in seconds if they are cheap to know.
+        """
+        size, duration = self._samples.get(url, (None, None))
+        if duration is None and isinstance(self.catalog, CatalogIndex):
+            size, duration = self.catalog.sound(url)
+            if duration is not None:
+                self._samples[url] = (size, duration)
+        if duration is None:
+            size, duration = probe_remote(url)
+            self.remember_sample(url, size=size, duration=duration)
+        if self.cache is not None and url in self.cache:
+            size = 0
+        return size, duration
+
+    def estimate_duration(self, url: str) -> Optional[float]:
+        """Returns sample duration known before downloading it."""
+        if self.cache is not None and url in self.cache and url not in self._samples:
+            return None  # local copy is measured cheaper and more precisely
+        return self.describe_sample(url)[1]
+
+    def excerpt_sample(self, url: str, remaining: float, path: Path) -> Optional[float]:
+        """Downloads random part of long MP3 sample to provided path
+        if excerpts are enabled.
+
+        The part is shorter than both excerpt length and remaining
+        duration in seconds. Returns the part duration, or None if the
+        sample is short enough or can't be excerpted.
+        """
+        if self.excerpts is None:
+            return None
+        size, duration = self.describe_sample(url)
+        if not size or not duration:
+            return None  # unknown, or cached and cheaper to use whole
+        max_duration = min(self.excerpts, remaining)
+        if duration <= max_duration:
+            return None
+        if (excerpt := fetch_mp3_excerpt(url, size, duration, max_duration)) is None:
+            return None
+        data, excerpt_duration = excerpt
+        try:
+            with self.open_sample(url, path) as file:
+                file.write(data)
+        except SoxError as exc:
+            logger.debug('Excerpt of %s discarded due to the error\n%s', url, exc)
+            return None
+        return excerpt_duration
+
+    def remember_sample(
+        self, url: str, *, size: Optional[int] = None, duration: Optional[float] = None
+    ):
+        """Saves sample size and duration for the run and to the catalog index."""
+        known_size, known_duration = self._samples.get(url, (None, None))
+        self._samples[url] = (
+            known_size if size is None else size,
+            known_duration if duration is None else duration,
+        )
+        if isinstance(self.catalog, CatalogIndex):
+            self.catalog.remember(url, size=size, duration=duration)
+
+    def retrieve(
+        self, url: str, path: Path, *, abort: Optional[threading.Event] = None
+    ):
+        """Downloads sample to provided path, from cache if possible."""
+        if self.cache is None or self.streaming:
+            with self.open_sample(url, path) as file:
+                download(url, file, abort=abort)
+        else:
+            self.cache.retrieve(url, path, abort=abort)
+
+    def open_sample(self, url: str, path: Path) -> ContextManager[BinaryIO]:
+        """Opens sample file for writing. In streaming mode the written
+        sample is converted on the fly, so that only the result is saved,
+        and its peak amplitude is remembered.
         """
-        dir_.mkdir(exist_ok=True)
-        dst = dir_ / src.name
-        for num in count(1):
-            if not dst.exists():
-                break
-            # append something like a version to the filename
-            dst = dst.with_stem(src.stem + '-' + str(num))
-        shutil.copyfile(src, dst)
-        return dst
+        if not self.streaming:
+            return path.open('wb')
+        return convert_stream(
+            path,
+            file_type=Path(url).suffix[1:].lower() or 'mp3',
+            channels=RADIOMUSIC_CHANNELS,
+            sample_rate=RADIOMUSIC_SAMPLE_RATE,
+            bit_depth=RADIOMUSIC_BIT_DEPTH,
+            report_peak=functools.partial(self._peaks.__setitem__, path),
+        )
+
+    def forget_peaks(self, dir_: Path):
+        """Drops peak amplitudes of samples from provided directory."""
+        for path in [path for path in list(self._peaks) if path.parent == dir_]:
+            self._peaks.pop(path, None)
@@ -0,0 +1,108 @@
+from email.message import Message
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import re
+import threading
+from typing import Optional, Union
+
+import pytest
+
+
+RANGE_PATTERN = re.compile(r'bytes=(\d+)-(\d*)')
+
+
+class Resource:
+    """Resource served by the test server.
+
+    Every request takes the next action: 'ok' sends the content, 'drop'
+    sends half of it and closes the connection, a number responds with
+    that error status.
+    """
+
+    def __init__(
+        self,
+        content: bytes,
+        *actions: Union[str, int],
+        ranges: bool = True,
+        validator: str = 'ETag',
+        location: Optional[str] = None,
+    ):
+        self.content = content
+        self.actions = list(actions)
+        self.ranges = ranges
+        self.validator = validator
+        self.location = location
+        self.version = '"1"'
+        self.requests: list[Message] = []
+        self.paths: list[str] = []
+        self.clients: list[tuple[str, int]] = []
+
+    def respond(self, handler: BaseHTTPRequestHandler):
+        self.requests.append(handler.headers)
+        self.paths.append(handler.path)
+        self.clients.append(handler.client_address)
+        action = self.actions.pop(0) if self.actions else 'ok'
+        if isinstance(action, int):
+            handler.send_error(action)
+            return
+        if self.location:
+            handler.send_response(302)
+            handler.send_header('Location', self.location)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        if handler.headers.get('If-None-Match') == self.version:
+            handler.send_response(304)
+            handler.end_headers()
+            return
+
+        body = self.content
+        match = RANGE_PATTERN.fullmatch(handler.headers.get('Range', ''))
+        if_range = handler.headers.get('If-Range')
+        if self.ranges and match and if_range in (None, self.version):
+            start = int(match[1])
+            end = min(int(match[2] or len(body) - 1), len(body) - 1)
+            handler.send_response(206)
+            handler.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+            body = body[start : end + 1]
+        else:
+            handler.send_response(200)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.send_header(self.validator, self.version)
+        handler.end_headers()
+        if action == 'drop':
+            body = body[: len(body) // 2]
+            handler.close_connection = True
+        handler.wfile.write(body)
+
+    def change(self, content: bytes, version: str = '"2"'):
+        """Replaces the content with a new version."""
+        self.content = content
+        self.version = version
+
+
+@pytest.fixture
+def serve():
+    """Provides function serving a resource and returning its URL."""
+    servers = []
+
+    def serve_resource(resource: Resource) -> str:
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keeps connections alive
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                resource.respond(self)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        # short poll interval makes shutdown fast
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        servers.append(server)
+        host, port = server.server_address
+        return f'http://{host}:{port}/sample.mp3'
+
+    yield serve_resource
+    for server in servers:
+        server.shutdown()
+        server.server_close()
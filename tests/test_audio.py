@@ -0,0 +1,270 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import io
+from pathlib import Path
+import struct
+import time
+from types import SimpleNamespace
+import wave
+
+import pytest
+
+from radioscripts import audio
+from radioscripts.audio import (
+    SilenceTrimmer,
+    SoxError,
+    calculate_required_space,
+    calculate_staging_space,
+    convert_all,
+    decode,
+    decoding_parameters,
+    seek_pcm,
+    trim_trailing_silence,
+)
+from radioscripts.cache import ConversionCache
+
+
+def pcm(*values: int) -> bytes:
+    return array('h', values).tobytes()
+
+
+def samples(data: bytes) -> list[int]:
+    return list(array('h', data))
+
+
+@pytest.fixture
+def fake_convert(monkeypatch):
+    """Replaces sox conversion with copying, slower for earlier inputs."""
+
+    def convert(input_path, output_path, **_):
+        time.sleep(0.01 * int(input_path.stem))
+        if input_path.stem == '0':
+            raise SoxError(2, 'broken')
+        output_path.write_bytes(input_path.read_bytes())
+        return int(input_path.stem) / 10
+
+    monkeypatch.setattr(audio, 'convert', convert)
+
+
+def write_samples(directory: Path, *names: str) -> list[Path]:
+    paths = [directory / f'{name}.mp3' for name in names]
+    for path in paths:
+        path.write_text(path.stem)
+    return paths
+
+
+def test_convert_all_keeps_input_order(tmp_path, fake_convert):
+    input_paths = write_samples(tmp_path, '3', '1', '2', '1')
+    with ThreadPoolExecutor(4) as executor:
+        output_paths, peaks = convert_all(
+            input_paths,
+            tmp_path,
+            executor=executor,
+            channels=1,
+            sample_rate=44100,
+            bit_depth=16,
+        )
+    assert [path.read_text() for path in output_paths] == ['3', '1', '2', '1']
+    assert len(set(output_paths)) == 4
+    assert peaks == [0.3, 0.1, 0.2, 0.1]
+
+
+def test_convert_all_waits_for_all_conversions_on_error(tmp_path, fake_convert):
+    input_paths = write_samples(tmp_path, '0', '5')
+    with ThreadPoolExecutor(2) as executor:
+        with pytest.raises(SoxError):
+            convert_all(
+                input_paths,
+                tmp_path,
+                executor=executor,
+                channels=1,
+                sample_rate=44100,
+                bit_depth=16,
+            )
+        assert (tmp_path / '2_5.wav').exists()
+
+
+def write_wav(path: Path, data: bytes, *, chunks: bytes = b''):
+    with wave.open(str(path), 'wb') as file:
+        # pylint: disable=no-member
+        file.setnchannels(2)
+        file.setsampwidth(2)
+        file.setframerate(44100)
+        file.writeframes(data)
+    with path.open('ab') as file:
+        file.write(chunks)
+
+
+@pytest.mark.parametrize(
+    'data, expected',
+    [
+        (pcm(100, 200, 300, 400, 0, 0, 0, 0), pcm(100, 200, 300, 400)),
+        (pcm(100, 200, 300, 0, 0, 0), pcm(100, 200, 300, 0)),  # whole frames are kept
+        (pcm(100, 200, 1, -3, 0, 2), pcm(100, 200)),  # quieter than the threshold
+        (pcm(0, 0, 100, 200), pcm(0, 0, 100, 200)),
+        (pcm(0, 0, 1, 0), b''),
+        (b'', b''),
+    ],
+)
+def test_trim_trailing_silence(tmp_path, data, expected):
+    path = tmp_path / 'sample.wav'
+    write_wav(path, data)
+    trim_trailing_silence(path, channels=2, bit_depth=16)
+    with wave.open(str(path)) as file:
+        assert file.readframes(-1) == expected
+    assert path.stat().st_size == 44 + len(expected)
+
+
+def test_trim_trailing_silence_keeps_trailing_chunks(tmp_path):
+    path = tmp_path / 'sample.wav'
+    chunks = b'LIST' + struct.pack('<I', 4) + b'INFO'
+    write_wav(path, pcm(100, 200, 0, 0), chunks=chunks)
+    trim_trailing_silence(path, channels=2, bit_depth=16)
+    with wave.open(str(path)) as file:
+        assert file.readframes(-1) == pcm(100, 200)
+    content = path.read_bytes()
+    assert content.endswith(chunks)
+    assert struct.unpack('<I', content[4:8])[0] == len(content) - 8
+
+
+@pytest.mark.parametrize('size', [-1, 1, 3, 4, 100])
+@pytest.mark.parametrize(
+    'data, expected',
+    [
+        (
+            pcm(100, 200, 0, 0, 300, 400, 0, 0, 0, 0),
+            pcm(100, 200, 0, 0, 300, 400),
+        ),
+        (pcm(100, 0, 0, 0, 0, 0), pcm(100, 0)),
+        (pcm(100, 0, 2, -2, 0, 1), pcm(100, 0)),
+        (pcm(0, 0, 0, 0), b''),
+    ],
+)
+def test_silence_trimmer(data, expected, size):
+    trimmer = SilenceTrimmer(io.BytesIO(data), channels=2, bit_depth=16)
+    trimmed = b''
+    while chunk := trimmer.read(size):
+        trimmed += chunk
+    assert trimmed == expected
+
+
+@pytest.mark.parametrize(
+    'kwargs, expected',
+    [
+        ({}, 4 * (2 * (44 + 5292000) + 1)),
+        ({'cluster_size': 32768}, 4 * (2 * 162 + 1) * 32768),
+        ({'channels': 2, 'alignment': 4096}, 4 * (2 * (4096 + 10584000) + 1)),
+    ],
+)
+def test_calculate_required_space(kwargs, expected):
+    assert calculate_required_space(4, 2, 1, **kwargs) == expected
+
+
+@pytest.mark.parametrize(
+    'converted, expected',
+    [
+        (False, 3 * 60 * 16000 + 2 * (44 + 5292000)),
+        (True, 5 * (44 + 5292000)),
+    ],
+)
+def test_calculate_staging_space(converted, expected):
+    size = calculate_staging_space(3, 1, converted=converted, sample_byte_rate=16000)
+    assert size == expected
+
+
+def test_seek_pcm_reads_only_audio_data(tmp_path):
+    path = tmp_path / 'sample.wav'
+    write_wav(path, pcm(1, 2, 3, 4), chunks=b'LIST' + bytes(4))
+    with path.open('rb') as file:
+        stream = seek_pcm(file)
+        assert stream.read(4) == pcm(1, 2)
+        assert stream.read() == pcm(3, 4)
+        assert stream.read() == b''
+
+
+def test_seek_pcm_of_not_wav_file(tmp_path):
+    path = tmp_path / 'sample.wav'
+    path.write_bytes(b'broken')
+    with path.open('rb') as file:
+        assert seek_pcm(file) is None
+
+
+@pytest.fixture
+def fake_sox(monkeypatch):
+    """Replaces sox decoding with a constant sound peaking at half of
+    full scale, and sox volume change with doubling.
+    """
+
+    @contextlib.contextmanager
+    def open_sox(*_, report, **__):
+        yield SimpleNamespace(stdout=io.BytesIO(pcm(100, 200, 300, 400)))
+        report('Maximum amplitude: 0.5\nMinimum amplitude: -0.25\n')
+
+    def run_sox(option, volume, input_path, output_path):
+        assert (option, volume) == ('-v', '2.0')
+        with wave.open(str(input_path)) as file:
+            data = file.readframes(-1)
+        write_wav(output_path, pcm(*(value * 2 for value in samples(data))))
+
+    monkeypatch.setattr(audio, 'open_sox', open_sox)
+    monkeypatch.setattr(audio, 'run_sox', run_sox)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ConversionCache(tmp_path / 'cache', budget=1024**2)
+
+
+@pytest.fixture
+def sample_path(tmp_path):
+    path = tmp_path / 'sample.mp3'
+    path.write_bytes(b'sound')
+    return path
+
+
+PCM_FORMAT = {'channels': 2, 'sample_rate': 44100, 'bit_depth': 16}
+
+
+def test_decode_streams_new_sample_and_caches_it_normalized(
+    sample_path, cache, fake_sox
+):
+    peaks = []
+    with decode(sample_path, **PCM_FORMAT, cache=cache) as stream:
+        assert stream.read(4) == pcm(100, 200)
+    digest = cache.digest(sample_path, decoding_parameters(**PCM_FORMAT))
+    with cache.open(digest) as file:
+        assert seek_pcm(file).read() == pcm(200, 400, 600, 800)
+    with decode(
+        sample_path, **PCM_FORMAT, cache=cache, report_peak=peaks.append
+    ) as stream:
+        assert stream.read() == pcm(200, 400, 600, 800)
+    assert not peaks  # cached sample is normalized already
+
+
+def test_decode_reports_peak(sample_path, fake_sox):
+    peaks = []
+    with decode(sample_path, **PCM_FORMAT, report_peak=peaks.append) as stream:
+        assert stream.read() == pcm(100, 200, 300, 400)
+    assert peaks == [0.5]
+
+
+def test_decode_converts_broken_cached_conversion_again(sample_path, cache, fake_sox):
+    digest = cache.digest(sample_path, decoding_parameters(**PCM_FORMAT))
+    with cache.converting(digest) as cached_path:
+        cached_path.write_bytes(b'broken')
+
+    with decode(sample_path, **PCM_FORMAT, cache=cache) as stream:
+        assert stream.read() == pcm(100, 200, 300, 400)
+    with cache.open(digest) as file:
+        assert seek_pcm(file).read() == pcm(200, 400, 600, 800)
+
+
+def test_decode_reads_converted_samples_without_sox(tmp_path, monkeypatch):
+    monkeypatch.setattr(audio, 'open_sox', None)
+    path = tmp_path / 'sample.wav'
+    write_wav(path, pcm(1, 2, 3, 4), chunks=b'LIST' + bytes(4))
+    with decode(
+        path, channels=2, sample_rate=44100, bit_depth=16, converted=True
+    ) as stream:
+        assert stream.read() == pcm(1, 2, 3, 4)
@@ -0,0 +1,170 @@
+import errno
+import os
+from pathlib import Path
+
+import pytest
+
+from conftest import Resource
+from radioscripts import audio
+from radioscripts.audio import convert
+from radioscripts.cache import ConversionCache, ObjectStore, SampleCache, copy_file
+
+
+CONTENT = bytes(range(256)) * 40
+
+
+def add_object(store: ObjectStore, tmp_path: Path, digest: str, size: int) -> Path:
+    src = tmp_path / f'{digest}.src'
+    src.write_bytes(bytes(size))
+    path = tmp_path / digest
+    store.add(src, digest, path)
+    return path
+
+
+def test_object_store_checkout(tmp_path):
+    store = ObjectStore(tmp_path / 'cache', budget=1000)
+    add_object(store, tmp_path, 'aa01', 100)
+    assert store.checkout('aa01', tmp_path / 'checkout')
+    assert (tmp_path / 'checkout').read_bytes() == bytes(100)
+    assert not store.checkout('bb02', tmp_path / 'missing')
+    assert not (tmp_path / 'missing').exists()
+
+
+def test_object_store_evicts_least_recently_used(tmp_path):
+    store = ObjectStore(tmp_path / 'cache', budget=250)
+    placed = add_object(store, tmp_path, 'aa01', 100)
+    add_object(store, tmp_path, 'bb02', 100)
+    assert store.checkout('aa01', tmp_path / 'used')
+    add_object(store, tmp_path, 'cc03', 100)
+
+    assert not store.object_path('bb02').exists()
+    assert store.object_path('aa01').exists()
+    assert store.object_path('cc03').exists()
+    # files handed out before stay in place
+    assert placed.exists()
+
+
+def test_object_store_keeps_index_between_sessions(tmp_path):
+    add_object(ObjectStore(tmp_path / 'cache', budget=1000), tmp_path, 'aa01', 100)
+    assert ObjectStore(tmp_path / 'cache', budget=1000).checkout('aa01', tmp_path / 'x')
+
+
+@pytest.fixture
+def resource():
+    return Resource(CONTENT)
+
+
+def test_sample_cache_downloads_sample_once(tmp_path, serve, resource):
+    url = serve(resource)
+    cache = SampleCache(tmp_path / 'cache', budget=10**6)
+    cache.retrieve(url, tmp_path / 'first')
+    cache.retrieve(url, tmp_path / 'second')
+
+    assert url in cache
+    assert len(resource.requests) == 1
+    assert (tmp_path / 'second').read_bytes() == CONTENT
+
+
+def test_sample_cache_revalidates_stale_sample(tmp_path, serve, resource):
+    url = serve(resource)
+    cache = SampleCache(tmp_path / 'cache', budget=10**6, max_age=0)
+    cache.retrieve(url, tmp_path / 'first')
+    cache.retrieve(url, tmp_path / 'second')
+
+    assert len(resource.requests) == 2
+    assert resource.requests[1]['If-None-Match'] == resource.version
+    assert (tmp_path / 'second').read_bytes() == CONTENT
+
+
+def test_sample_cache_replaces_changed_sample(tmp_path, serve, resource):
+    url = serve(resource)
+    cache = SampleCache(tmp_path / 'cache', budget=10**6, max_age=0)
+    cache.retrieve(url, tmp_path / 'first')
+    resource.change(CONTENT[::-1])
+    cache.retrieve(url, tmp_path / 'second')
+
+    assert (tmp_path / 'first').read_bytes() == CONTENT
+    assert (tmp_path / 'second').read_bytes() == CONTENT[::-1]
+
+
+def test_sample_cache_downloads_evicted_sample(tmp_path, serve, resource):
+    url = serve(resource)
+    cache = SampleCache(tmp_path / 'cache', budget=10**6, max_age=0)
+    cache.retrieve(url, tmp_path / 'first')
+    cache.budget = 0
+    cache.evict()
+    cache.retrieve(url, tmp_path / 'second')
+
+    assert url not in cache  # the sample doesn't fit the budget anymore
+    assert (tmp_path / 'second').read_bytes() == CONTENT
+
+
+def test_conversion_cache_digest_depends_on_parameters(tmp_path):
+    source = tmp_path / 'sample.mp3'
+    source.write_bytes(CONTENT)
+    digest = ConversionCache.digest(source, ['-r', '44100'])
+    assert digest == ConversionCache.digest(source, ['-r', '44100'])
+    assert digest != ConversionCache.digest(source, ['-r', '48000'])
+    assert digest != ConversionCache.digest(source, ['-r44100'])
+
+
+def test_conversion_cache_stores_successful_conversions(tmp_path):
+    cache = ConversionCache(tmp_path / 'cache', budget=10**6)
+    with cache.converting('aa01', tmp_path / 'converted.wav') as tmp_path_:
+        tmp_path_.write_bytes(CONTENT)
+    with pytest.raises(RuntimeError):
+        with cache.converting('bb02') as tmp_path_:
+            tmp_path_.write_bytes(CONTENT)
+            raise RuntimeError()
+
+    assert (tmp_path / 'converted.wav').read_bytes() == CONTENT
+    with cache.open('aa01') as file:
+        assert file.read() == CONTENT
+    assert cache.open('bb02') is None
+
+
+def test_convert_uses_cached_conversion(tmp_path, monkeypatch):
+    cache = ConversionCache(tmp_path / 'cache', budget=10**6)
+    source = tmp_path / 'sample.mp3'
+    source.write_bytes(CONTENT)
+    pcm_format = {'channels': 1, 'sample_rate': 44100, 'bit_depth': 16}
+
+    def run_sox(*args, **_):
+        args[3].write_bytes(b'converted ' + args[0].read_bytes())
+        return 'Maximum amplitude: 0.5\nMinimum amplitude: -0.75\n'
+
+    monkeypatch.setattr(audio, 'run_sox', run_sox)
+    assert convert(source, tmp_path / 'first.wav', **pcm_format, cache=cache) == 0.75
+    monkeypatch.setattr(audio, 'run_sox', None)
+    assert convert(source, tmp_path / 'second.wav', **pcm_format, cache=cache) == 0.75
+
+    assert (tmp_path / 'second.wav').read_bytes() == b'converted ' + CONTENT
+
+
+def test_conversion_cache_forgets_peaks_of_evicted_files(tmp_path):
+    cache = ConversionCache(tmp_path / 'cache', budget=10**6)
+    with cache.converting('aa01') as tmp_path_:
+        tmp_path_.write_bytes(CONTENT)
+    cache.remember_peak('aa01', 0.5)
+    cache.remember_peak('bb02', 0.5)
+    assert cache.peak('aa01') == 0.5
+    assert cache.peak('bb02') is None
+
+    cache.budget = 0
+    cache.evict()
+    assert cache.peak('aa01') is None
+
+
+@pytest.mark.parametrize('in_kernel', [True, False])
+def test_copy_file(tmp_path, monkeypatch, in_kernel):
+    if not in_kernel:
+
+        def copy_file_range(*args):
+            raise OSError(errno.EXDEV, 'cross-device link')
+
+        monkeypatch.setattr(os, 'copy_file_range', copy_file_range, raising=False)
+    src = tmp_path / 'src'
+    src.write_bytes(CONTENT * 100)
+    (tmp_path / 'dst').write_bytes(b'previous content ' * 10**5)
+    copy_file(src, tmp_path / 'dst')
+    assert (tmp_path / 'dst').read_bytes() == CONTENT * 100
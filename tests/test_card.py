@@ -0,0 +1,192 @@
+from concurrent.futures import wait
+import errno
+import os
+from pathlib import Path
+import threading
+from typing import Callable
+import wave
+
+import pytest
+
+from radioscripts.card import (
+    CardWriter,
+    count_fragments,
+    fallocate,
+    move_file,
+    preallocate,
+    reserve_file,
+    verify,
+)
+from radioscripts.wav import WavWriter
+
+
+def test_reserve_file_keeps_existing_files(tmp_path):
+    assert reserve_file(tmp_path / 'bank', 'station.wav') == (
+        tmp_path / 'bank' / 'station.wav'
+    )
+    assert reserve_file(tmp_path / 'bank', 'station.wav') == (
+        tmp_path / 'bank' / 'station-1.wav'
+    )
+    assert reserve_file(tmp_path / 'bank', 'station.wav') == (
+        tmp_path / 'bank' / 'station-2.wav'
+    )
+
+
+def test_move_file_renames_file(tmp_path):
+    src = tmp_path / 'station.wav.part'
+    src.write_text('station')
+    (tmp_path / 'station.wav').touch()
+    move_file(src, tmp_path / 'station.wav')
+    assert (tmp_path / 'station.wav').read_text() == 'station'
+    assert not src.exists()
+
+
+def test_move_file_copies_file_between_file_systems(tmp_path, monkeypatch):
+    def replace(*_):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    src = tmp_path / 'station.wav.part'
+    src.write_text('station')
+    monkeypatch.setattr(os, 'replace', replace)
+    move_file(src, tmp_path / 'station.wav')
+    assert (tmp_path / 'station.wav').read_text() == 'station'
+    assert not src.exists()
+
+
+@pytest.fixture
+def writer():
+    writer = CardWriter(range(3))
+    yield writer
+    writer.shutdown()
+
+
+def render(text: str) -> Callable[[Path], None]:
+    return lambda path: path.write_text(text)
+
+
+def test_card_writer_writes_files_in_order(tmp_path, writer, monkeypatch):
+    written = []
+    write = writer.write
+
+    def record(render_: Callable[[Path], object], dst: Path, size: int) -> Path:
+        written.append(dst.name)
+        return write(render_, dst, size)
+
+    monkeypatch.setattr(writer, 'write', record)
+    futures = [
+        writer.submit(key, render(str(key)), tmp_path / 'card' / f'{key}.wav', 1)
+        for key in (2, 0, 1)
+    ]
+    wait(futures, timeout=10)
+    writer.shutdown()
+
+    assert written == ['0.wav', '1.wav', '2.wav']
+    assert (tmp_path / 'card' / '2.wav').read_text() == '2'
+    assert sorted(path.name for path in (tmp_path / 'card').iterdir()) == [
+        '0.wav',
+        '1.wav',
+        '2.wav',
+    ]
+
+
+def test_card_writer_goes_on_after_discarded_file(tmp_path, writer):
+    future = writer.submit(1, render('1'), tmp_path / 'card' / '1.wav', 1)
+    assert not future.done()
+    writer.discard(0)
+    assert future.result(timeout=10) == tmp_path / 'card' / '1.wav'
+
+
+def test_card_writer_cancels_waiting_files_on_shutdown(tmp_path, writer):
+    future = writer.submit(1, render('1'), tmp_path / 'card' / '1.wav', 1)
+    writer.shutdown()
+    assert future.cancelled()
+    assert not (tmp_path / 'card').exists()
+
+
+def test_card_writer_removes_failed_files(tmp_path, writer):
+    def fail(path: Path):
+        path.write_text('partly')
+        raise OSError('No space left on device')
+
+    future = writer.submit(0, fail, tmp_path / 'card' / '0.wav', 1)
+    with pytest.raises(OSError):
+        future.result(timeout=10)
+    assert not list((tmp_path / 'card').iterdir())
+
+
+def test_card_writer_aligns_audio_data(tmp_path, writer):
+    def render_station(path: Path):
+        with WavWriter(
+            path, channels=1, sample_rate=44100, bit_depth=16, alignment=4096
+        ) as file:
+            file.write(b'\x01\x02' * 1000)
+
+    (tmp_path / 'card').mkdir()
+    written = writer.submit(
+        0, render_station, tmp_path / 'card' / '0' / 'station.wav', 4096 + 2000
+    )
+    path = written.result(timeout=10)
+    writer.shutdown()
+
+    with wave.open(str(path)) as file:
+        assert file.readframes(-1) == b'\x01\x02' * 1000
+    assert path.stat().st_size == 4096 + 2000
+
+    (layout,) = verify(tmp_path / 'card')
+    assert layout[0] == path
+    assert layout[1] in (None, 1)
+    assert layout[2] == 4096
+
+
+@pytest.mark.parametrize(
+    'extents, expected',
+    [
+        ([], 0),
+        ([(0, 4096)], 1),
+        ([(0, 4096), (4096, 4096)], 1),
+        ([(0, 4096), (8192, 4096)], 2),
+        ([(8192, 4096), (0, 4096), (4096, 10)], 2),
+    ],
+)
+def test_count_fragments(extents, expected):
+    assert count_fragments(extents) == expected
+
+
+@pytest.mark.skipif(fallocate is None, reason='Linux fallocate is not available')
+def test_preallocate_keeps_file_size(tmp_path):
+    path = tmp_path / 'station.wav'
+    with path.open('wb') as file:
+        preallocate(file, 1024**2)
+    assert path.stat().st_size == 0
+    assert path.stat().st_blocks * 512 >= 1024**2
+
+
+def test_card_writer_limits_files_ahead(tmp_path):
+    writer = CardWriter(range(4), ahead=2)
+    ready = []
+
+    def wait_for_room(key: int):
+        writer.wait_for_room(key)
+        ready.append(key)
+
+    writer.wait_for_room(1)
+    waiting = threading.Thread(target=wait_for_room, args=(2,))
+    waiting.start()
+    waiting.join(0.05)
+    assert ready == []
+
+    writer.submit(0, render('0'), tmp_path / '0.wav', 1).result(timeout=10)
+    waiting.join(10)
+    assert ready == [2]
+    writer.shutdown()
+
+
+def test_card_writer_lets_waiting_files_go_on_shutdown(tmp_path):
+    writer = CardWriter(range(4), ahead=1)
+    waiting = threading.Thread(target=writer.wait_for_room, args=(2,))
+    waiting.start()
+    writer.shutdown()
+    waiting.join(10)
+    assert not waiting.is_alive()
+    assert writer.submit(2, render('2'), tmp_path / '2.wav', 1).cancelled()
+    assert not (tmp_path / '2.wav').exists()
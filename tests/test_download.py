@@ -0,0 +1,305 @@
+from email.message import Message
+import http.client
+import io
+import threading
+import urllib.error
+
+import pytest
+
+from conftest import Resource
+from radioscripts import download as download_module
+from radioscripts.download import (
+    DownloadAborted,
+    DownloadError,
+    HTTPClient,
+    download,
+    fetch_range,
+    is_transient,
+    probe_remote,
+    resume_headers,
+    skip_written,
+)
+
+
+CONTENT = bytes(range(256)) * 400
+
+# MPEG 1 layer III 128 kbit/s 44100 Hz frame
+MP3_FRAME = b'\xff\xfb\x90\x00' + bytes(413)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download_module, 'DOWNLOAD_BACKOFF', 0)
+
+
+@pytest.mark.parametrize('ranges', [True, False])
+def test_fetch_range_beginning(serve, ranges):
+    url = serve(Resource(CONTENT, ranges=ranges))
+    assert fetch_range(url, 0, 100) == (CONTENT[:100], len(CONTENT))
+
+
+def test_fetch_range(serve):
+    url = serve(Resource(CONTENT))
+    assert fetch_range(url, 1000, 100) == (CONTENT[1000:1100], len(CONTENT))
+
+
+def test_fetch_range_ignored_by_server(serve):
+    url = serve(Resource(CONTENT, ranges=False))
+    with pytest.raises(DownloadError):
+        fetch_range(url, 1000, 100)
+
+
+def test_fetch_range_past_the_end(serve):
+    url = serve(Resource(CONTENT))
+    assert fetch_range(url, len(CONTENT) - 10, 100) == (CONTENT[-10:], len(CONTENT))
+
+
+def test_probe_remote(serve):
+    resource = Resource(MP3_FRAME * 1000)
+    assert probe_remote(serve(resource)) == (
+        len(resource.content),
+        pytest.approx(len(resource.content) * 8 / 128000),
+    )
+    assert resource.requests[0]['Range'] == 'bytes=0-65535'
+
+
+def test_probe_remote_skips_id3v2_tag(serve):
+    tag = b'ID3\x04\x00\x00\x00\x04\x00\x00' + bytes(65536)
+    resource = Resource(tag + MP3_FRAME * 1000)
+    assert probe_remote(serve(resource)) == (
+        len(resource.content),
+        pytest.approx(len(MP3_FRAME * 1000) * 8 / 128000),
+    )
+    assert resource.requests[1]['Range'] == f'bytes={len(tag)}-{len(tag) + 65535}'
+
+
+def test_probe_remote_of_unknown_file(serve):
+    assert probe_remote(serve(Resource(CONTENT))) == (len(CONTENT), None)
+
+
+def test_probe_remote_of_unavailable_file():
+    assert probe_remote('http://127.0.0.1:9/sample.mp3') == (None, None)
+
+
+def test_client_reuses_connections(serve):
+    resource = Resource(CONTENT)
+    url = serve(resource)
+    client = HTTPClient()
+    for _ in range(3):
+        with client.request(url) as response:
+            assert response.read() == CONTENT
+    assert len(set(resource.clients)) == 1
+
+
+def test_client_does_not_reuse_partially_read_connections(serve):
+    resource = Resource(CONTENT)
+    url = serve(resource)
+    client = HTTPClient()
+    for _ in range(2):
+        with client.request(url) as response:
+            response.read(10)
+    assert len(set(resource.clients)) == 2
+
+
+def test_client_follows_redirects(serve):
+    resource = Resource(CONTENT)
+    url = serve(resource)
+    with HTTPClient().request(serve(Resource(b'', location=url))) as response:
+        assert response.read() == CONTENT
+
+
+def test_client_sends_user_agent(serve):
+    resource = Resource(CONTENT)
+    with HTTPClient().request(serve(resource)) as response:
+        response.read()
+    assert resource.requests[0]['User-Agent'].startswith('radioscripts/')
+
+
+def test_client_sends_requests_through_proxy(serve):
+    resource = Resource(CONTENT)
+    client = HTTPClient(proxies={'http': serve(resource)})
+    with client.request('http://radio.invalid/sample.mp3?id=1') as response:
+        assert response.read() == CONTENT
+    assert resource.paths == ['http://radio.invalid/sample.mp3?id=1']
+
+
+def test_client_bypasses_proxy(serve, monkeypatch):
+    monkeypatch.setenv('no_proxy', '127.0.0.1')
+    resource = Resource(CONTENT)
+    url = serve(resource)
+    client = HTTPClient(proxies={'http': 'http://proxy.invalid:3128'})
+    with client.request(url) as response:
+        assert response.read() == CONTENT
+    assert resource.paths == ['/sample.mp3']
+
+
+def test_client_limits_connections_per_host():
+    client = HTTPClient(connections_per_host=2)
+    client.connections_per_host = 1
+    limit = client.host_limit(('http', 'radio.invalid'))
+    assert limit.acquire(blocking=False)
+    assert not limit.acquire(blocking=False)
+
+
+def test_client_raises_error_statuses(serve):
+    with pytest.raises(urllib.error.HTTPError) as exc_info:
+        with HTTPClient().request(serve(Resource(CONTENT, 404))):
+            pass
+    assert exc_info.value.code == 404
+
+
+@pytest.mark.parametrize('validator', ['ETag', 'Last-Modified'])
+@pytest.mark.parametrize('ranges', [True, False])
+def test_download_resumes(serve, ranges, validator):
+    resource = Resource(CONTENT, 'drop', 'drop', ranges=ranges, validator=validator)
+    file = io.BytesIO()
+
+    headers = download(serve(resource), file)
+
+    assert file.getvalue() == CONTENT
+    assert headers[validator] == resource.version
+    assert len(resource.requests) == 3
+    assert 'Range' not in resource.requests[0]
+    assert resource.requests[1]['Range'] == f'bytes={len(CONTENT) // 2}-'
+    assert resource.requests[1]['If-Range'] == resource.version
+
+
+def test_download_fails_when_resource_changes(serve):
+    resource = Resource(CONTENT, 'drop')
+    url = serve(resource)
+    file = io.BytesIO()
+
+    class ChangingFile(io.BytesIO):
+        def write(self, data):
+            resource.change(CONTENT[::-1])
+            return file.write(data)
+
+    with pytest.raises(DownloadError) as info:
+        download(url, ChangingFile())
+    assert 'changed' in str(info.value.__cause__)
+    assert len(resource.requests) == 2
+    assert file.getvalue() == CONTENT[: len(CONTENT) // 2]
+
+
+@pytest.mark.parametrize(
+    'actions, requests',
+    [
+        ((503, 'drop', 429), 4),
+        ((500,), 2),
+    ],
+)
+def test_download_retries_transient_errors(serve, actions, requests):
+    resource = Resource(CONTENT, *actions)
+    file = io.BytesIO()
+    download(serve(resource), file)
+    assert file.getvalue() == CONTENT
+    assert len(resource.requests) == requests
+
+
+@pytest.mark.parametrize(
+    'actions, requests',
+    [
+        ((404,), 1),
+        ((403, 'ok'), 1),
+        (('drop',) * 10, download_module.DOWNLOAD_ATTEMPTS),
+        ((503,) * 10, download_module.DOWNLOAD_ATTEMPTS),
+    ],
+)
+def test_download_gives_up(serve, actions, requests):
+    resource = Resource(CONTENT, *actions)
+    with pytest.raises(DownloadError):
+        download(serve(resource), io.BytesIO())
+    assert len(resource.requests) == requests
+
+
+def test_download_not_modified(serve):
+    resource = Resource(CONTENT)
+    file = io.BytesIO()
+    assert download(serve(resource), file, headers={'If-None-Match': '"1"'}) is None
+    assert file.getvalue() == b''
+
+
+def test_download_aborted(serve):
+    abort = threading.Event()
+    abort.set()
+    resource = Resource(CONTENT)
+    with pytest.raises(DownloadAborted):
+        download(serve(resource), io.BytesIO(), abort=abort)
+    assert len(resource.requests) == 1
+
+
+def message(**headers: str) -> Message:
+    result = Message()
+    for name, value in headers.items():
+        result[name.replace('_', '-')] = value
+    return result
+
+
+class Response(io.BytesIO):
+    def __init__(self, content: bytes, headers: Message):
+        super().__init__(content)
+        self.headers = headers
+
+
+@pytest.mark.parametrize(
+    'first, expected',
+    [
+        (message(ETag='"1"'), {'Range': 'bytes=10-', 'If-Range': '"1"'}),
+        (
+            message(Last_Modified='Wed, 21 Oct 2015 07:28:00 GMT'),
+            {'Range': 'bytes=10-', 'If-Range': 'Wed, 21 Oct 2015 07:28:00 GMT'},
+        ),
+        (
+            message(ETag='"1"', Last_Modified='Wed, 21 Oct 2015 07:28:00 GMT'),
+            {'Range': 'bytes=10-', 'If-Range': '"1"'},
+        ),
+        (message(), {'Range': 'bytes=10-'}),
+    ],
+)
+def test_resume_headers(first, expected):
+    assert resume_headers(first, 10) == expected
+
+
+@pytest.mark.parametrize(
+    'first, again, written, error',
+    [
+        (message(ETag='"1"'), message(ETag='"1"'), 1000, False),
+        (message(ETag='"1"'), message(ETag='"1"'), 0, False),
+        (message(), message(), len(CONTENT), False),
+        (message(ETag='"1"'), message(ETag='"2"'), 1000, True),
+        (message(ETag='"1"'), message(), 1000, True),
+        (message(Last_Modified='Mon'), message(Last_Modified='Tue'), 1000, True),
+    ],
+)
+def test_skip_written(first, again, written, error):
+    response = Response(CONTENT, again)
+    if error:
+        with pytest.raises(DownloadError):
+            skip_written('url', response, first, written)
+    else:
+        skip_written('url', response, first, written)
+        assert response.read() == CONTENT[written:]
+
+
+def http_error(code: int) -> urllib.error.HTTPError:
+    return urllib.error.HTTPError('url', code, 'reason', Message(), None)
+
+
+@pytest.mark.parametrize(
+    'exc, expected',
+    [
+        (http_error(500), True),
+        (http_error(503), True),
+        (http_error(429), True),
+        (http_error(404), False),
+        (http_error(403), False),
+        (ConnectionResetError(), True),
+        (TimeoutError(), True),
+        (http.client.IncompleteRead(b''), True),
+        (DownloadError(), False),
+        (BrokenPipeError(), False),
+        (ValueError(), False),
+    ],
+)
+def test_is_transient(exc, expected):
+    assert is_transient(exc) == expected
@@ -0,0 +1,66 @@
+import pytest
+
+from radioscripts.index import CatalogIndex
+
+
+class Catalog:
+    """Catalog returning predefined links and counting scrapes."""
+
+    def __init__(self):
+        self.pages = {'section': ['a.mp3', 'b.mp3']}
+        self.scrapes: list[str] = []
+
+    def sections(self) -> list[str]:
+        self.scrapes.append('start')
+        return list(self.pages)
+
+    def sounds(self, url: str) -> list[str]:
+        self.scrapes.append(url)
+        if url not in self.pages:
+            raise OSError('not found')
+        return self.pages[url]
+
+    def __str__(self):
+        return 'catalog'
+
+
+@pytest.fixture
+def catalog():
+    return Catalog()
+
+
+def test_index_keeps_scraped_links(tmp_path, catalog):
+    index = CatalogIndex(catalog, tmp_path / 'index.sqlite3', max_age=60)
+    assert index.sections() == ['section']
+    assert index.sounds('section') == ['a.mp3', 'b.mp3']
+
+    reopened = CatalogIndex(catalog, tmp_path / 'index.sqlite3', max_age=60)
+    assert reopened.sections() == ['section']
+    assert reopened.sounds('section') == ['a.mp3', 'b.mp3']
+    assert catalog.scrapes == ['start', 'section']
+
+
+def test_index_scrapes_outdated_pages_again(tmp_path, catalog):
+    index = CatalogIndex(catalog, tmp_path / 'index.sqlite3', max_age=0)
+    index.sounds('section')
+    catalog.pages['section'] = ['c.mp3']
+    assert index.sounds('section') == ['c.mp3']
+    assert catalog.scrapes == ['section', 'section']
+
+
+def test_index_falls_back_to_outdated_pages(tmp_path, catalog):
+    index = CatalogIndex(catalog, tmp_path / 'index.sqlite3', max_age=0)
+    index.sounds('section')
+    del catalog.pages['section']
+    assert index.sounds('section') == ['a.mp3', 'b.mp3']
+    with pytest.raises(OSError):
+        index.sounds('missing')
+
+
+def test_index_remembers_sounds(tmp_path, catalog):
+    index = CatalogIndex(catalog, tmp_path / 'index.sqlite3', max_age=60)
+    assert index.sound('a.mp3') == (None, None)
+    index.remember('a.mp3', size=1000)
+    index.remember('a.mp3', duration=2.5)
+    index.remember('a.mp3')
+    assert index.sound('a.mp3') == (1000, 2.5)
@@ -0,0 +1,130 @@
+from itertools import combinations
+import math
+import random
+
+import pytest
+
+from radioscripts.planner import DEFAULT_BYTE_RATE, Candidate, byte_rate, pack, plan
+
+
+def candidates(*durations: float, sizes=None, sections=None) -> list[Candidate]:
+    """Returns candidates named by their indices."""
+    sizes = sizes or [round(duration * 1000) for duration in durations]
+    sections = sections or [0] * len(durations)
+    return [
+        Candidate(str(index), section, size, duration)
+        for index, (duration, size, section) in enumerate(
+            zip(durations, sizes, sections)
+        )
+    ]
+
+
+def urls(chosen: list[Candidate]) -> list[str]:
+    return [candidate.url for candidate in chosen]
+
+
+@pytest.mark.parametrize(
+    'available, capacity, expected',
+    [
+        (candidates(10, 20, 30), 50, ['1', '2']),
+        (candidates(10, 20, 30), 60, ['0', '1', '2']),
+        (candidates(10, 20, 30), 100, ['0', '1', '2']),
+        (candidates(10, 20, 30), 5, []),
+        (candidates(), 100, []),
+        # the capacity can't be filled exactly
+        (candidates(7, 8), 10, ['1']),
+        (candidates(7, 8, 4), 12, ['1', '2']),
+        # durations are rounded up
+        (candidates(9.5, 10.5), 20, ['1']),
+        (candidates(9.5, 10.5), 20.9, ['1']),
+        (candidates(9.5, 10.5), 21, ['0', '1']),
+        # the least bytes among equal fillings
+        (candidates(10, 10, 20, sizes=[1, 100, 50]), 20, ['2']),
+        (candidates(10, 10, 20, sizes=[1, 10, 50]), 20, ['0', '1']),
+        (candidates(5, 5, 5, sizes=[3, 1, 2]), 10, ['1', '2']),
+        # an item taken early in the table is left out on the way back
+        (candidates(3, 4, 5, 6, sizes=[1, 1, 1, 100]), 9, ['1', '2']),
+        (candidates(3, 3, 3, 6, sizes=[5, 5, 5, 1]), 9, ['0', '3']),
+    ],
+)
+def test_pack(available, capacity, expected):
+    assert urls(pack(available, capacity)) == expected
+
+
+def best_packing(available: list[Candidate], capacity: float) -> tuple[int, int]:
+    """Returns the filling and size of the best packing by brute force."""
+    return max(
+        (
+            sum(math.ceil(candidate.duration) for candidate in chosen),
+            -sum(candidate.size for candidate in chosen),
+        )
+        for number in range(len(available) + 1)
+        for chosen in combinations(available, number)
+        if sum(math.ceil(candidate.duration) for candidate in chosen) <= capacity
+    )
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_pack_matches_brute_force(seed):
+    rng = random.Random(seed)
+    durations = [rng.uniform(1, 60) for _ in range(rng.randint(1, 10))]
+    sizes = [rng.randint(1, 10**6) for _ in durations]
+    available = candidates(*durations, sizes=sizes)
+    capacity = rng.uniform(0, sum(durations))
+
+    chosen = pack(available, capacity)
+
+    assert len(set(urls(chosen))) == len(chosen)
+    filled = sum(math.ceil(candidate.duration) for candidate in chosen)
+    size = sum(candidate.size for candidate in chosen)
+    assert (filled, -size) == best_packing(available, capacity)
+
+
+def test_plan_takes_candidate_from_each_section():
+    # the long candidates of the first section would fill the capacity alone
+    available = candidates(
+        50, 50, 10, 10, 10, sizes=[1, 1, 100, 100, 100], sections=[0, 0, 1, 2, 2]
+    )
+    chosen = plan(available, 100, sections=3)
+    assert sorted(candidate.section for candidate in chosen) == [0, 1, 2, 2]
+    assert sum(candidate.duration for candidate in chosen) <= 100
+
+
+def test_plan_skips_seeds_longer_than_share():
+    available = candidates(60, 10, sections=[0, 1])
+    chosen = plan(available, 60, sections=2)
+    assert urls(chosen) == ['1']
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_plan_fits_capacity(seed):
+    rng = random.Random(seed)
+    durations = [rng.uniform(1, 300) for _ in range(30)]
+    sections = [rng.randrange(4) for _ in durations]
+    available = candidates(*durations, sections=sections)
+    capacity = rng.uniform(300, 3000)
+
+    chosen = plan(available, capacity, sections=4)
+
+    assert len(set(urls(chosen))) == len(chosen)
+    assert sum(candidate.duration for candidate in chosen) <= capacity
+    share = capacity / 4
+    for section in range(4):
+        if any(
+            candidate.section == section and candidate.duration < share
+            for candidate in available
+        ):
+            assert any(candidate.section == section for candidate in chosen)
+
+
+@pytest.mark.parametrize(
+    'descriptions, expected',
+    [
+        ([(1000, 1.0), (5000, 3.0)], 1500),
+        ([(1000, 1.0), (None, 3.0), (0, 5.0), (None, None)], 1000),
+        ([(None, 3.0), (0, 5.0)], DEFAULT_BYTE_RATE),
+        ([], DEFAULT_BYTE_RATE),
+    ],
+)
+def test_byte_rate(descriptions, expected):
+    assert byte_rate(descriptions) == expected
@@ -0,0 +1,273 @@
+from pathlib import Path
+import struct
+from typing import Optional
+
+import pytest
+
+from radioscripts.probe import (
+    FrameHeader,
+    find_frame,
+    id3v2_size,
+    mp3_duration,
+    mp3_frames,
+    parse_frame_header,
+    probe_duration,
+    vbr_frames,
+    wav_data_chunk,
+    wav_duration,
+)
+
+
+VERSION_BITS = {1: 0b11, 2: 0b10, 2.5: 0b00}
+
+
+def frame_header(
+    version: float = 1,
+    layer: int = 3,
+    bitrate_index: int = 9,
+    sample_rate_index: int = 0,
+    *,
+    padding: bool = False,
+    mono: bool = False,
+) -> bytes:
+    """Returns MPEG audio frame header without CRC."""
+    word = (
+        0x7FF << 21
+        | VERSION_BITS[version] << 19
+        | (4 - layer) << 17
+        | 1 << 16
+        | bitrate_index << 12
+        | sample_rate_index << 10
+        | padding << 9
+        | (0b11 if mono else 0b00) << 6
+    )
+    return struct.pack('>I', word)
+
+
+def frame(*args, tag: bytes = b'', vbri: bool = False, **kwargs) -> bytes:
+    """Returns whole MPEG audio frame with provided tag after its side
+    information, or 32 bytes after the header for VBRI tag.
+    """
+    header = frame_header(*args, **kwargs)
+    parsed = parse_frame_header(header)
+    body = bytes(32 if vbri else parsed.side_info_size) + tag
+    return header + body + bytes(parsed.length - len(header) - len(body))
+
+
+def xing_tag(frames: Optional[int], name: bytes = b'Xing') -> bytes:
+    if frames is None:
+        return name + struct.pack('>I', 0)
+    return name + struct.pack('>II', 1, frames)
+
+
+def vbri_tag(frames: int) -> bytes:
+    return b'VBRI' + bytes(10) + struct.pack('>I', frames)
+
+
+@pytest.mark.parametrize(
+    'data, expected',
+    [
+        # MPEG 1 layer III 128 kbit/s 44100 Hz stereo
+        (b'\xff\xfb\x90\x00', FrameHeader(1, 3, 128000, 44100, False, False)),
+        # the same with padding and mono
+        (b'\xff\xfb\x92\xc0', FrameHeader(1, 3, 128000, 44100, True, True)),
+        # MPEG 2 layer III 64 kbit/s 22050 Hz
+        (b'\xff\xf3\x80\x00', FrameHeader(2, 3, 64000, 22050, False, False)),
+        # MPEG 2.5 layer III 8 kbit/s 12000 Hz
+        (b'\xff\xe3\x14\x00', FrameHeader(2.5, 3, 8000, 12000, False, False)),
+        # MPEG 1 layer I 384 kbit/s 32000 Hz
+        (b'\xff\xff\xc8\x00', FrameHeader(1, 1, 384000, 32000, False, False)),
+        # MPEG 1 layer II 192 kbit/s 48000 Hz
+        (b'\xff\xfd\xa4\x00', FrameHeader(1, 2, 192000, 48000, False, False)),
+        (b'\x00\xfb\x90\x00', None),  # no frame sync
+        (b'\xff\xfb\x90', None),  # too short
+        (b'\xff\xeb\x90\x00', None),  # reserved version
+        (b'\xff\xf9\x90\x00', None),  # reserved layer
+        (b'\xff\xfb\x00\x00', None),  # free format bitrate
+        (b'\xff\xfb\xf0\x00', None),  # bad bitrate
+        (b'\xff\xfb\x9c\x00', None),  # reserved sample rate
+    ],
+)
+def test_parse_frame_header(data, expected):
+    assert parse_frame_header(data) == expected
+
+
+@pytest.mark.parametrize(
+    'header, samples, length, side_info_size',
+    [
+        (frame_header(1, 3, 9, 0), 1152, 417, 32),
+        (frame_header(1, 3, 9, 0, padding=True), 1152, 418, 32),
+        (frame_header(1, 3, 9, 0, mono=True), 1152, 417, 17),
+        (frame_header(2, 3, 8, 0), 576, 208, 17),
+        (frame_header(2, 3, 8, 0, mono=True), 576, 208, 9),
+        (frame_header(1, 1, 12, 0), 384, 416, 32),
+        (frame_header(1, 1, 12, 0, padding=True), 384, 420, 32),
+        (frame_header(1, 2, 10, 1), 1152, 576, 32),
+    ],
+)
+def test_frame_header_properties(header, samples, length, side_info_size):
+    parsed = parse_frame_header(header)
+    assert parsed.samples == samples
+    assert parsed.length == length
+    assert parsed.side_info_size == side_info_size
+
+
+def test_find_frame_skips_false_sync():
+    mp3 = frame() * 3
+    # a valid header which is not followed by another frame
+    data = b'junk' + frame_header() + b'\x00' * 500 + mp3
+    offset, header = find_frame(data)
+    assert offset == 4 + 4 + 500
+    assert header == parse_frame_header(mp3)
+
+
+def test_find_frame_trusts_frame_at_the_end_of_data():
+    data = b'junk' + frame()[:100]
+    assert find_frame(data) == (4, parse_frame_header(frame()))
+
+
+def test_find_frame_without_frames():
+    assert find_frame(b'\xff' * 10 + bytes(100)) is None
+
+
+@pytest.mark.parametrize(
+    'data, expected',
+    [
+        (b'ID3\x04\x00\x00\x00\x00\x02\x01', 10 + 257),
+        (b'ID3\x04\x00\x10\x00\x00\x02\x01', 10 + 257 + 10),  # with footer
+        (b'ID3\x04\x00\x00\x7f\x7f\x7f\x7f', 10 + 2**28 - 1),
+        (b'ID3\x04\x00\x00\x00\x00', 0),  # too short
+        (b'\xff\xfb\x90\x00' + bytes(6), 0),
+    ],
+)
+def test_id3v2_size(data, expected):
+    assert id3v2_size(data) == expected
+
+
+@pytest.mark.parametrize(
+    'data, expected',
+    [
+        (frame(tag=xing_tag(1000)), 1000),
+        (frame(tag=xing_tag(1000, b'Info')), 1000),
+        (frame(mono=True, tag=xing_tag(1000)), 1000),
+        (frame(2, 3, 8, 0, tag=xing_tag(500)), 500),
+        (frame(tag=xing_tag(None)), None),  # no frames number
+        (frame(tag=vbri_tag(2000), vbri=True), 2000),
+        (frame(2, 3, 8, 0, tag=vbri_tag(2000), vbri=True), 2000),
+        (frame(), None),
+        (frame()[:40] + b'Xing', None),  # cut tag
+    ],
+)
+def test_vbr_frames(data, expected):
+    offset, header = find_frame(data)
+    assert vbr_frames(data, offset, header) == expected
+
+
+@pytest.mark.parametrize(
+    'data, size, expected',
+    [
+        # constant bitrate, 128 kbit/s
+        (frame() * 4, 16000, 1.0),
+        (b'junk' + frame() * 4, 16004, 1.0),
+        # variable bitrate, frames of 1152 samples at 44100 Hz
+        (frame(tag=xing_tag(441)) + frame() * 3, 10**6, 441 * 1152 / 44100),
+        (frame(2, 3, 8, 0, tag=vbri_tag(245), vbri=True), 10**6, 245 * 576 / 22050),
+        (bytes(1000), 1000, None),
+    ],
+)
+def test_mp3_duration(data, size, expected):
+    assert mp3_duration(data, size) == pytest.approx(expected)
+
+
+FRAME_DURATION = 1152 / 44100
+
+
+@pytest.mark.parametrize(
+    'data, max_duration, expected',
+    [
+        (frame() * 3, 1, (0, 417 * 3, FRAME_DURATION * 3)),
+        (b'junk' + frame() * 3, 1, (4, 4 + 417 * 3, FRAME_DURATION * 3)),
+        # the cut frame at the end is left out
+        (
+            b'junk' + frame() * 3 + frame()[:100],
+            1,
+            (4, 4 + 417 * 3, FRAME_DURATION * 3),
+        ),
+        # frames are taken while their duration is shorter
+        (frame() * 3, FRAME_DURATION * 2.5, (0, 417 * 2, FRAME_DURATION * 2)),
+        (frame() * 3, FRAME_DURATION * 2, (0, 417, FRAME_DURATION)),
+        (frame()[:100], 1, None),
+        (bytes(1000), 1, None),
+    ],
+)
+def test_mp3_frames(data, max_duration, expected):
+    result = mp3_frames(data, max_duration)
+    if expected is None:
+        assert result is None
+    else:
+        start, end, duration = result
+        assert (start, end) == expected[:2]
+        assert duration == pytest.approx(expected[2])
+
+
+def wav(
+    *chunks: tuple[bytes, bytes], byte_rate: int = 88200, data_size: int = 1000
+) -> bytes:
+    """Returns RIFF WAVE header with provided chunks before audio data."""
+    fmt = struct.pack('<HHIIHH', 1, 1, byte_rate // 2, byte_rate, 2, 16)
+    body = b''.join(
+        chunk_id + struct.pack('<I', len(data)) + data + bytes(len(data) % 2)
+        for chunk_id, data in ((b'fmt ', fmt), *chunks)
+    )
+    body += b'data' + struct.pack('<I', data_size)
+    riff_size = min(4 + len(body) + data_size, 0xFFFFFFFF)
+    return b'RIFF' + struct.pack('<I', riff_size) + b'WAVE' + body
+
+
+@pytest.mark.parametrize(
+    'data, expected',
+    [
+        (wav(), (88200, 44, 1000)),
+        (wav((b'LIST', b'INFOtest')), (88200, 60, 1000)),
+        (wav((b'LIST', b'odd')), (88200, 56, 1000)),  # chunks are word aligned
+        (wav(byte_rate=44100, data_size=0), (44100, 44, 0)),
+        (wav()[:40], None),  # no data chunk yet
+        (b'RIFF' + bytes(4) + b'WAVEdata' + bytes(4), None),  # no format
+        (b'RIFX' + wav()[4:], None),
+        (b'RIFF', None),
+    ],
+)
+def test_wav_data_chunk(data, expected):
+    assert wav_data_chunk(data) == expected
+
+
+@pytest.mark.parametrize(
+    'data, size, expected',
+    [
+        (wav(data_size=88200), 44 + 88200, 1.0),
+        # streamed files have unknown or wrong data size
+        (wav(data_size=0), 44 + 44100, 0.5),
+        (wav(data_size=0xFFFFFFFF), 44 + 44100, 0.5),
+        (wav(data_size=88200), 44 + 44100, 0.5),
+        (bytes(44), 1000, None),
+    ],
+)
+def test_wav_duration(data, size, expected):
+    assert wav_duration(data, size) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize(
+    'content, expected',
+    [
+        (wav(data_size=88200) + bytes(88200), 1.0),
+        (
+            b'ID3\x04\x00\x00\x00\x00\x00\x10' + bytes(16) + frame() * 4,
+            4 * 417 * 8 / 128000,
+        ),
+        (bytes(1000), None),
+    ],
+)
+def test_probe_duration(tmp_path: Path, content, expected):
+    path = tmp_path / 'sample'
+    path.write_bytes(content)
+    assert probe_duration(path) == pytest.approx(expected)
@@ -0,0 +1,313 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import io
+import math
+from pathlib import Path
+import shutil
+import struct
+import subprocess
+import wave
+
+import pytest
+
+from radioscripts import program
+from radioscripts.program import (
+    crossfade,
+    crossfade_peak,
+    fade_out,
+    fit_length,
+    known_peaks,
+    make_radio_program,
+    open_mastering,
+    splice_streams,
+)
+from radioscripts.probe import PROBE_SIZE, wav_data_chunk
+
+
+def pcm(*values: int) -> bytes:
+    return array('h', values).tobytes()
+
+
+def samples(data: bytes) -> list[int]:
+    return list(array('h', data))
+
+
+def test_crossfade_fades_tail_out_and_head_in():
+    mixed = samples(
+        crossfade(pcm(*[1000] * 8), pcm(*[0] * 8), channels=1, bit_depth=16)
+    )
+    assert mixed == sorted(mixed, reverse=True)
+    assert mixed[0] > 990 and mixed[-1] < 100
+
+
+def test_crossfade_keeps_power_of_uncorrelated_signals():
+    tail = pcm(*[10000] * 100)
+    mixed = samples(crossfade(tail, tail, channels=1, bit_depth=16))
+    assert max(mixed) == pytest.approx(10000 * 2**0.5, rel=0.01)
+
+
+def test_crossfade_clips_to_sample_range():
+    loud = pcm(*[32767] * 10)
+    assert max(samples(crossfade(loud, loud, channels=1, bit_depth=16))) == 32767
+
+
+def test_crossfade_fades_channels_of_a_frame_together():
+    mixed = samples(
+        crossfade(pcm(*[1000] * 8), pcm(*[0] * 8), channels=2, bit_depth=16)
+    )
+    assert mixed[0::2] == mixed[1::2]
+
+
+@pytest.mark.parametrize(
+    'lengths, crossfade_frames, expected_length',
+    [
+        ([10, 10, 10], 0, 30),
+        ([10, 10, 10], 2, 26),
+        ([10, 1, 10], 2, 19),  # shorter stream is mixed only as much as it lasts
+        ([10, 0, 10], 2, 18),
+        ([], 2, 0),
+    ],
+)
+def test_splice_streams_overlaps_by_crossfade(
+    lengths, crossfade_frames, expected_length
+):
+    output = io.BytesIO()
+    splice_streams(
+        [io.BytesIO(pcm(*[100] * length)) for length in lengths],
+        output,
+        crossfade_duration=crossfade_frames / 10,
+        channels=1,
+        sample_rate=10,
+        bit_depth=16,
+    )
+    assert len(output.getvalue()) == expected_length * 2
+
+
+def test_splice_streams_passes_through_parts_outside_of_crossfades():
+    output = io.BytesIO()
+    splice_streams(
+        [io.BytesIO(pcm(*range(1, 11))), io.BytesIO(pcm(*range(101, 111)))],
+        output,
+        crossfade_duration=0.2,
+        channels=1,
+        sample_rate=10,
+        bit_depth=16,
+    )
+    spliced = samples(output.getvalue())
+    assert spliced[:8] == list(range(1, 9))
+    assert spliced[10:] == list(range(103, 111))
+
+
+@pytest.mark.parametrize(
+    'data, frames, expected',
+    [
+        (pcm(100, 100, 100, 100), 4, pcm(100, 100, 100, 100)),
+        (pcm(100, 100), 4, pcm(100, 100, 0, 0)),
+        (pcm(100, 100, 100, 100), 3, pcm(100, 100, 50)),  # cut audio fades out
+        (pcm(100, 100, 100, 100), 0, b''),
+    ],
+)
+def test_fit_length(tmp_path, data, frames, expected):
+    path = tmp_path / 'station.wav'
+    with wave.open(str(path), 'wb') as file:
+        # pylint: disable=no-member
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(44100)
+        file.writeframes(data)
+    fit_length(path, frames=frames, channels=1, bit_depth=16, fade_frames=2)
+    with wave.open(str(path)) as file:
+        assert file.readframes(-1) == expected
+    assert path.stat().st_size == 44 + len(expected)
+
+
+@pytest.mark.parametrize('frames', [1, 3])
+def test_fit_length_keeps_trailing_chunks(tmp_path, frames):
+    path = tmp_path / 'station.wav'
+    with wave.open(str(path), 'wb') as file:
+        # pylint: disable=no-member
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(44100)
+        file.writeframes(pcm(100, 100))
+    chunks = b'LIST' + struct.pack('<I', 4) + b'INFO'
+    with path.open('ab') as file:
+        file.write(chunks)
+    fit_length(path, frames=frames, channels=1, bit_depth=16, fade_frames=0)
+    with wave.open(str(path)) as file:
+        assert file.getnframes() == frames
+    content = path.read_bytes()
+    assert content.endswith(chunks)
+    assert struct.unpack('<I', content[4:8])[0] == len(content) - 8
+
+
+def test_fade_out_keeps_channels_together():
+    faded = samples(fade_out(pcm(100, -100, 100, -100), channels=2, bit_depth=16))
+    assert faded == [100, -100, 50, -50]
+
+
+def test_crossfade_peak_matches_crossfade():
+    tail = [5000, -1000, 7500, 10000, 2500, 0, -15000, 12500]
+    head = [10000, 10000, -7500, 1500, 15000, 16000, 500, 15000]
+    mixed = samples(crossfade(pcm(*tail), pcm(*head), channels=2, bit_depth=16))
+    peak = crossfade_peak(
+        array('d', (s / 32768 for s in tail)),
+        array('d', (s / 32768 for s in head)),
+        channels=2,
+    )
+    assert peak == pytest.approx(max(map(abs, mixed)) / 32768, abs=1 / 32768)
+
+
+def test_crossfade_peak_is_not_clipped():
+    loud = array('d', [1.0] * 10)
+    assert crossfade_peak(loud, loud, channels=1) > 1.4
+
+
+def test_crossfade_peak_overlaps_by_shorter_piece():
+    tail = array('d', [0.0] * 8 + [0.5, 0.5])
+    head = array('d', [0.5, 0.5])
+    assert crossfade_peak(tail, head, channels=1) == pytest.approx(
+        crossfade_peak(head, head, channels=1)
+    )
+
+
+@pytest.mark.parametrize(
+    'durations, duration, expected',
+    [
+        ([100] * 6, 300, [[0, 1, 2], [3, 4, 5]]),
+        ([100] * 6, 1000, [[0, 1, 2, 3, 4, 5]]),
+        ([100] * 3, 10, [[0], [1], [2]]),
+        ([500, 50, 50, 50], 300, [[0], [1], [2, 3]]),
+    ],
+)
+def test_split_evenly(monkeypatch, durations, duration, expected):
+    paths = [Path(f'{index}.wav') for index in range(len(durations))]
+    monkeypatch.setattr(
+        program,
+        'measure_durations',
+        lambda *paths_: [durations[int(path.stem)] for path in paths_],
+    )
+    groups = program.split_evenly(paths, duration)
+    assert [[int(path.stem) for path in group] for group in groups] == expected
+
+
+def test_make_radio_program_leaves_samples_to_the_engine(tmp_path, monkeypatch):
+    engine_calls = []
+    monkeypatch.setitem(
+        program.engines,
+        'pipe',
+        lambda input_paths, output_path, **kwargs: engine_calls.append(
+            (list(input_paths), kwargs['converted'])
+        ),
+    )
+    input_paths = [tmp_path / '1.mp3', tmp_path / '2.mp3']
+    with ThreadPoolExecutor(2) as executor:
+        make_radio_program(
+            input_paths, tmp_path / 'station.wav', engine='pipe', executor=executor
+        )
+    assert engine_calls == [(input_paths, False)]
+
+
+def test_make_radio_program_writes_aligned_wav_of_duration(tmp_path, monkeypatch):
+    monkeypatch.setitem(
+        program.engines,
+        'pipe',
+        lambda input_paths, output, **_: output.write(pcm(100, 200)),
+    )
+    path = tmp_path / 'station.wav'
+    make_radio_program(
+        [tmp_path / '1.mp3'],
+        path,
+        engine='pipe',
+        channels=1,
+        duration=3 / 44100,
+        alignment=4096,
+    )
+    with path.open('rb') as file:
+        assert wav_data_chunk(file.read(PROBE_SIZE))[1:] == (4096, 6)
+    with wave.open(str(path)) as file:
+        assert file.readframes(-1) == pcm(100, 200, 0)
+
+
+@pytest.fixture
+def fake_mastering(monkeypatch):
+    """Replaces sox mastering with passing audio through."""
+
+    @contextlib.contextmanager
+    def open_sox(*_, stdin, stdout):
+        with subprocess.Popen(['cat'], stdin=stdin, stdout=stdout) as proc:
+            yield proc
+
+    monkeypatch.setattr(program, 'open_sox', open_sox)
+
+
+def test_open_mastering_writes_program_to_output(fake_mastering):
+    output = io.BytesIO()
+    with open_mastering(output, channels=1, sample_rate=44100, bit_depth=16) as stream:
+        for _ in range(100):
+            stream.write(pcm(*range(1000)))
+    assert output.getvalue() == pcm(*range(1000)) * 100
+
+
+def test_open_mastering_fails_with_output(fake_mastering):
+    class Full(io.BytesIO):
+        def write(self, data):
+            raise OSError(28, 'No space left on device')
+
+    with pytest.raises(OSError, match='No space'):
+        with open_mastering(
+            Full(), channels=1, sample_rate=44100, bit_depth=16
+        ) as stream:
+            for _ in range(1000):
+                stream.write(pcm(*range(1000)))
+
+
+def test_known_peaks_take_unknown_sounds_at_full_scale():
+    paths = [Path('1.wav'), Path('2.wav')]
+    assert known_peaks(paths, {paths[1]: 0.5}) == [1.0, 0.5]
+    assert known_peaks(paths, None) == [1.0, 1.0]
+
+
+def write_tone(path: Path, frequency: float, duration: float):
+    frames = round(duration * 44100)
+    with wave.open(str(path), 'wb') as file:
+        # pylint: disable=no-member
+        file.setnchannels(2)
+        file.setsampwidth(2)
+        file.setframerate(44100)
+        file.writeframes(
+            array(
+                'h',
+                (
+                    round(16000 * math.sin(2 * math.pi * frequency * index / 44100))
+                    for index in range(frames)
+                    for _ in range(2)
+                ),
+            ).tobytes()
+        )
+
+
+@pytest.mark.skipif(shutil.which('sox') is None, reason='sox is not installed')
+def test_segments_engine_matches_staging_engine(tmp_path, monkeypatch):
+    # every sample is a part of its own, so that every seam is stitched
+    monkeypatch.setattr(program, 'SEGMENT_DURATION', 1)
+    paths = []
+    for index, frequency in enumerate((220, 330, 440, 550)):
+        paths.append(tmp_path / f'{index}.wav')
+        write_tone(paths[-1], frequency, 3)
+    rendered = []
+    for engine in ('staging', 'segments'):
+        path = tmp_path / f'{engine}.wav'
+        make_radio_program(paths, path, engine=engine, crossfade_duration=0.5)
+        with wave.open(str(path)) as file:
+            rendered.append(array('h', file.readframes(-1)))
+    staged, segmented = rendered
+
+    # a frame per seam may be rounded differently
+    assert abs(len(staged) - len(segmented)) <= 2 * 3
+    length = min(len(staged), len(segmented))
+    difference = sum((a - b) ** 2 for a, b in zip(staged[:length], segmented))
+    power = sum(a**2 for a in staged[:length])
+    # dither and rounding of the crossfades
+    assert math.sqrt(difference / power) < 0.05
@@ -0,0 +1,141 @@
+import io
+import wave
+
+import pytest
+
+
+np = pytest.importorskip('numpy')
+
+# pylint: disable=wrong-import-position
+from radioscripts.render import (
+    block_gains,
+    limited_chunks,
+    limiter_envelope,
+    limiter_level,
+    read_frames,
+    read_segments,
+    rechunk,
+    render,
+    splice,
+)
+from radioscripts.wav import WavWriter
+
+
+def frames(*values: int, channels: int = 1) -> 'np.ndarray':
+    return np.array(values, dtype=np.int16).reshape(-1, channels)
+
+
+def test_splice_overlaps_segments():
+    pieces = splice(
+        [[frames(*[100] * 10)], [frames(*[200] * 10)]], overlap=4, bit_depth=16
+    )
+    program = np.concatenate(list(pieces))
+    assert len(program) == 16
+    assert (program[:6] == 100).all() and (program[10:] == 200).all()
+
+
+def test_splice_skips_empty_segments():
+    pieces = splice(
+        [[frames(*[100] * 10)], [], [frames()], [frames(*[200] * 10)]],
+        overlap=4,
+        bit_depth=16,
+    )
+    assert len(np.concatenate(list(pieces))) == 16
+
+
+@pytest.mark.parametrize('overlap', [0, 1, 3, 4, 6])
+def test_splice_matches_whole_segments_spliced(overlap):
+    chunked = [
+        [frames(1, 2), frames(3), frames(4, 5, 6)],
+        [frames(7), frames(8, 9)],
+        [frames(10, 11, 12, 13, 14)],
+    ]
+    whole = [[np.concatenate(segment)] for segment in chunked]
+    assert np.array_equal(
+        np.concatenate(list(splice(chunked, overlap=overlap, bit_depth=16))),
+        np.concatenate(list(splice(whole, overlap=overlap, bit_depth=16))),
+    )
+
+
+def test_read_segments_changes_volume():
+    segments = read_segments(
+        [io.BytesIO(frames(100, -200).tobytes()), io.BytesIO(frames(100).tobytes())],
+        channels=1,
+        bit_depth=16,
+        volumes=[2.5, 1.0],
+    )
+    assert [np.concatenate(list(segment)).ravel().tolist() for segment in segments] == [
+        [250, -500],
+        [100],
+    ]
+
+
+class Trickle(io.BytesIO):
+    """Returns at most 3 bytes at once, like a pipe may."""
+
+    def read(self, size=-1):
+        return super().read(3 if size < 0 else min(size, 3))
+
+
+def test_read_frames_reads_bounded_chunks():
+    chunks = list(
+        read_frames(
+            Trickle(frames(1, 2, 3, 4, 5).tobytes()), channels=1, bit_depth=16, frames=2
+        )
+    )
+    assert all(len(chunk) <= 2 for chunk in chunks)
+    assert np.concatenate(chunks).ravel().tolist() == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize('length', [0, 3, 7, 8, 20])
+def test_rechunk_yields_fixed_size_chunks(length):
+    pieces = [frames(*range(length)), frames(*range(length))]
+    chunks = list(rechunk(pieces, 4))
+    assert all(len(chunk) == 4 for chunk in chunks[:-1])
+    assert np.concatenate(chunks or [frames()]).ravel().tolist() == [
+        *range(length),
+        *range(length),
+    ]
+
+
+def test_block_gains_attenuate_blocks_above_threshold():
+    quiet, loud = [1000] * 4, [32767] * 4
+    gains = block_gains(frames(*quiet, *loud, 1000), block=4, bit_depth=16)
+    assert gains[0] == gains[2] == 1.0
+    assert 20 * np.log10(gains[1]) == pytest.approx(limiter_level(0), abs=0.01)
+
+
+def test_limiter_envelope_holds_gain_over_the_peak_block():
+    envelope = limiter_envelope(np.array([1.0, 0.5, 1.0]), before=None, after=0.8)
+    # gain drops one block ahead of the peak and rises after it
+    assert envelope.tolist() == [1.0, 0.5, 0.5, 0.8]
+
+
+@pytest.mark.parametrize('position', [0, 3, 4, 7, 11])
+def test_limited_chunks_reduce_late_peaks(position, monkeypatch):
+    monkeypatch.setattr('radioscripts.render.RENDER_CHUNK_FRAMES', 4)
+    program = [0] * 16
+    program[position] = 32767
+    chunks = limited_chunks([frames(*program)], block=4, bit_depth=16)
+    limited = np.concatenate(list(chunks))
+    assert len(limited) == 16
+    level = 20 * np.log10(np.abs(limited).max() / 32768)
+    assert level <= limiter_level(0) + 0.01
+
+
+def test_render_writes_wav(tmp_path):
+    tone = (np.sin(np.arange(4410) / 10) * 32767).astype(np.int16)
+    output_path = tmp_path / 'station.wav'
+    with WavWriter(output_path, channels=1, sample_rate=44100, bit_depth=16) as output:
+        render(
+            [io.BytesIO(tone.tobytes()), io.BytesIO(tone.tobytes())],
+            output,
+            crossfade_duration=0.01,
+            channels=1,
+            sample_rate=44100,
+            bit_depth=16,
+        )
+    with wave.open(str(output_path)) as output:
+        assert output.getnframes() == 2 * 4410 - 441
+        rendered = np.frombuffer(output.readframes(-1), dtype='<i2')
+    assert np.abs(rendered).max() >= 32000
@@ -0,0 +1,91 @@
+import wave
+
+import pytest
+
+from radioscripts.probe import wav_data_chunk
+from radioscripts.wav import WAV_HEADER_SIZE, WavWriter, align_header, header_size
+
+
+@pytest.mark.parametrize('chunk_size', [2, 4, 1024])
+@pytest.mark.parametrize(
+    'data',
+    [b'', b'\x01\x02' * 10, bytes(range(256)) * 3],
+    ids=['empty', 'short', 'long'],
+)
+def test_wav_writer(tmp_path, data, chunk_size):
+    path = tmp_path / 'station.wav'
+    with WavWriter(
+        path, channels=2, sample_rate=22050, bit_depth=16, chunk_size=chunk_size
+    ) as writer:
+        for start in range(0, len(data), 6):
+            writer.write(data[start : start + 6])
+
+    with wave.open(str(path)) as file:
+        assert (file.getnchannels(), file.getsampwidth()) == (2, 2)
+        assert file.getframerate() == 22050
+        assert file.readframes(-1) == data
+    assert wav_data_chunk(path.read_bytes()) == (88200, WAV_HEADER_SIZE, len(data))
+
+
+def test_wav_writer_pads_odd_data(tmp_path):
+    path = tmp_path / 'station.wav'
+    with WavWriter(path, channels=1, sample_rate=44100, bit_depth=8) as writer:
+        writer.write(b'\x80' * 3)
+    content = path.read_bytes()
+    assert len(content) == WAV_HEADER_SIZE + 4
+    assert wav_data_chunk(content)[2] == 3
+    assert int.from_bytes(content[4:8], 'little') == len(content) - 8
+
+
+@pytest.mark.parametrize('alignment', [2, 512, 4096, 32768])
+def test_align_header(tmp_path, alignment):
+    path = tmp_path / 'station.wav'
+    with WavWriter(path, channels=1, sample_rate=44100, bit_depth=16) as writer:
+        writer.write(b'\x01\x02' * 100)
+    content = path.read_bytes()
+
+    header = align_header(content[:WAV_HEADER_SIZE], 200, alignment)
+    aligned = header + content[WAV_HEADER_SIZE:]
+    assert len(header) % alignment == 0
+    assert wav_data_chunk(aligned) == (88200, len(header), 200)
+    assert int.from_bytes(aligned[4:8], 'little') == len(aligned) - 8
+    (tmp_path / 'aligned.wav').write_bytes(aligned)
+    with wave.open(str(tmp_path / 'aligned.wav')) as file:
+        assert file.readframes(-1) == b'\x01\x02' * 100
+
+
+@pytest.mark.parametrize('alignment', [None, 512, 4096])
+def test_header_size(tmp_path, alignment):
+    path = tmp_path / 'station.wav'
+    with WavWriter(path, channels=1, sample_rate=44100, bit_depth=16):
+        pass
+    header = path.read_bytes()
+    if alignment:
+        header = align_header(header, 0, alignment)
+    assert header_size(alignment) == len(header)
+
+
+@pytest.mark.parametrize('alignment', [None, 512, 4096])
+def test_wav_writer_aligns_audio_data(tmp_path, alignment):
+    path = tmp_path / 'station.wav'
+    with WavWriter(
+        path, channels=1, sample_rate=44100, bit_depth=16, alignment=alignment
+    ) as writer:
+        writer.write(b'\x01\x02' * 100)
+    content = path.read_bytes()
+    assert wav_data_chunk(content) == (88200, header_size(alignment), 200)
+    assert int.from_bytes(content[4:8], 'little') == len(content) - 8
+    with wave.open(str(path)) as file:
+        assert file.readframes(-1) == b'\x01\x02' * 100
+
+
+def test_wav_writer_overwrites_file_in_place(tmp_path):
+    path = tmp_path / 'station.wav'
+    path.write_bytes(bytes(10000))
+    inode = path.stat().st_ino
+    with WavWriter(path, channels=1, sample_rate=44100, bit_depth=16) as writer:
+        writer.write(b'\x01\x02' * 100)
+    assert path.stat().st_ino == inode
+    assert path.stat().st_size == WAV_HEADER_SIZE + 200
+    with wave.open(str(path)) as file:
+        assert file.readframes(-1) == b'\x01\x02' * 100
@@ -0,0 +1,199 @@
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import itertools
+import threading
+
+import pytest
+
+from radioscripts.download import DownloadError
+from radioscripts.worker import Worker
+
+
+class Catalog:
+    def __init__(self, sections: dict[str, list[str]]):
+        self._sections = sections
+
+    def sections(self) -> list[str]:
+        return list(self._sections)
+
+    def sounds(self, url: str) -> list[str]:
+        return self._sections[url]
+
+
+@pytest.fixture
+def worker(tmp_path):
+    worker = Worker(
+        target=tmp_path / 'card', catalog=Catalog({}), banks=1, files=1, minutes=1
+    )
+    yield worker
+    worker.writer.shutdown()
+
+
+@pytest.fixture
+def discarded(worker, monkeypatch):
+    """Keys of stations the writer is told not to wait for."""
+    keys = []
+    monkeypatch.setattr(worker.writer, 'discard', keys.append)
+    return keys
+
+
+@pytest.fixture
+def downloader():
+    with ThreadPoolExecutor(1) as executor:
+        yield executor
+
+
+def test_schedule_station_fails_when_download_fails(
+    worker, discarded, downloader, monkeypatch
+):
+    def download_station(*_):
+        raise DownloadError('unavailable')
+
+    monkeypatch.setattr(worker, 'download_station', download_station)
+    station = worker.schedule_station(downloader, 0, 0)
+    with pytest.raises(DownloadError):
+        station.result(timeout=5)
+    assert discarded == [(0, 0)]
+
+
+def test_schedule_station_renders_to_target(worker, downloader, tmp_path, monkeypatch):
+    samples_dir = tmp_path / 'samples'
+    samples_dir.mkdir()
+    sample = samples_dir / '000_sample.wav'
+    (tmp_path / 'card').mkdir()
+    monkeypatch.setattr(worker, 'download_station', lambda *_: ([sample], samples_dir))
+    rendered = []
+
+    def render_program(samples, path):
+        rendered.append(samples)
+        path.write_text('station')
+
+    monkeypatch.setattr(worker, 'render_program', render_program)
+    station = worker.schedule_station(downloader, 0, 0)
+    assert station.result(timeout=5) == tmp_path / 'card' / '00' / '00.wav'
+    assert station.result().read_text() == 'station'
+    assert rendered == [[sample]]
+    assert not samples_dir.exists()
+
+
+def test_schedule_station_fails_when_writer_is_shut_down(
+    worker, downloader, tmp_path, monkeypatch
+):
+    worker.writer.shutdown()
+    samples_dir = tmp_path / 'samples'
+    samples_dir.mkdir()
+    monkeypatch.setattr(worker, 'download_station', lambda *_: ([], samples_dir))
+    station = worker.schedule_station(downloader, 0, 0)
+    with pytest.raises(CancelledError):
+        station.result(timeout=5)
+    assert not samples_dir.exists()
+    assert not (tmp_path / 'card').exists()
+
+
+def test_schedule_station_is_not_downloaded_when_cancelled(
+    worker, discarded, downloader, monkeypatch
+):
+    downloads = []
+    monkeypatch.setattr(worker, 'download_station', downloads.append)
+    busy = threading.Event()
+    downloader.submit(busy.wait)  # occupies the only thread
+    station = worker.schedule_station(downloader, 0, 0)
+    assert station.cancel()
+    busy.set()
+    downloader.shutdown(wait=True)
+    assert not downloads
+    assert discarded == [(0, 0)]
+
+
+def test_download_station_keeps_samples_in_workdir(tmp_path, monkeypatch):
+    worker = Worker(
+        target=tmp_path / 'card',
+        catalog=Catalog({}),
+        banks=1,
+        files=1,
+        minutes=1,
+        workdir=tmp_path,
+    )
+    monkeypatch.setattr(worker, 'collect_station_samples', lambda *_: iter([]))
+    samples, dir_ = worker.download_station(0, 0, 1)
+    worker.writer.shutdown()
+    assert samples == []
+    assert dir_.parent == tmp_path
+
+
+def test_collect_samples_skips_samples_too_long(worker, tmp_path, monkeypatch):
+    durations = {'a': 10, 'b': 20, 'c': 50, 'd': 5}
+
+    def fetch_sample(url, path, remaining, abort):
+        return None if remaining <= durations[url] else (path, durations[url])
+
+    monkeypatch.setattr(worker, 'fetch_sample', fetch_sample)
+    samples = worker.collect_samples(
+        40, list(durations), tmp_path, crossfade_duration=0
+    )
+    assert [path.name.split('_')[1] for path in samples] == ['a', 'b', 'd']
+
+
+def test_collect_samples_fills_duration_crossfaded(worker, tmp_path, monkeypatch):
+    fetched = []
+
+    def fetch_sample(url, path, remaining, abort):
+        fetched.append(url)
+        return path, 20
+
+    worker.prefetch = 0
+    monkeypatch.setattr(worker, 'fetch_sample', fetch_sample)
+    samples = worker.collect_samples(
+        38, ['a', 'b', 'c', 'd'], tmp_path, crossfade_duration=2
+    )
+    # 20 + 18 seconds fill the duration, the last sample is cut
+    assert [path.name.split('_')[1] for path in samples] == ['a', 'b']
+    assert fetched == ['a', 'b']
+
+
+def test_collect_samples_uses_samples_too_long_after_skips(
+    worker, tmp_path, monkeypatch
+):
+    durations = {'a': 10, 'b': 100, 'c': 100}
+
+    def fetch_sample(url, path, remaining, abort):
+        return None if remaining <= durations[url] else (path, durations[url])
+
+    worker.prefetch = 0
+    monkeypatch.setattr(worker, 'fetch_sample', fetch_sample)
+    samples = worker.collect_samples(
+        40, list(durations), tmp_path, skips_count=1, crossfade_duration=0
+    )
+    assert [path.name.split('_')[1] for path in samples] == ['a', 'c']
+
+
+def test_collect_samples_aborts_downloads_ahead(worker, tmp_path, monkeypatch):
+    aborted = []
+    started = threading.Event()
+
+    def fetch_sample(url, path, remaining, abort):
+        if url == 'a':
+            return path, 1
+        started.set()
+        aborted.append(abort.wait(5))
+        return None
+
+    monkeypatch.setattr(worker, 'fetch_sample', fetch_sample)
+    samples = worker.collect_samples(60, ['a', 'b'], tmp_path)
+    next(samples)
+    assert started.wait(5)
+    samples.close()
+    assert aborted == [True]
+    assert not worker.prefetcher._shutdown  # the pool is shared by stations
+
+
+def test_plan_samples_urls_estimates_unknown_sizes(worker, monkeypatch):
+    descriptions = {
+        'known': (16000, 10.0),
+        'large': (80000, 10.0),
+        'unknown size': (None, 10.0),
+        'unknown': (None, None),
+    }
+    monkeypatch.setattr(worker, 'describe_sample', descriptions.__getitem__)
+    urls = worker.plan_samples_urls([list(descriptions)], 25)
+    assert set(itertools.islice(urls, 2)) == {'known', 'unknown size'}
+    assert set(urls) == {'large', 'unknown'}